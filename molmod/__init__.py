@@ -52,10 +52,14 @@ np.seterr(divide='raise', invalid='raise')
 from molmod.context import *
 
 from molmod.binning import *
+from molmod.rdf import *
 from molmod.clusters import *
+from molmod.compositeff import *
 from molmod.constants import *
+from molmod.ewald import *
 from molmod.graphs import *
 from molmod.ic import *
+from molmod.kdtree import *
 from molmod.log import *
 from molmod.minimizer import *
 from molmod.molecules import *
@@ -0,0 +1,160 @@
+// MolMod is a collection of molecular modelling tools for python.
+// Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+// for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+// reserved unless otherwise stated.
+//
+// This file is part of MolMod.
+//
+// MolMod is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// MolMod is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+
+#include <math.h>
+#include "common.h"
+
+static int search_cell_pair(
+  double *cor0, int *order0, int *offsets0, double *cor1, int *order1,
+  int *offsets1, int c0, int c1, int intra, double cutoff, int nshift,
+  double *shifts, int size, int counter, int *pairs, double *deltas,
+  double *distances, int periodic, double *matrix, double *reciprocal
+) {
+  /* Adds the pairs between the coordinates in cell c0 of the first set and
+     cell c1 of the second set to the output arrays. Returns the updated
+     counter. */
+  int i0, i1, j0, j1, k;
+  double delta[3], wrapped[3], image[3], d, d_sq, image_sq;
+
+  for (j0 = offsets0[c0]; j0 < offsets0[c0+1]; j0++) {
+    i0 = order0[j0];
+    for (j1 = offsets1[c1]; j1 < offsets1[c1+1]; j1++) {
+      i1 = order1[j1];
+      /* only include each pair once */
+      if (intra && (i1 >= i0)) continue;
+      if (periodic) {
+        d = distance_delta_periodic(cor1 + 3*i1, cor0 + 3*i0, delta, matrix, reciprocal);
+        if (nshift > 0) {
+          /* look for a shorter periodic image */
+          wrapped[0] = delta[0];
+          wrapped[1] = delta[1];
+          wrapped[2] = delta[2];
+          d_sq = d*d;
+          for (k = 0; k < nshift; k++) {
+            image[0] = wrapped[0] + shifts[3*k  ];
+            image[1] = wrapped[1] + shifts[3*k+1];
+            image[2] = wrapped[2] + shifts[3*k+2];
+            image_sq = image[0]*image[0] + image[1]*image[1] + image[2]*image[2];
+            if (image_sq < d_sq) {
+              d_sq = image_sq;
+              delta[0] = image[0];
+              delta[1] = image[1];
+              delta[2] = image[2];
+            }
+          }
+          d = sqrt(d_sq);
+        }
+      } else {
+        d = distance_delta(cor1 + 3*i1, cor0 + 3*i0, delta);
+      }
+      if (d > cutoff) continue;
+      /* When the output arrays are too small, the pairs are only counted
+         such that the caller can retry with larger arrays. */
+      if (counter < size) {
+        pairs[2*counter  ] = i0;
+        pairs[2*counter+1] = i1;
+        deltas[3*counter  ] = delta[0];
+        deltas[3*counter+1] = delta[1];
+        deltas[3*counter+2] = delta[2];
+        distances[counter] = d;
+      }
+      counter++;
+    }
+  }
+  return counter;
+}
+
+int binning_pair_search(
+  int n0, double *cor0, int *order0, int *offsets0, int n1, double *cor1,
+  int *order1, int *offsets1, int ncell, int intra, int cbegin, int cend,
+  int *shape, int *ranges,
+  int m, int *neighbors, int nlink, int *links, double cutoff, int nshift,
+  double *shifts, int size, int *pairs, double *deltas, double *distances,
+  int periodic, double *matrix, double *reciprocal
+) {
+  /* The coordinates in cell c are order[offsets[c]] to order[offsets[c+1]-1].
+     Both sets of coordinates are binned in the same box with the given shape.
+     The table with links covers this box, extended with ranges on both sides,
+     such that it can be used to look up neighboring cells. Only the cells
+     cbegin to cend-1 of the first set are considered, which makes it possible
+     to divide the work over several threads.
+
+     When shifts are given, these are added to the relative vectors to find
+     the true minimum image in skewed unit cells. */
+  int c0, c1, s, counter;
+  int key[3], ext[3];
+
+  counter = 0;
+  for (c0 = cbegin; c0 < cend; c0++) {
+    if (offsets0[c0] == offsets0[c0+1]) continue;
+    key[0] = c0/(shape[1]*shape[2]);
+    key[1] = (c0/shape[2])%shape[1];
+    key[2] = c0%shape[2];
+    for (s = 0; s < m; s++) {
+      /* The wrapping of the cell keys in periodic systems is already taken
+         care of in the table with links. */
+      ext[0] = key[0] + ranges[0] + neighbors[3*s  ];
+      ext[1] = key[1] + ranges[1] + neighbors[3*s+1];
+      ext[2] = key[2] + ranges[2] + neighbors[3*s+2];
+      c1 = links[
+        (ext[0]*(shape[1] + 2*ranges[1]) + ext[1])*(shape[2] + 2*ranges[2]) + ext[2]
+      ];
+      if (c1 < 0) continue;
+      counter = search_cell_pair(
+        cor0, order0, offsets0, cor1, order1, offsets1, c0, c1, intra,
+        cutoff, nshift, shifts, size, counter, pairs, deltas, distances,
+        periodic, matrix, reciprocal
+      );
+    }
+  }
+  return counter;
+}
+
+int binning_pair_search_sparse(
+  int n0, double *cor0, int *order0, int *offsets0, int n1, double *cor1,
+  int *order1, int *offsets1, int ncell0, int ncell1, int intra, int cbegin,
+  int cend, int *cell_offsets, int nneighbor, int *cell_neighbors,
+  double cutoff, int nshift, double *shifts, int size, int *pairs,
+  double *deltas, double *distances, int periodic, double *matrix,
+  double *reciprocal
+) {
+  /* Same as binning_pair_search, but only the occupied cells are stored. The
+     (occupied) neighboring cells of cell c0 in the second set are
+     cell_neighbors[cell_offsets[c0]] to cell_neighbors[cell_offsets[c0+1]-1].
+     This avoids a table for all cells in the bounding box, which becomes
+     huge for dilute systems with a fine grid. */
+  int c0, s, counter;
+
+  counter = 0;
+  for (c0 = cbegin; c0 < cend; c0++) {
+    for (s = cell_offsets[c0]; s < cell_offsets[c0+1]; s++) {
+      counter = search_cell_pair(
+        cor0, order0, offsets0, cor1, order1, offsets1, c0,
+        cell_neighbors[s], intra, cutoff, nshift, shifts, size, counter,
+        pairs, deltas, distances, periodic, matrix, reciprocal
+      );
+    }
+  }
+  return counter;
+}
@@ -32,16 +32,172 @@
 """
 
 
+from molmod.ext import binning_pair_search, binning_pair_search_sparse
 from molmod.unit_cells import UnitCell
-import numpy
 
+import numpy, threading
 
-__all__ = ["PairSearchIntra", "PairSearchInter"]
+
+__all__ = [
+    "PairSearchIntra", "PairSearchInter", "PairSearchImages", "NeighborList"
+]
+
+
+def _get_neighbor_indexes(cutoff, grid_cell, integer_cell=None):
+    """Compute the relative keys of the bins within the cutoff of a bin
+
+       In case of a periodic system (``integer_cell`` is given), the relative
+       keys are limited such that each bin is included only once.
+    """
+    if integer_cell is None:
+        return grid_cell.get_radius_indexes(cutoff)
+    elif _is_diagonal(integer_cell.matrix):
+        max_ranges = numpy.diag(integer_cell.matrix).astype(int)
+        max_ranges[True^integer_cell.active] = -1
+        return grid_cell.get_radius_indexes(cutoff, max_ranges)
+    else:
+        # Only keep the shortest relative key of all those that refer to
+        # the same (wrapped) bin.
+        indexes = grid_cell.get_radius_indexes(cutoff)
+        norms_sq = (grid_cell.to_cartesian(indexes)**2).sum(axis=1)
+        indexes = indexes[norms_sq.argsort(kind="mergesort")]
+        wrapped = _wrap_keys(indexes, integer_cell)
+        unique, first = numpy.unique(wrapped, axis=0, return_index=True)
+        return indexes[numpy.sort(first)]
+
+
+def _is_diagonal(matrix):
+    """Test if all off-diagonal elements of a matrix are zero"""
+    return (matrix == numpy.diag(numpy.diag(matrix))).all()
+
+
+def _get_keys(coordinates, grid_cell, integer_cell=None):
+    """Compute the (wrapped) integer bin keys of the given coordinates"""
+    keys = numpy.floor(grid_cell.to_fractional(coordinates)).astype(int)
+    if integer_cell is not None:
+        keys = _wrap_keys(keys, integer_cell)
+    return keys
+
+
+def _get_bounds(keys_list):
+    """Compute the smallest box that contains all given integer keys
+
+       Returns: ``(lower, shape)``
+    """
+    keys_list = [keys for keys in keys_list if len(keys) > 0]
+    if len(keys_list) == 0:
+        return numpy.zeros(3, int), numpy.ones(3, int)
+    lower = numpy.array([keys.min(axis=0) for keys in keys_list]).min(axis=0)
+    upper = numpy.array([keys.max(axis=0) for keys in keys_list]).max(axis=0)
+    return lower, upper - lower + 1
+
+
+def _get_links(lower, shape, ranges, integer_cell=None):
+    """Construct a table to look up the neighbors of a bin
+
+       The table covers the box of bins (``lower`` and ``shape``), extended
+       with the given ``ranges`` on both sides. Each element is the linear
+       index of the (wrapped) bin in the box or -1 when the bin lies outside
+       the box.
+    """
+    if integer_cell is None or _is_diagonal(integer_cell.matrix):
+        # The wrapping can be done for each direction separately, which
+        # avoids the construction of an array with all keys in the table.
+        maps = []
+        for i in xrange(3):
+            keys = numpy.zeros((shape[i] + 2*ranges[i], 3), int)
+            keys[:,i] = numpy.arange(lower[i] - ranges[i], lower[i] + shape[i] + ranges[i])
+            if integer_cell is not None:
+                keys = _wrap_keys(keys, integer_cell)
+            indexes = (keys[:,i] - lower[i]).astype(numpy.int32)
+            indexes[(indexes < 0) | (indexes >= shape[i])] = -1
+            maps.append(indexes)
+        links = maps[0].reshape(-1, 1, 1)*numpy.int32(shape[1]*shape[2])
+        links = links + maps[1].reshape(1, -1, 1)*numpy.int32(shape[2])
+        links = links + maps[2].reshape(1, 1, -1)
+        links[
+            (maps[0] < 0).reshape(-1, 1, 1) |
+            (maps[1] < 0).reshape(1, -1, 1) |
+            (maps[2] < 0).reshape(1, 1, -1)
+        ] = -1
+        return links.ravel()
+    else:
+        keys = numpy.indices(shape + 2*ranges).reshape(3, -1).transpose()
+        keys += lower - ranges
+        keys = _wrap_keys(keys, integer_cell)
+        keys -= lower
+        mask = ((keys >= 0) & (keys < shape)).all(axis=1)
+        links = numpy.zeros(len(keys), numpy.int32)
+        links[:] = -1
+        links[mask] = numpy.ravel_multi_index(keys[mask].transpose(), shape)
+        return links
+
+
+def _get_cell_neighbors(bins0, bins1, chunk_size=1048576):
+    """Find the occupied neighboring bins of all bins in a sparse Binning
+
+       Arguments:
+        | ``bins0``  --  the sparse Binning of the first set of coordinates
+        | ``bins1``  --  the sparse Binning of the second set, with the same
+                         bounds
+
+       Returns: ``(cell_offsets, cell_neighbors)``. The neighbors of bin ``c``
+       of ``bins0`` are the bins
+       ``cell_neighbors[cell_offsets[c]:cell_offsets[c+1]]`` of ``bins1``,
+       in the order of ``bins0.neighbor_indexes``. The keys of the
+       neighboring bins are looked up with a binary search among the occupied
+       bins of ``bins1``. This is done for a limited number of bins at a time,
+       such that the memory usage does not exceed ``chunk_size`` keys.
+    """
+    keys0 = numpy.array(numpy.unravel_index(bins0.cells, bins0.shape)).transpose() + bins0.lower
+    shifts = bins0.neighbor_indexes
+    step = max(1, chunk_size/len(shifts))
+    sources = []
+    neighbors = []
+    for begin in xrange(0, len(keys0), step):
+        keys = (keys0[begin:begin+step].reshape(-1, 1, 3) + shifts).reshape(-1, 3)
+        if bins0.integer_cell is not None:
+            keys = _wrap_keys(keys, bins0.integer_cell)
+        keys -= bins1.lower
+        mask = ((keys >= 0) & (keys < bins1.shape)).all(axis=1)
+        cells = numpy.ravel_multi_index(keys[mask].transpose(), bins1.shape)
+        positions = numpy.searchsorted(bins1.cells, cells)
+        positions[positions == len(bins1.cells)] = 0
+        hit = bins1.cells[positions] == cells
+        sources.append(mask.nonzero()[0][hit]/len(shifts) + begin)
+        neighbors.append(positions[hit].astype(numpy.int32))
+    cell_offsets = numpy.zeros(len(keys0) + 1, numpy.int32)
+    cell_offsets[1:] = numpy.bincount(numpy.concatenate(sources), minlength=len(keys0)).cumsum()
+    return cell_offsets, numpy.concatenate(neighbors)
+
+
+def _wrap_keys(keys, integer_cell):
+    """Translate integer bin keys into the central cell of a periodic grid
+
+       A small number is added to the fractional coordinates before rounding.
+       This makes sure that all periodic images of a key are wrapped in the
+       same way, even when it lies exactly on the border of the central cell.
+    """
+    images = numpy.floor(integer_cell.to_fractional(keys) + (0.5 + 1e-8))
+    return keys - numpy.round(integer_cell.to_cartesian(images)).astype(int)
 
 
 class Binning(object):
-    """Division of coordinates in regular bins"""
-    def __init__(self, coordinates, cutoff, grid_cell, integer_cell=None):
+    """Division of coordinates in regular bins
+
+       The bins are stored in a compact form, similar to a sparse CSR matrix.
+       The indexes of the coordinates in bin ``c`` are
+       ``order[offsets[c]:offsets[c+1]]``. The bins are numbered
+       consecutively in a box of integer keys, from ``lower`` to
+       ``lower+shape-1``.
+
+       When the box contains many more bins than coordinates, e.g. for a
+       dilute system with a fine grid, only the occupied bins are stored. In
+       this sparse form, ``cells`` is a sorted array with the linear indexes
+       in the box of the occupied bins and bin ``c`` refers to ``cells[c]``.
+       In the dense form, ``cells`` is None.
+    """
+    def __init__(self, coordinates, cutoff, grid_cell, integer_cell=None, bounds=None, sparse=None):
         """Initialize a Binning object
 
            Arguments:
@@ -57,71 +213,136 @@ class Binning(object):
            Optional argument:
             | ``integer_cell``  --  the periodicity of the system in terms if
                                     integer grid cells.
+            | ``bounds``  --  a tuple ``(lower, shape)`` with the box of keys
+                              in which the bins are numbered. It must contain
+                              all keys of the coordinates. This is useful to
+                              number the bins of two Binning objects in the
+                              same way. When not given, the smallest box is
+                              used.
+            | ``sparse``  --  when True, only the occupied bins are stored.
+                              When not given, this is only done when the box
+                              contains more than 8N+1000 bins.
         """
+        self.coordinates = coordinates
         self.grid_cell = grid_cell
         self.integer_cell = integer_cell
 
-        # setup the bins
-        self._bins = {}
+        # assign an integer key and a bin index to each coordinate
+        keys = _get_keys(coordinates, grid_cell, integer_cell)
+        if bounds is None:
+            bounds = _get_bounds([keys])
+        self.lower, self.shape = bounds
+        if len(keys) > 0:
+            cells = numpy.ravel_multi_index((keys - self.lower).transpose(), self.shape)
+        else:
+            cells = numpy.zeros(0, int)
+        del keys
+        if sparse is None:
+            sparse = numpy.product(self.shape.astype(float)) > 8*len(cells) + 1000
+        if sparse:
+            self.cells, cells = numpy.unique(cells, return_inverse=True)
+            num_cells = len(self.cells)
+        else:
+            self.cells = None
+            num_cells = numpy.product(self.shape)
 
-        fractional = grid_cell.to_fractional(coordinates)
-        for i in xrange(len(coordinates)):
-            key = tuple(fractional[i].astype(int))
-            if integer_cell is not None:
-                key = self.wrap_key(key)
-            bin = self._bins.get(key)
-            if bin is None:
-                bin = []
-                self._bins[key] = bin
-            bin.append((i, coordinates[i]))
+        # sort the coordinates by bin
+        self.order = cells.argsort(kind="mergesort").astype(numpy.int32)
+        self.offsets = numpy.zeros(num_cells + 1, numpy.int32)
+        numpy.cumsum(
+            numpy.bincount(cells, minlength=num_cells),
+            out=self.offsets[1:]
+        )
 
         # compute the neigbouring bins within the cutoff
-        if self.integer_cell is None:
-            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff)
+        self.neighbor_indexes = _get_neighbor_indexes(cutoff, grid_cell, integer_cell)
+        self.ranges = abs(self.neighbor_indexes).max(axis=0)
+        # table to look up the neighboring bins, only in the dense form
+        if sparse:
+            self.links = None
         else:
-            max_ranges = numpy.diag(self.integer_cell.matrix).astype(int)
-            max_ranges[True^self.integer_cell.active] = -1
-            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff, max_ranges)
+            self.links = _get_links(self.lower, self.shape, self.ranges, integer_cell)
+
+    def _get_key(self, cell):
+        """Return the integer key of a bin"""
+        if self.cells is not None:
+            cell = self.cells[cell]
+        return tuple(int(k) for k in numpy.unravel_index(cell, self.shape) + self.lower)
+
+    def _get_bin(self, cell):
+        """Return the indexes of the coordinates in a bin"""
+        return self.order[self.offsets[cell]:self.offsets[cell+1]]
 
     def __iter__(self):
-        """Iterate over (key,bin) pairs"""
-        return self._bins.iteritems()
+        """Iterate over (key,indexes) pairs of all non-empty bins"""
+        for cell in (self.offsets[1:] > self.offsets[:-1]).nonzero()[0]:
+            yield self._get_key(cell), self._get_bin(cell)
 
     def iter_surrounding(self, center_key):
-        """Iterate over all bins surrounding the given bin"""
-        for shift in self.neighbor_indexes:
-            key = tuple(numpy.add(center_key, shift).astype(int))
+        """Iterate over all non-empty bins surrounding the given bin"""
+        if self.cells is not None:
+            keys = numpy.array(center_key) + self.neighbor_indexes
             if self.integer_cell is not None:
-                key = self.wrap_key(key)
-            bin = self._bins.get(key)
-            if bin is not None:
-                yield key, bin
+                keys = _wrap_keys(keys, self.integer_cell)
+            keys -= self.lower
+            keys = keys[((keys >= 0) & (keys < self.shape)).all(axis=1)]
+            cells = numpy.ravel_multi_index(keys.transpose(), self.shape)
+            positions = numpy.searchsorted(self.cells, cells)
+            for cell, position in zip(cells, positions):
+                if position < len(self.cells) and self.cells[position] == cell:
+                    yield self._get_key(position), self._get_bin(position)
+            return
+        ext_shape = self.shape + 2*self.ranges
+        center = numpy.array(center_key) - self.lower + self.ranges
+        for shift in self.neighbor_indexes:
+            ext_key = center + shift
+            if (ext_key < 0).any() or (ext_key >= ext_shape).any():
+                continue
+            cell = self.links[numpy.ravel_multi_index(ext_key, ext_shape)]
+            if cell >= 0 and self.offsets[cell+1] > self.offsets[cell]:
+                yield self._get_key(cell), self._get_bin(cell)
 
     def wrap_key(self, key):
         """Translate the key into the central cell
 
            This method is only applicable in case of a periodic system.
         """
-        return tuple(numpy.round(
-            self.integer_cell.shortest_vector(key)
-        ).astype(int))
+        return tuple(_wrap_keys(numpy.array(key), self.integer_cell))
 
 
 class PairSearchBase(object):
     """Base class for :class:`PairSearchIntra` and :class:`PairSearchInter`"""
-    def _setup_grid(self, cutoff, unit_cell, grid):
-        """Choose a proper grid for the binning process"""
+    def _setup_grid(self, cutoff, unit_cell, grid, coordinates):
+        """Choose a proper grid for the binning process
+
+           The last argument is a list of coordinate arrays that will be
+           triaged into bins. It is used to avoid a huge number of empty bins
+           when the grid is chosen automatically for a dilute system.
+        """
         if grid is None:
             # automatically choose a decent grid
+            # Keep the number of bins in the bounding box of all coordinates
+            # close to the number of coordinates. (Explicit fine grids are
+            # handled by storing only the occupied bins, see Binning.)
+            max_bins = 8*sum(len(c) for c in coordinates) + 1000
             if unit_cell is None:
                 grid = cutoff/2.9
+                extent = 0.0
+                for c in coordinates:
+                    if len(c) > 0:
+                        extent = numpy.maximum(extent, c.max(axis=0) - c.min(axis=0))
+                while numpy.product(extent/grid + 1) > max_bins:
+                    grid *= 1.2
             else:
-                # The following would be faster, but it is not reliable
-                # enough yet.
-                #grid = unit_cell.get_optimal_subcell(cutoff/2.0)
-                divisions = numpy.ceil(unit_cell.spacings/cutoff)
+                # The grid is derived from the reduced unit cell, which is much
+                # less skewed in case of triclinic cells. This keeps the number
+                # of neighboring bins close to that of an orthorhombic cell.
+                reduced = unit_cell.reduced
+                divisions = numpy.ceil(reduced.spacings/cutoff)
                 divisions[divisions<1] = 1
-                grid = unit_cell/divisions
+                while numpy.product(divisions) > max_bins:
+                    divisions = numpy.ceil(divisions/1.2)
+                grid = reduced/divisions
 
         if isinstance(grid, float):
             grid_cell = UnitCell(numpy.array([
@@ -135,9 +356,11 @@ class PairSearchBase(object):
             raise TypeError("Grid must be None, a float or a UnitCell instance.")
 
         if unit_cell is not None:
-            # The columns of integer_matrix are the unit cell vectors in
-            # fractional coordinates of the grid cell.
-            integer_matrix = grid_cell.to_fractional(unit_cell.matrix.transpose()).transpose()
+            # The columns of integer_matrix are the (reduced) unit cell vectors
+            # in fractional coordinates of the grid cell. The reduced unit cell
+            # describes the same periodicity, but it often results in a
+            # diagonal integer_matrix.
+            integer_matrix = grid_cell.to_fractional(unit_cell.reduced.matrix.transpose()).transpose()
             if abs((integer_matrix - numpy.round(integer_matrix))*self.unit_cell.active).max() > 1e-6:
                 raise ValueError("The unit cell vectors are not an integer linear combination of grid cell vectors.")
             integer_matrix = integer_matrix.round()
@@ -145,7 +368,109 @@ class PairSearchBase(object):
         else:
             integer_cell = None
 
-        return grid_cell, integer_cell
+        self.grid_cell = grid_cell
+        self.integer_cell = integer_cell
+
+    def _search(self, bins0, bins1, intra):
+        """Compute all pairs below the cutoff with the compiled cell lists
+
+           Both Binning objects must have the same bounds and the same form
+           (dense or sparse).
+        """
+        if bins0.cells is not None:
+            cell_offsets, cell_neighbors = _get_cell_neighbors(bins0, bins1)
+        if len(bins0.coordinates) == 0 or len(bins1.coordinates) == 0 or \
+           (bins0.cells is not None and len(cell_neighbors) == 0):
+            return (
+                numpy.zeros(0, int), numpy.zeros(0, int),
+                numpy.zeros((0, 3), float), numpy.zeros(0, float),
+            )
+        shifts = numpy.zeros((0, 3), float)
+        if self.unit_cell is None:
+            periodic_args = ()
+        elif self.exact:
+            reduced = self.unit_cell.reduced
+            periodic_args = (reduced.matrix, reduced.reciprocal)
+            shifts = reduced.image_shifts
+        else:
+            periodic_args = (self.unit_cell.matrix, self.unit_cell.reciprocal)
+
+        coordinates0 = numpy.ascontiguousarray(bins0.coordinates, float)
+        coordinates1 = numpy.ascontiguousarray(bins1.coordinates, float)
+
+        def search_slab(cbegin, cend):
+            """Compute all pairs for the bins cbegin to cend-1 of bins0"""
+            # The size of the output arrays is not known in advance. When the
+            # initial guess is too small, the search is repeated with arrays
+            # that are large enough.
+            size = 4*(bins0.offsets[cend] - bins0.offsets[cbegin] + len(coordinates1)) + 64
+            while True:
+                pairs = numpy.zeros((size, 2), numpy.int32)
+                deltas = numpy.zeros((size, 3), float)
+                distances = numpy.zeros(size, float)
+                if bins0.cells is None:
+                    count = binning_pair_search(
+                        coordinates0, bins0.order, bins0.offsets, coordinates1,
+                        bins1.order, bins1.offsets, intra, cbegin, cend,
+                        bins0.shape, bins0.ranges, bins0.neighbor_indexes,
+                        bins0.links, self.cutoff, shifts, pairs, deltas,
+                        distances, *periodic_args
+                    )
+                else:
+                    count = binning_pair_search_sparse(
+                        coordinates0, bins0.order, bins0.offsets, coordinates1,
+                        bins1.order, bins1.offsets, intra, cbegin, cend,
+                        cell_offsets, cell_neighbors, self.cutoff, shifts,
+                        pairs, deltas, distances, *periodic_args
+                    )
+                if count <= size:
+                    break
+                size = count
+            return pairs[:count], deltas[:count], distances[:count]
+
+        ncell = len(bins0.offsets) - 1
+        if self.workers <= 1:
+            results = [search_slab(0, ncell)]
+        else:
+            # Divide the bins in slabs with about the same number of
+            # coordinates. The compiled routine releases the GIL, such that
+            # the slabs are really processed in parallel.
+            borders = numpy.searchsorted(
+                bins0.offsets,
+                numpy.arange(1, self.workers)*len(coordinates0)/float(self.workers)
+            )
+            borders = [0] + list(numpy.clip(borders, 0, ncell)) + [ncell]
+            results = [None]*self.workers
+
+            def work(index):
+                results[index] = search_slab(borders[index], borders[index+1])
+
+            threads = [
+                threading.Thread(target=work, args=(index,))
+                for index in xrange(self.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if None in results:
+                raise RuntimeError("The pair search failed in one of the threads.")
+
+        pairs = numpy.concatenate([result[0] for result in results])
+        return (
+            pairs[:, 0].astype(int), pairs[:, 1].astype(int),
+            numpy.concatenate([result[1] for result in results]),
+            numpy.concatenate([result[2] for result in results]),
+        )
+
+    def __iter__(self):
+        """Iterate over all pairs with a distance below the cutoff
+
+           This is a thin wrapper around the ``get_arrays`` method.
+        """
+        i0, i1, deltas, distances = self.get_arrays()
+        for k in xrange(len(distances)):
+            yield int(i0[k]), int(i1[k]), deltas[k], distances[k]
 
 
 class PairSearchIntra(PairSearchBase):
@@ -157,10 +482,15 @@ class PairSearchIntra(PairSearchBase):
            for i, j, distance, delta in PairSearchIntra(coordinates, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once as numpy arrays, which is a lot
+       more efficient for large systems::
+
+           i, j, deltas, distances = PairSearchIntra(coordinates, 2.5).get_arrays()
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
-    def __init__(self, coordinates, cutoff, unit_cell=None, grid=None):
+    def __init__(self, coordinates, cutoff, unit_cell=None, grid=None, exact=False, workers=1):
         """
            Arguments:
             | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
@@ -180,32 +510,45 @@ class PairSearchIntra(PairSearchBase):
                         the unit cell). If this is not the case, a ValueError is
                         raised.
 
+            | ``exact``  --  When True, the true minimum image convention is
+                             applied, also for skewed unit cells. By default,
+                             the relative vectors have fractional coordinates
+                             in the range [-0.5,0.5[, see
+                             :meth:`molmod.unit_cells.UnitCell.shortest_vector`.
+            | ``workers``  --  The number of threads used for the pair search.
+                               [default=1]
+
            The default value of grid depends on other parameters:
 
-             1) When no unit cell is given, it is equal to cutoff/2.9.
-             2) When a unit cell is given, the grid cell is as close to cubic
-                as possible, with spacings below cutoff/2 that are integer
-                divisions of the unit cell spacings
+             1) When no unit cell is given, it is equal to cutoff/2.9, unless
+                this would result in many more bins than coordinates. (An
+                explicit fine grid in a dilute system is allowed. In that case
+                only the occupied bins are stored.)
+             2) When a unit cell is given, the grid cell is obtained by
+                dividing the reduced unit cell (see
+                :attr:`molmod.unit_cells.UnitCell.reduced`) such that the
+                spacings are just below the cutoff.
         """
         self.cutoff = cutoff
         self.unit_cell = unit_cell
-        grid_cell, integer_cell = self._setup_grid(cutoff, unit_cell, grid)
-        self.bins = Binning(coordinates, cutoff, grid_cell, integer_cell)
+        self.exact = exact
+        self.workers = workers
+        self._setup_grid(cutoff, unit_cell, grid, [coordinates])
+        self.bins = Binning(coordinates, cutoff, self.grid_cell, self.integer_cell)
+
+    def get_arrays(self):
+        """Compute all pairs with a distance below the cutoff at once
+
+           The search is carried out with compiled cell lists, which is much
+           faster than iterating over the pairs.
+
+           Returns: ``(i0, i1, deltas, distances)``. The first two are integer
+           arrays with the indexes of the pairs (``i1 < i0``), ``deltas`` is an
+           Mx3 array with the relative vectors (from ``i0`` to ``i1``) and
+           ``distances`` contains the corresponding norms.
+        """
+        return self._search(self.bins, self.bins, True)
 
-    def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
-        for key0, bin0 in self.bins:
-            for key1, bin1 in self.bins.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        if i1 >= i0:
-                            continue
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
 
 class PairSearchInter(PairSearchBase):
     """Iterator over all pairs of coordinates with a distance below a cutoff.
@@ -217,10 +560,13 @@ class PairSearchInter(PairSearchBase):
            for i, j, distance, delta in PairSearchInter(coordinates0, coordinates1, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once as numpy arrays with the method
+       ``get_arrays``.
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
-    def __init__(self, coordinates0, coordinates1, cutoff, unit_cell=None, grid=None):
+    def __init__(self, coordinates0, coordinates1, cutoff, unit_cell=None, grid=None, exact=False, workers=1):
         """
            Arguments:
             | ``coordinates0``  --  A Nx3 numpy array with Cartesian coordinates
@@ -241,27 +587,256 @@ class PairSearchInter(PairSearchBase):
                         the unit cell). If this is not the case, a ValueError is
                         raised.
 
+            | ``exact``  --  When True, the true minimum image convention is
+                             applied, also for skewed unit cells. By default,
+                             the relative vectors have fractional coordinates
+                             in the range [-0.5,0.5[, see
+                             :meth:`molmod.unit_cells.UnitCell.shortest_vector`.
+            | ``workers``  --  The number of threads used for the pair search.
+                               [default=1]
+
            The default value of grid depends on other parameters:
-             1) When no unit cell is given, it is equal to cutoff/2.9.
-             2) When a unit cell is given, the grid cell is as close to cubic
-                as possible, with spacings below cutoff/2 that are integer
-                divisions of the unit cell spacings
+             1) When no unit cell is given, it is equal to cutoff/2.9, unless
+                this would result in many more bins than coordinates. (An
+                explicit fine grid in a dilute system is allowed. In that case
+                only the occupied bins are stored.)
+             2) When a unit cell is given, the grid cell is obtained by
+                dividing the reduced unit cell (see
+                :attr:`molmod.unit_cells.UnitCell.reduced`) such that the
+                spacings are just below the cutoff.
         """
         self.cutoff = cutoff
         self.unit_cell = unit_cell
-        grid_cell, integer_cell = self._setup_grid(cutoff, unit_cell, grid)
-        self.bins0 = Binning(coordinates0, cutoff, grid_cell, integer_cell)
-        self.bins1 = Binning(coordinates1, cutoff, grid_cell, integer_cell)
+        self.exact = exact
+        self.workers = workers
+        self._setup_grid(cutoff, unit_cell, grid, [coordinates0, coordinates1])
+        # both sets of bins must be numbered in the same way
+        bounds = _get_bounds([
+            _get_keys(coordinates0, self.grid_cell, self.integer_cell),
+            _get_keys(coordinates1, self.grid_cell, self.integer_cell),
+        ])
+        sparse = numpy.product(bounds[1].astype(float)) > 8*(len(coordinates0) + len(coordinates1)) + 1000
+        self.bins0 = Binning(coordinates0, cutoff, self.grid_cell, self.integer_cell, bounds, sparse)
+        self.bins1 = Binning(coordinates1, cutoff, self.grid_cell, self.integer_cell, bounds, sparse)
+
+    def get_arrays(self):
+        """Compute all pairs with a distance below the cutoff at once
+
+           The search is carried out with compiled cell lists, which is much
+           faster than iterating over the pairs.
+
+           Returns: ``(i0, i1, deltas, distances)``. The first two are integer
+           arrays with the indexes of the pairs in ``coordinates0`` and
+           ``coordinates1``, respectively. ``deltas`` is an Mx3 array with the
+           relative vectors (from ``i0`` to ``i1``) and ``distances`` contains
+           the corresponding norms.
+        """
+        return self._search(self.bins0, self.bins1, False)
+
+
+class PairSearchImages(object):
+    """Iterator over all pairs of periodic images with a distance below a cutoff
+
+       Example usage::
+
+           unit_cell = UnitCell(numpy.identity(3)*5)
+           coordinates = numpy.random.uniform(0,5,(10,3))
+           for i, j, image, delta, distance in PairSearchImages(coordinates, 12.0, unit_cell):
+               print i, j, image, distance
+
+       In contrast to :class:`PairSearchIntra`, the minimum image convention is
+       not applied. All periodic images of the coordinates within the cutoff
+       are included, such that the cutoff may be larger than half the spacing
+       of the unit cell. The relative vector of a pair is::
+
+           coordinates[j] - coordinates[i] + unit_cell.to_cartesian(image)
+
+       Each pair of images is only included once: ``j < i``, or ``j == i`` and
+       the first nonzero element of ``image`` is positive.
+    """
+
+    def __init__(self, coordinates, cutoff, unit_cell, grid=None, workers=1):
+        """
+           Arguments:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+            | ``cutoff``  --  The cutoff radius for the pair distances.
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+
+           Optional argument:
+            | ``grid``  --  The edge length of the cubic bins used for the
+                            pair search. The default is cutoff/2.9.
+            | ``workers``  --  The number of threads used for the pair search.
+                               [default=1]
+        """
+        self.coordinates = coordinates
+        self.cutoff = cutoff
+        self.unit_cell = unit_cell
+        self.grid = grid
+        self.workers = workers
+
+    def get_arrays(self):
+        """Compute all pairs of images with a distance below the cutoff at once
+
+           The coordinates are first translated into the central unit cell.
+           All images of these coordinates that can be within the cutoff of the
+           central cell are then constructed, using the indexes of
+           :meth:`molmod.unit_cells.UnitCell.get_radius_indexes`. Finally, the
+           pairs between the central cell and these images are found with
+           the compiled cell lists, without periodic boundary conditions.
+
+           Returns: ``(i0, i1, images, deltas, distances)``. The first two are
+           integer arrays with the indexes of the pairs, ``images`` is an Mx3
+           integer array with the image of the second coordinate, ``deltas``
+           is an Mx3 array with the relative vectors and ``distances`` contains
+           the corresponding norms.
+        """
+        unit_cell = self.unit_cell
+        fractional = unit_cell.to_fractional(self.coordinates)
+        offsets = numpy.floor(fractional).astype(int)
+        fractional -= offsets
+        central = self.coordinates - unit_cell.to_cartesian(offsets)
+
+        # Only keep the images that are close enough to the central cell.
+        # For each active direction, the fractional coordinate may not be
+        # further from the central cell than the cutoff.
+        margins = numpy.zeros(3, float)
+        margins[unit_cell.active] = self.cutoff/unit_cell.spacings[unit_cell.active]
+        image_indexes = unit_cell.get_radius_indexes(self.cutoff).astype(int)
+        parts_i = []
+        parts_k = []
+        for k in image_indexes:
+            shifted = fractional + k
+            mask = ((shifted >= -margins) & (shifted <= 1 + margins)).all(axis=1)
+            parts_i.append(mask.nonzero()[0])
+            parts_k.append(numpy.tile(k, (len(parts_i[-1]), 1)))
+        copy_indexes = numpy.concatenate(parts_i)
+        copy_images = numpy.concatenate(parts_k)
+        copies = central[copy_indexes] + unit_cell.to_cartesian(copy_images)
+
+        pair_search = PairSearchInter(
+            central, copies, self.cutoff, None, self.grid, workers=self.workers
+        )
+        i0, j, deltas, distances = pair_search.get_arrays()
+        i1 = copy_indexes[j]
+        # translate the images back to the original coordinates
+        images = copy_images[j] - offsets[i1] + offsets[i0]
+
+        # only include each pair once
+        signs = numpy.sign(images)
+        first = signs[:,0] + (signs[:,0] == 0)*(signs[:,1] + (signs[:,1] == 0)*signs[:,2])
+        mask = (i1 < i0) | ((i1 == i0) & (first > 0))
+        return i0[mask], i1[mask], images[mask], deltas[mask], distances[mask]
 
     def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
-        for key0, bin0 in self.bins0:
-            for key1, bin1 in self.bins1.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
+        """Iterate over all pairs of images with a distance below the cutoff
+
+           This is a thin wrapper around the ``get_arrays`` method.
+        """
+        i0, i1, images, deltas, distances = self.get_arrays()
+        for k in xrange(len(distances)):
+            yield int(i0[k]), int(i1[k]), images[k], deltas[k], distances[k]
+
+
+class NeighborList(PairSearchBase):
+    """Verlet neighbor list that can be reused for many similar geometries
+
+       Example usage::
+
+           neighbor_list = NeighborList(5.0, 1.0, unit_cell)
+           for coordinates in frames:
+               neighbor_list.update(coordinates)
+               i, j, deltas, distances = neighbor_list.get_arrays()
+
+       The pair search is carried out with a cutoff that is extended with a
+       skin. All pairs within the (unextended) cutoff are then obtained by
+       recomputing the distances of the candidate pairs. A new pair search is
+       only performed when some atom has moved more than half the skin since
+       the previous pair search.
+
+       Note that for periodic systems the minimum image convention is applied.
+    """
+
+    def __init__(self, cutoff, skin, unit_cell=None, grid=None, exact=False, workers=1):
+        """
+           Arguments:
+            | ``cutoff``  --  The cutoff radius for the pair distances.
+            | ``skin``  --  The extension of the cutoff used for the list of
+                            candidate pairs.
+
+           Optional arguments:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``grid``  --  Specification of the grid, see
+                            :class:`PairSearchIntra`. The grid must be suitable
+                            for the extended cutoff, i.e. ``cutoff+skin``.
+            | ``exact``  --  When True, the true minimum image convention is
+                             applied, see :class:`PairSearchIntra`.
+            | ``workers``  --  The number of threads used for the pair search.
+                               [default=1]
+
+           The method ``update`` must be called before the pairs can be
+           retrieved.
+        """
+        if skin < 0:
+            raise ValueError("The skin must not be negative.")
+        self.cutoff = cutoff
+        self.skin = skin
+        self.unit_cell = unit_cell
+        self.grid = grid
+        self.exact = exact
+        self.workers = workers
+        # the number of pair searches carried out so far
+        self.num_builds = 0
+        self._reference = None
+        self._candidates = None
+        self._pairs = None
+
+    def _build(self, coordinates):
+        """Construct a new list of candidate pairs"""
+        pair_search = PairSearchIntra(
+            coordinates, self.cutoff + self.skin, self.unit_cell, self.grid,
+            self.exact, self.workers
+        )
+        i0, i1, deltas, distances = pair_search.get_arrays()
+        self._reference = coordinates.copy()
+        self._candidates = i0, i1
+        self.num_builds += 1
+        mask = distances <= self.cutoff
+        self._pairs = i0[mask], i1[mask], deltas[mask], distances[mask]
+
+    def update(self, coordinates):
+        """Compute the pairs for a new set of coordinates
+
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Returns True when a new pair search was needed, False otherwise.
+        """
+        if self._reference is None or len(coordinates) != len(self._reference):
+            self._build(coordinates)
+            return True
+        displacements = coordinates - self._reference
+        if self.unit_cell is not None:
+            displacements = self.unit_cell.shortest_vector(displacements, self.exact)
+        if len(displacements) > 0 and \
+           (displacements*displacements).sum(axis=1).max() > 0.25*self.skin**2:
+            self._build(coordinates)
+            return True
+        i0, i1 = self._candidates
+        deltas = coordinates[i1] - coordinates[i0]
+        if self.unit_cell is not None:
+            deltas = self.unit_cell.shortest_vector(deltas, self.exact)
+        distances = numpy.sqrt((deltas*deltas).sum(axis=1))
+        mask = distances <= self.cutoff
+        self._pairs = i0[mask], i1[mask], deltas[mask], distances[mask]
+        return False
+
+    def get_arrays(self):
+        """Return all pairs with a distance below the cutoff
+
+           The result is obtained for the coordinates given to the last call of
+           the method ``update``. The format of the return value is the same as
+           in :meth:`PairSearchIntra.get_arrays`.
+        """
+        if self._pairs is None:
+            raise RuntimeError("The method update must be called first.")
+        return self._pairs
@@ -95,3 +95,27 @@ double distance_delta_periodic(double *a, double *b, double *delta, double *matr
 double norm(double *a) {
   return sqrt(a[0]*a[0] + a[1]*a[1] + a[2]*a[2]);
 }
+
+float distance_float(float *a, float *b) {
+  float tmp, dsq;
+  tmp = a[0]-b[0];
+  dsq = tmp*tmp;
+  tmp = a[1]-b[1];
+  dsq += tmp*tmp;
+  tmp = a[2]-b[2];
+  dsq += tmp*tmp;
+  return sqrtf(dsq);
+}
+
+double distance_periodic_float(float *a, float *b, double *matrix, double *reciprocal) {
+  // The minimum image is determined in double precision, as the
+  // fractional coordinates are rounded.
+  double a_double[3], b_double[3];
+  a_double[0] = a[0];
+  a_double[1] = a[1];
+  a_double[2] = a[2];
+  b_double[0] = b[0];
+  b_double[1] = b[1];
+  b_double[2] = b[2];
+  return distance_periodic(a_double, b_double, matrix, reciprocal);
+}
@@ -35,5 +35,7 @@ double distance_periodic(double *a, double *b, double *matrix, double *reciproca
 double distance_delta(double *a, double *b, double *delta);
 double distance_delta_periodic(double *a, double *b, double *delta, double *matrix, double *reciprocal);
 double norm(double *a);
+float distance_float(float *a, float *b);
+double distance_periodic_float(float *a, float *b, double *matrix, double *reciprocal);
 
 #endif
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""A container that sums the contributions of several force fields
+
+   The force fields in molmod have different interfaces. ToyFF is a function
+   of the Cartesian coordinates, while the PairFF and EwaldFF objects
+   compute the energy and the gradient after a call to update_coordinates.
+   The CompositeFF class below combines all of these into a single function
+   that can be passed to :class:`molmod.minimizer.Minimizer`. The geometric
+   quantities needed by the PairFF terms are computed only once per call.
+"""
+
+
+from molmod.binning import NeighborList
+from molmod.pairff import PairFF, get_dense_geometry
+from molmod.units import angstrom
+
+import numpy, time
+
+
+__all__ = ["CompositeFF"]
+
+
+class CompositeFF(object):
+    """The sum of several force field terms
+
+       Example::
+
+           ff = CompositeFF([toyff, coulombff, dispersionff], ["toy", "ei", "disp"])
+           minimizer = Minimizer(x_init, ff, ...)
+           print ff.energies, ff.timings
+
+       After each call, the attribute ``energies`` contains the energy of each
+       term and ``timings`` the wall time spent in each term, both in the same
+       order as the terms. The time spent on the shared geometry is stored in
+       ``geometry_timing``.
+    """
+
+    def __init__(self, terms, names=None, skin=0.5*angstrom, workers=1):
+        """
+           Argument:
+            | ``terms``  --  A list of force field terms. Each term is either
+                             a PairFF or EwaldFF instance, or a function like
+                             ToyFF with the signature ``f(x, do_gradient)``.
+
+           Optional arguments:
+            | ``names``  --  A list of names for the terms. [default is the
+                             class name of each term]
+            | ``skin``  --  The skin of the neighbor list that is shared by
+                            the PairFF terms with a cutoff. [default=0.5*angstrom]
+            | ``workers``  --  The number of threads used for the pair search.
+                               [default=1]
+
+           All PairFF terms with a cutoff must have the same unit cell. The
+           shared neighbor list uses the largest cutoff.
+        """
+        if names is None:
+            names = [term.__class__.__name__ for term in terms]
+        elif len(names) != len(terms):
+            raise TypeError("The number of names does not match the number of terms.")
+        self.terms = list(terms)
+        self.names = list(names)
+        cutoff_terms = [
+            term for term in terms
+            if isinstance(term, PairFF) and term.cutoff is not None
+        ]
+        if len(cutoff_terms) > 0:
+            unit_cell = cutoff_terms[0].unit_cell
+            for term in cutoff_terms[1:]:
+                if (term.unit_cell is None) != (unit_cell is None) or \
+                   (unit_cell is not None and (term.unit_cell.matrix != unit_cell.matrix).any()):
+                    raise ValueError("All PairFF terms with a cutoff must have the same unit cell.")
+            cutoff = max(term.cutoff for term in cutoff_terms)
+            self.neighbor_list = NeighborList(cutoff, skin, unit_cell, workers=workers)
+        else:
+            self.neighbor_list = None
+        self.energies = [0.0]*len(terms)
+        self.timings = [0.0]*len(terms)
+        self.geometry_timing = 0.0
+
+    def __call__(self, x, do_gradient=False):
+        """Compute the energy (and gradient) for a set of Cartesian coordinates
+
+           Argument:
+            | ``x``  --  the Cartesian coordinates
+            | ``do_gradient``  --  when set to True, the gradient is also
+                                   computed and returned. [default=False]
+        """
+        coordinates = x.reshape((-1, 3))
+        gradient = numpy.zeros(coordinates.shape, float)
+
+        # shared geometric quantities
+        start = time.time()
+        dense_geometry = None
+        pairs = None
+        for term in self.terms:
+            if isinstance(term, PairFF):
+                if term.cutoff is None:
+                    if dense_geometry is None:
+                        dense_geometry = get_dense_geometry(coordinates)
+                elif pairs is None:
+                    self.neighbor_list.update(coordinates)
+                    pairs = self.neighbor_list.get_arrays()
+        self.geometry_timing = time.time() - start
+
+        result = 0.0
+        for index, term in enumerate(self.terms):
+            start = time.time()
+            if isinstance(term, PairFF):
+                if term.cutoff is None:
+                    term.update_coordinates(coordinates, dense_geometry)
+                else:
+                    term.update_coordinates(coordinates, pairs)
+                energy = term.energy()
+                if do_gradient:
+                    gradient += term.gradient()
+            elif hasattr(term, "update_coordinates"):
+                term.update_coordinates(coordinates)
+                energy = term.energy()
+                if do_gradient:
+                    gradient += term.gradient()
+            elif do_gradient:
+                energy, term_gradient = term(x, True)
+                gradient += term_gradient.reshape(gradient.shape)
+            else:
+                energy = term(x)
+            self.timings[index] = time.time() - start
+            self.energies[index] = energy
+            result += energy
+
+        if do_gradient:
+            return result, gradient.ravel()
+        else:
+            return result
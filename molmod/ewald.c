@@ -0,0 +1,205 @@
+// MolMod is a collection of molecular modelling tools for python.
+// Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+// for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+// reserved unless otherwise stated.
+//
+// This file is part of MolMod.
+//
+// MolMod is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// MolMod is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+
+
+#include <math.h>
+
+
+double ewald_real(
+  int npair, int *pairs, double *deltas, double *distances, double *charges,
+  double alpha, double *gradient
+) {
+  /* The real-space part of the Ewald sum for a list of pairs. The relative
+     vectors are r_j - r_i for a pair (i, j). Returns the energy and adds the
+     gradient to the last argument. */
+  int k, i, j, c;
+  double energy, d, qq, e, f;
+
+  energy = 0.0;
+  for (k = 0; k < npair; k++) {
+    i = pairs[2*k];
+    j = pairs[2*k+1];
+    d = distances[k];
+    qq = charges[i]*charges[j];
+    e = qq*erfc(alpha*d)/d;
+    energy += e;
+    /* f = derivative of the pair energy towards the distance, divided by the
+       distance */
+    f = -(e + qq*M_2_SQRTPI*alpha*exp(-alpha*alpha*d*d))/(d*d);
+    for (c = 0; c < 3; c++) {
+      gradient[3*i+c] -= f*deltas[3*k+c];
+      gradient[3*j+c] += f*deltas[3*k+c];
+    }
+  }
+  return energy;
+}
+
+
+double ewald_reci(
+  int n, double *cor, double *charges, int ng, double *gvecs, double *coeffs,
+  double *gradient
+) {
+  /* The reciprocal-space part of the Ewald sum. Each wave vector represents
+     itself and its inverse, i.e. coeffs must include the corresponding factor
+     two. Returns the energy and adds the gradient to the last argument. */
+  int g, i, c;
+  double energy, *g_vec, phase, re, im, f;
+
+  energy = 0.0;
+  for (g = 0; g < ng; g++) {
+    g_vec = gvecs + 3*g;
+    /* the structure factor */
+    re = 0.0;
+    im = 0.0;
+    for (i = 0; i < n; i++) {
+      phase = g_vec[0]*cor[3*i] + g_vec[1]*cor[3*i+1] + g_vec[2]*cor[3*i+2];
+      re += charges[i]*cos(phase);
+      im += charges[i]*sin(phase);
+    }
+    energy += coeffs[g]*(re*re + im*im);
+    for (i = 0; i < n; i++) {
+      phase = g_vec[0]*cor[3*i] + g_vec[1]*cor[3*i+1] + g_vec[2]*cor[3*i+2];
+      f = 2*coeffs[g]*charges[i]*(im*cos(phase) - re*sin(phase));
+      for (c = 0; c < 3; c++) {
+        gradient[3*i+c] += f*g_vec[c];
+      }
+    }
+  }
+  return energy;
+}
+
+
+void pme_bspline(double w, int order, double *values, double *derivs) {
+  /* The cardinal B-spline of the given order, M_order, and its derivative,
+     evaluated in w+j for j=0..order-1, with w in [0,1[. */
+  int k, j;
+
+  /* M_2(w) = w and M_2(w+1) = 1-w */
+  values[0] = w;
+  values[1] = 1.0 - w;
+  if (order == 2) {
+    derivs[0] = 1.0;
+    derivs[1] = -1.0;
+    return;
+  }
+  for (k = 2; k < order; k++) {
+    if (k == order-1) {
+      /* M'_order(u) = M_{order-1}(u) - M_{order-1}(u-1) */
+      derivs[0] = values[0];
+      for (j = 1; j < k; j++) derivs[j] = values[j] - values[j-1];
+      derivs[k] = -values[k-1];
+    }
+    /* M_{k+1}(u) = (u*M_k(u) + (k+1-u)*M_k(u-1))/k, with u = w+j */
+    values[k] = (1.0-w)*values[k-1]/k;
+    for (j = k-1; j > 0; j--) {
+      values[j] = ((w+j)*values[j] + (k+1-w-j)*values[j-1])/k;
+    }
+    values[0] = w*values[0]/k;
+  }
+}
+
+
+void pme_setup_atom(
+  double *frac, int order, int *shape, int *start, double *values,
+  double *derivs
+) {
+  /* Compute the B-spline weights of an atom along the three axes. The grid
+     point of weight j along axis c is start[c]-j (modulo the grid size). */
+  int c;
+  double u, w;
+
+  for (c = 0; c < 3; c++) {
+    u = frac[c]*shape[c];
+    w = floor(u);
+    start[c] = (int)w;
+    pme_bspline(u - w, order, values + order*c, derivs + order*c);
+  }
+}
+
+
+int pme_wrap(int k, int size) {
+  k %= size;
+  if (k < 0) k += size;
+  return k;
+}
+
+
+void pme_spread(
+  int n, double *frac, double *charges, int order, int *shape, double *grid
+) {
+  /* Spread the charges on the grid with B-splines */
+  int i, j0, j1, j2, k0, k1, k2, start[3];
+  double values[3*32], derivs[3*32], w0, w01;
+
+  for (i = 0; i < n; i++) {
+    pme_setup_atom(frac + 3*i, order, shape, start, values, derivs);
+    for (j0 = 0; j0 < order; j0++) {
+      k0 = pme_wrap(start[0] - j0, shape[0]);
+      w0 = charges[i]*values[j0];
+      for (j1 = 0; j1 < order; j1++) {
+        k1 = pme_wrap(start[1] - j1, shape[1]);
+        w01 = w0*values[order + j1];
+        for (j2 = 0; j2 < order; j2++) {
+          k2 = pme_wrap(start[2] - j2, shape[2]);
+          grid[(k0*shape[1] + k1)*shape[2] + k2] += w01*values[2*order + j2];
+        }
+      }
+    }
+  }
+}
+
+
+void pme_gradient(
+  int n, double *frac, double *charges, int order, int *shape, double *potential,
+  double *gradient
+) {
+  /* Interpolate the derivatives of the energy towards the scaled fractional
+     coordinates from the potential on the grid (derivative of the energy
+     towards the grid values). */
+  int i, j0, j1, j2, k0, k1, k2, start[3];
+  double values[3*32], derivs[3*32], p, g[3];
+
+  for (i = 0; i < n; i++) {
+    pme_setup_atom(frac + 3*i, order, shape, start, values, derivs);
+    g[0] = 0.0;
+    g[1] = 0.0;
+    g[2] = 0.0;
+    for (j0 = 0; j0 < order; j0++) {
+      k0 = pme_wrap(start[0] - j0, shape[0]);
+      for (j1 = 0; j1 < order; j1++) {
+        k1 = pme_wrap(start[1] - j1, shape[1]);
+        for (j2 = 0; j2 < order; j2++) {
+          k2 = pme_wrap(start[2] - j2, shape[2]);
+          p = potential[(k0*shape[1] + k1)*shape[2] + k2];
+          g[0] += p*derivs[j0]*values[order + j1]*values[2*order + j2];
+          g[1] += p*values[j0]*derivs[order + j1]*values[2*order + j2];
+          g[2] += p*values[j0]*values[order + j1]*derivs[2*order + j2];
+        }
+      }
+    }
+    gradient[3*i] += charges[i]*g[0];
+    gradient[3*i+1] += charges[i]*g[1];
+    gradient[3*i+2] += charges[i]*g[2];
+  }
+}
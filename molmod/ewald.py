@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Electrostatic interactions of point charges in periodic systems
+
+   The Coulomb energy of a periodic system is computed with the Ewald
+   summation: the sum over all pairs and their periodic images is split into a
+   short-ranged real-space part and a smooth reciprocal-space part. The
+   parameter ``alpha`` controls the split. Two methods for the reciprocal part
+   are available:
+
+   * :class:`EwaldFF`: an explicit sum over all wave vectors below a cutoff.
+     This is accurate but becomes expensive for large cells.
+   * :class:`PMEFF`: the smooth particle-mesh Ewald method. The charges are
+     interpolated on a grid with B-splines and the reciprocal sum is computed
+     with fast Fourier transforms, such that the cost is O(N log N).
+
+   Example usage::
+
+       ff = PMEFF(charges, unit_cell, coordinates)
+       energy = ff.energy()
+       gradient = ff.gradient()
+
+   All quantities are in atomic units. The systems must be periodic in three
+   dimensions. When the total charge is not zero, a neutralizing background is
+   included.
+"""
+
+
+from molmod.ext import ewald_real, ewald_reci, pme_spread, pme_gradient
+from molmod.binning import PairSearchImages
+from molmod.unit_cells import UnitCell
+from molmod.units import angstrom
+
+import numpy
+
+
+__all__ = ["EwaldFF", "PMEFF"]
+
+
+class EwaldFF(object):
+    """Ewald summation for point charges
+
+       The energy has four contributions: the real-space sum over all pairs of
+       periodic images within ``rcut``, the reciprocal-space sum over all wave
+       vectors within ``gcut``, the self-interaction correction and (for
+       charged systems) the interaction with a neutralizing background.
+    """
+
+    def __init__(self, charges, unit_cell, coordinates=None, alpha=None, rcut=None, gcut=None, accuracy=1e-8):
+        """
+           Arguments:
+            | ``charges``  --  An array with N point charges
+            | ``unit_cell``  --  A three-dimensional periodic UnitCell object
+
+           Optional arguments:
+            | ``coordinates``  --  The initial Cartesian coordinates, which
+                                   can be updated with the method
+                                   update_coordinates
+            | ``alpha``  --  The Ewald splitting parameter, i.e. the inverse
+                             width of the Gaussian charge distributions
+            | ``rcut``  --  The cutoff for the real-space sum
+            | ``gcut``  --  The cutoff for the wave vectors in the
+                            reciprocal-space sum
+            | ``accuracy``  --  The relative accuracy that is used to derive
+                                the missing parameters [default=1e-8]
+
+           When alpha is not given, it is derived from rcut. When rcut is not
+           given either, alpha is chosen to balance the cost of both sums.
+        """
+        if not unit_cell.active.all():
+            raise ValueError("The unit cell must be periodic in three dimensions.")
+        self.charges = numpy.array(charges, float)
+        self.unit_cell = unit_cell
+        self.volume = unit_cell.volume
+        tail = numpy.sqrt(-numpy.log(accuracy))
+        if alpha is None:
+            if rcut is None:
+                alpha = numpy.sqrt(numpy.pi)*(len(self.charges)/self.volume**2)**(1.0/6.0)
+            else:
+                alpha = tail/rcut
+        if rcut is None:
+            rcut = tail/alpha
+        if gcut is None:
+            gcut = 2*alpha*tail
+        self.alpha = alpha
+        self.rcut = rcut
+        self.gcut = gcut
+        self.accuracy = accuracy
+        if coordinates is not None:
+            self.update_coordinates(coordinates)
+
+    def update_coordinates(self, coordinates=None):
+        """Update the coordinates
+
+           Argument:
+             coordinates  --  new Cartesian coordinates of the system
+        """
+        if coordinates is not None:
+            self.coordinates = coordinates
+        self._energy = None
+        self._gradient = None
+
+    def _compute_real(self, gradient):
+        """Compute the real-space part, the gradient is added to the argument"""
+        i0, i1, images, deltas, distances = PairSearchImages(
+            self.coordinates, self.rcut, self.unit_cell
+        ).get_arrays()
+        if len(i0) == 0:
+            return 0.0
+        pairs = numpy.array([i0, i1], numpy.int32).transpose()
+        return ewald_real(pairs, deltas, distances, self.charges, self.alpha, gradient.ravel())
+
+    def _get_wave_vectors(self):
+        """Return the wave vectors and the corresponding prefactors"""
+        reciprocal = 2*numpy.pi*self.unit_cell.reciprocal
+        indexes = UnitCell(reciprocal).get_radius_indexes(self.gcut)
+        # Only keep one of each pair of opposite wave vectors.
+        signs = numpy.sign(indexes)
+        first = signs[:,0] + (signs[:,0] == 0)*(signs[:,1] + (signs[:,1] == 0)*signs[:,2])
+        indexes = indexes[first > 0]
+        gvecs = numpy.dot(indexes, reciprocal.transpose())
+        gsq = (gvecs**2).sum(axis=1)
+        mask = gsq <= self.gcut**2
+        gvecs = gvecs[mask]
+        gsq = gsq[mask]
+        coeffs = 4*numpy.pi/self.volume*numpy.exp(-0.25*gsq/self.alpha**2)/gsq
+        return gvecs, coeffs
+
+    def _compute_reci(self, gradient):
+        """Compute the reciprocal-space part, the gradient is added to the argument"""
+        if not hasattr(self, "_wave_vectors"):
+            self._wave_vectors = self._get_wave_vectors()
+        gvecs, coeffs = self._wave_vectors
+        return ewald_reci(self.coordinates, self.charges, gvecs, coeffs, gradient)
+
+    def _compute(self):
+        """Compute the energy and the gradient"""
+        gradient = numpy.zeros((len(self.charges), 3), float)
+        energy = self._compute_real(gradient)
+        energy += self._compute_reci(gradient)
+        # the self-interaction
+        energy -= self.alpha/numpy.sqrt(numpy.pi)*(self.charges**2).sum()
+        # the neutralizing background
+        energy -= 0.5*numpy.pi/self.volume/self.alpha**2*self.charges.sum()**2
+        self._energy = energy
+        self._gradient = gradient
+
+    def energy(self):
+        """Compute the electrostatic energy of the system"""
+        if self._energy is None:
+            self._compute()
+        return self._energy
+
+    def gradient(self):
+        """Compute the gradient of the energy for all atoms"""
+        if self._gradient is None:
+            self._compute()
+        return self._gradient.copy()
+
+    def gradient_flat(self):
+        """Return the gradient a 3N array"""
+        return self.gradient().ravel()
+
+
+def _get_bspline_integers(order):
+    """Return the cardinal B-spline of the given order in 0, 1, ..., order-1"""
+    values = numpy.array([0.0, 1.0])
+    for k in xrange(2, order):
+        # M_{k+1}(j) = (j*M_k(j) + (k+1-j)*M_k(j-1))/k
+        j = numpy.arange(k+1)
+        previous = numpy.concatenate([values, [0.0]])
+        shifted = numpy.concatenate([[0.0], values])
+        values = (j*previous + (k+1-j)*shifted)/k
+    return values
+
+
+def _get_fft_size(size):
+    """Return the smallest integer not below size without prime factors above 5"""
+    while True:
+        rest = size
+        for factor in 2, 3, 5:
+            while rest % factor == 0:
+                rest /= factor
+        if rest == 1:
+            return size
+        size += 1
+
+
+class PMEFF(EwaldFF):
+    """Smooth particle-mesh Ewald summation for point charges
+
+       The real-space part and the corrections are the same as in
+       :class:`EwaldFF`. The reciprocal-space part is computed by spreading the
+       charges on a regular grid with cardinal B-splines. The convolution with
+       the Ewald kernel is carried out with fast Fourier transforms. (Essmann et
+       al., J. Chem. Phys. 103, 8577 (1995))
+    """
+
+    def __init__(self, charges, unit_cell, coordinates=None, alpha=None, rcut=9*angstrom, shape=None, spacing=0.5*angstrom, order=6, accuracy=1e-8):
+        """
+           Arguments:
+            | ``charges``  --  An array with N point charges
+            | ``unit_cell``  --  A three-dimensional periodic UnitCell object
+
+           Optional arguments:
+            | ``coordinates``  --  The initial Cartesian coordinates, which
+                                   can be updated with the method
+                                   update_coordinates
+            | ``alpha``  --  The Ewald splitting parameter [default derived
+                             from rcut and accuracy]
+            | ``rcut``  --  The cutoff for the real-space sum
+                            [default=9*angstrom]
+            | ``shape``  --  The number of grid points along each cell vector
+            | ``spacing``  --  The approximate distance between grid points,
+                               only used when shape is not given
+                               [default=0.5*angstrom]
+            | ``order``  --  The order of the B-splines [default=6]
+            | ``accuracy``  --  The relative accuracy of the real-space sum
+                                [default=1e-8]
+        """
+        if order < 3 or order > 32:
+            raise ValueError("The order of the B-splines must be in the range [3,32].")
+        EwaldFF.__init__(self, charges, unit_cell, None, alpha, rcut, None, accuracy)
+        if shape is None:
+            lengths = numpy.sqrt((unit_cell.matrix**2).sum(axis=0))
+            shape = [_get_fft_size(max(order, int(numpy.ceil(l/spacing)))) for l in lengths]
+        self.shape = numpy.array(shape, numpy.int32)
+        if (self.shape < order).any():
+            raise ValueError("The grid must have at least order points in each direction.")
+        self.order = order
+        self._kernel = self._get_kernel()
+        if coordinates is not None:
+            self.update_coordinates(coordinates)
+
+    def _get_kernel(self):
+        """Compute the Ewald kernel in reciprocal space, including the B-spline factors"""
+        # the influence of the B-spline interpolation
+        splines = _get_bspline_integers(self.order)[1:]
+        factors = []
+        for size in self.shape:
+            m = numpy.arange(size)
+            k = numpy.arange(self.order-1)
+            denominator = abs((splines*numpy.exp(2j*numpy.pi*numpy.outer(m, k)/size)).sum(axis=1))**2
+            # For odd orders, the denominator is zero at m=size/2.
+            factor = numpy.zeros(size, float)
+            mask = denominator > 1e-10
+            factor[mask] = 1/denominator[mask]
+            factors.append(factor)
+        bsplines = factors[0].reshape(-1, 1, 1)*factors[1].reshape(1, -1, 1)*factors[2]
+        # the Gaussian screening, m are the reciprocal vectors without 2*pi
+        m = [numpy.fft.fftfreq(size)*size for size in self.shape]
+        mvecs = (
+            m[0].reshape(-1, 1, 1, 1)*self.unit_cell.reciprocal[:,0] +
+            m[1].reshape(1, -1, 1, 1)*self.unit_cell.reciprocal[:,1] +
+            m[2].reshape(1, 1, -1, 1)*self.unit_cell.reciprocal[:,2]
+        )
+        msq = (mvecs**2).sum(axis=3)
+        msq[0, 0, 0] = 1.0
+        kernel = numpy.exp(-(numpy.pi/self.alpha)**2*msq)/msq/(numpy.pi*self.volume)
+        kernel[0, 0, 0] = 0.0
+        return kernel*bsplines
+
+    def _compute_reci(self, gradient):
+        """Compute the reciprocal-space part, the gradient is added to the argument"""
+        fractional = self.unit_cell.to_fractional(self.coordinates)
+        grid = numpy.zeros(self.shape, float)
+        pme_spread(fractional, self.charges, self.order, self.shape, grid.ravel())
+        # the derivative of the energy towards the grid values
+        potential = numpy.fft.ifftn(self._kernel*numpy.fft.fftn(grid)).real*grid.size
+        energy = 0.5*(grid*potential).sum()
+        # the derivatives towards the scaled fractional coordinates
+        scaled_gradient = numpy.zeros(gradient.shape, float)
+        pme_gradient(fractional, self.charges, self.order, self.shape, potential.ravel(), scaled_gradient)
+        gradient += numpy.dot(scaled_gradient*self.shape, self.unit_cell.reciprocal.transpose())
+        return energy
@@ -37,125 +37,556 @@ inline void add_grad(
   gradient[j*3+2] -= s*delta[2];
 }
 
-double ff_dm_quad(
+inline void set_hess(double s, double t, double *delta, double *block) {
+  // block = s*I + t*delta*delta^T, the second derivative of a pair term
+  // E(d) towards the first atom, with s = E'/d and t = (E'' - E'/d)/d^2.
+  int k, l;
+  for (k=0; k<3; k++) {
+    for (l=0; l<3; l++) {
+      block[3*k+l] = t*delta[k]*delta[l];
+    }
+    block[4*k] += s;
+  }
+}
+
+inline void clear_hess(double *block) {
+  int k;
+  for (k=0; k<9; k++) block[k] = 0.0;
+}
+
+static double *get_local_gradient(int n, double *gradient, int serial) {
+  // With OpenMP, each thread accumulates the gradient in its own buffer to
+  // avoid race conditions. Without OpenMP, or when the kernel is called
+  // serially, the gradient is used directly.
+  if ((gradient==NULL) || serial) return gradient;
+#ifdef _OPENMP
+  return calloc(3*n, sizeof(double));
+#else
+  return gradient;
+#endif
+}
+
+static void merge_local_gradient(int n, double *local, double *gradient) {
+#ifdef _OPENMP
+  int k;
+  if (local==gradient) return;
+  #pragma omp critical (ff_merge_gradient)
+  {
+    for (k=0; k<3*n; k++) gradient[k] += local[k];
+  }
+  free(local);
+#endif
+}
+
+static int *get_row_offsets(int n, double *dm0, int *dm0_int, int threshold) {
+  // The Hessian blocks of the dm terms are stored in the order of the serial
+  // double loop. The position of the first block of each row is computed in
+  // advance, such that the rows can be processed in parallel.
+  int i, j, p, *offsets;
+  offsets = malloc(n*sizeof(int));
+  p = 0;
+  for (i=0; i<n; i++) {
+    offsets[i] = p;
+    for (j=0; j<i; j++) {
+      if ((dm0==NULL) ? (dm0_int[i*n+j]>threshold) : (dm0[i*n+j]>threshold)) p++;
+    }
+  }
+  return offsets;
+}
+
+static double dm_quad(
   int n, int periodic, double *cor, double *dm0, double *dmk,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal, int serial
 ) {
-  int i,j;
-  double delta[3], d, d0, k, tmp, result;
+  // The static kernels start no parallel region when serial is nonzero and
+  // then update the gradient in place. This is used by ff_toyff_batch, which
+  // processes several structures in parallel. The public ff_* functions
+  // below each kernel run in parallel.
+  int i, j, p, *offsets;
+  double result;
 
+  offsets = (nhess>0) ? get_row_offsets(n, dm0, NULL, 0) : NULL;
   result = 0.0;
-  //printf("n=%i\n", n);
-  for (i=0; i<n; i++) {
-    for (j=0; j<i; j++) {
-      d0 = dm0[i*n+j];
-      k = dmk[i*n+j];
-      //printf("i=%i  j=%i  d0=%i\n", i,j,d0);
-      if (d0>0) {
-        if (periodic) {
-          d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
-        } else {
-          d = distance_delta(cor + 3*i, cor + 3*j, delta);
-        }
-        tmp = (d-d0);
-        result += amp*k*tmp*tmp;
-        if (gradient!=NULL) {
-          //tmp = 2*amp*tmp/d0*radii[i]*radii[j]/d;
+  #pragma omp parallel private(i, j, p) reduction(+:result) if(!serial)
+  {
+    double delta[3], d, d0, k, tmp, *local;
+    local = get_local_gradient(n, gradient, serial);
+    p = 0;
+    #pragma omp for schedule(dynamic, 16)
+    for (i=0; i<n; i++) {
+      if (nhess>0) p = offsets[i];
+      for (j=0; j<i; j++) {
+        d0 = dm0[i*n+j];
+        k = dmk[i*n+j];
+        if (d0>0) {
+          if (periodic) {
+            d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+          } else {
+            d = distance_delta(cor + 3*i, cor + 3*j, delta);
+          }
+          tmp = (d-d0);
+          result += amp*k*tmp*tmp;
           tmp = 2*amp*k*tmp/d;
-          add_grad(i, j, tmp, cor, delta, gradient);
+          if (local!=NULL) {
+            add_grad(i, j, tmp, cor, delta, local);
+          }
+          if (nhess>0) {
+            set_hess(tmp, (2*amp*k - tmp)/(d*d), delta, hessian + 9*p);
+            p++;
+          }
         }
-        //result += tmp*tmp;
       }
     }
+    merge_local_gradient(n, local, gradient);
   }
-  //printf("result=%f\n", result);
+  free(offsets);
   return result;
 }
 
+double ff_dm_quad(
+  int n, int periodic, double *cor, double *dm0, double *dmk,
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal
+) {
+  return dm_quad(n, periodic, cor, dm0, dmk, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
 
-double ff_dm_reci(
+
+static double dm_reci(
   int n, int periodic, double *cor, double *radii, int *dm0,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal, int serial
 ) {
-  int i, j;
-  double delta[3], d, r0, tmp, result;
+  int i, j, p, *offsets;
+  double result;
 
+  offsets = (nhess>0) ? get_row_offsets(n, NULL, dm0, 1) : NULL;
   result = 0.0;
-  for (i=0; i<n; i++) {
-    for (j=0; j<i; j++) {
-      if (dm0[i*n+j]>1) {
-        if (periodic) {
-          d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
-        } else {
-          d = distance_delta(cor + 3*i, cor + 3*j, delta);
-        }
-        r0 = radii[i]+radii[j];
-        if (d < r0) {
+  #pragma omp parallel private(i, j, p) reduction(+:result) if(!serial)
+  {
+    double delta[3], d, r0, tmp, *local;
+    local = get_local_gradient(n, gradient, serial);
+    p = 0;
+    #pragma omp for schedule(dynamic, 16)
+    for (i=0; i<n; i++) {
+      if (nhess>0) p = offsets[i];
+      for (j=0; j<i; j++) {
+        if (dm0[i*n+j]>1) {
+          if (periodic) {
+            d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+          } else {
+            d = distance_delta(cor + 3*i, cor + 3*j, delta);
+          }
+          r0 = radii[i]+radii[j];
+          if (d < r0) {
             d /= r0;
             result += amp*(d-1)*(d-1)/d;
-            if (gradient!=NULL) {
-              tmp = amp*(1-1/d/d)/r0/d/r0;
-              add_grad(i, j, tmp, cor, delta, gradient);
+            tmp = amp*(1-1/d/d)/r0/d/r0;
+            if (local!=NULL) {
+              add_grad(i, j, tmp, cor, delta, local);
             }
+            if (nhess>0) {
+              set_hess(tmp, (2*amp/(d*d*d*r0*r0) - tmp)/(d*d*r0*r0), delta, hessian + 9*p);
+            }
+          } else if (nhess>0) {
+            clear_hess(hessian + 9*p);
+          }
+          p++;
         }
       }
     }
+    merge_local_gradient(n, local, gradient);
   }
+  free(offsets);
   return result;
 }
 
+double ff_dm_reci(
+  int n, int periodic, double *cor, double *radii, int *dm0,
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal
+) {
+  return dm_reci(n, periodic, cor, radii, dm0, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
 
-double ff_bond_quad(
+
+static double dm_quad_pairs(
   int m, int n, int periodic, double *cor, int *pairs, double *lengths,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  double *ks, double amp, double *gradient, int nhess, double *hessian,
+  double *matrix, double *reciprocal, int serial
 ) {
-  int b, i, j;
-  double delta[3], result, d, tmp;
+  int b;
+  double result;
 
   result = 0.0;
-  for (b=0; b<m; b++) {
-    i = pairs[2*b  ];
-    j = pairs[2*b+1];
-    if (periodic) {
-      d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
-    } else {
-      d = distance_delta(cor + 3*i, cor + 3*j, delta);
-    }
-
-    tmp = d-lengths[b];
-    result += amp*tmp*tmp;
-    if (gradient!=NULL) {
-      tmp = 2*amp*tmp/d;
-      add_grad(i, j, tmp, cor, delta, gradient);
+  #pragma omp parallel private(b) reduction(+:result) if(!serial)
+  {
+    int i, j;
+    double delta[3], d, tmp, *local;
+    local = get_local_gradient(n, gradient, serial);
+    #pragma omp for
+    for (b=0; b<m; b++) {
+      i = pairs[2*b  ];
+      j = pairs[2*b+1];
+      if (periodic) {
+        d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      } else {
+        d = distance_delta(cor + 3*i, cor + 3*j, delta);
+      }
+      tmp = d-lengths[b];
+      result += amp*ks[b]*tmp*tmp;
+      tmp = 2*amp*ks[b]*tmp/d;
+      if (local!=NULL) {
+        add_grad(i, j, tmp, cor, delta, local);
+      }
+      if (nhess>0) {
+        set_hess(tmp, (2*amp*ks[b] - tmp)/(d*d), delta, hessian + 9*b);
+      }
     }
-    //printf("result=%f\n", result);
+    merge_local_gradient(n, local, gradient);
   }
   return result;
 }
 
-double ff_bond_hyper(
+double ff_dm_quad_pairs(
+  int m, int n, int periodic, double *cor, int *pairs, double *lengths,
+  double *ks, double amp, double *gradient, int nhess, double *hessian,
+  double *matrix, double *reciprocal
+) {
+  return dm_quad_pairs(m, n, periodic, cor, pairs, lengths, ks, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
+
+
+static double dm_reci_pairs(
+  int m, int n, int periodic, double *cor, int *pairs, double *radii,
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal, int serial
+) {
+  int b;
+  double result;
+
+  result = 0.0;
+  #pragma omp parallel private(b) reduction(+:result) if(!serial)
+  {
+    int i, j;
+    double delta[3], d, r0, tmp, *local;
+    local = get_local_gradient(n, gradient, serial);
+    #pragma omp for
+    for (b=0; b<m; b++) {
+      i = pairs[2*b  ];
+      j = pairs[2*b+1];
+      if (periodic) {
+        d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      } else {
+        d = distance_delta(cor + 3*i, cor + 3*j, delta);
+      }
+      r0 = radii[i]+radii[j];
+      if (d < r0) {
+        d /= r0;
+        result += amp*(d-1)*(d-1)/d;
+        tmp = amp*(1-1/d/d)/r0/d/r0;
+        if (local!=NULL) {
+          add_grad(i, j, tmp, cor, delta, local);
+        }
+        if (nhess>0) {
+          set_hess(tmp, (2*amp/(d*d*d*r0*r0) - tmp)/(d*d*r0*r0), delta, hessian + 9*b);
+        }
+      } else if (nhess>0) {
+        clear_hess(hessian + 9*b);
+      }
+    }
+    merge_local_gradient(n, local, gradient);
+  }
+  return result;
+}
+
+double ff_dm_reci_pairs(
+  int m, int n, int periodic, double *cor, int *pairs, double *radii,
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal
+) {
+  return dm_reci_pairs(m, n, periodic, cor, pairs, radii, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
+
+
+static double bond_quad(
   int m, int n, int periodic, double *cor, int *pairs, double *lengths,
-  double scale, double amp, double *gradient, double *matrix, double *reciprocal
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal, int serial
 ) {
-  int b, i, j;
-  double delta[3], result, d, tmp;
+  int b;
+  double result;
 
   result = 0.0;
-  for (b=0; b<m; b++) {
-    i = pairs[2*b  ];
-    j = pairs[2*b+1];
-    if (periodic) {
-      d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
-    } else {
-      d = distance_delta(cor + 3*i, cor + 3*j, delta);
+  #pragma omp parallel private(b) reduction(+:result) if(!serial)
+  {
+    int i, j;
+    double delta[3], d, tmp, *local;
+    local = get_local_gradient(n, gradient, serial);
+    #pragma omp for
+    for (b=0; b<m; b++) {
+      i = pairs[2*b  ];
+      j = pairs[2*b+1];
+      if (periodic) {
+        d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      } else {
+        d = distance_delta(cor + 3*i, cor + 3*j, delta);
+      }
+      tmp = d-lengths[b];
+      result += amp*tmp*tmp;
+      tmp = 2*amp*tmp/d;
+      if (local!=NULL) {
+        add_grad(i, j, tmp, cor, delta, local);
+      }
+      if (nhess>0) {
+        set_hess(tmp, (2*amp - tmp)/(d*d), delta, hessian + 9*b);
+      }
     }
+    merge_local_gradient(n, local, gradient);
+  }
+  return result;
+}
+
+double ff_bond_quad(
+  int m, int n, int periodic, double *cor, int *pairs, double *lengths,
+  double amp, double *gradient, int nhess, double *hessian, double *matrix,
+  double *reciprocal
+) {
+  return bond_quad(m, n, periodic, cor, pairs, lengths, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
+
+static double bond_hyper(
+  int m, int n, int periodic, double *cor, int *pairs, double *lengths,
+  double scale, double amp, double *gradient, int nhess, double *hessian,
+  double *matrix, double *reciprocal, int serial
+) {
+  int b;
+  double result;
 
-    tmp = d-lengths[b];
-    result += amp*(cosh(scale*tmp)-1);
-    if (gradient!=NULL) {
-      tmp = amp*scale*sinh(scale*tmp)/d;
-      add_grad(i, j, tmp, cor, delta, gradient);
+  result = 0.0;
+  #pragma omp parallel private(b) reduction(+:result) if(!serial)
+  {
+    int i, j;
+    double delta[3], d, tmp, slope, *local;
+    local = get_local_gradient(n, gradient, serial);
+    #pragma omp for
+    for (b=0; b<m; b++) {
+      i = pairs[2*b  ];
+      j = pairs[2*b+1];
+      if (periodic) {
+        d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      } else {
+        d = distance_delta(cor + 3*i, cor + 3*j, delta);
+      }
+      tmp = d-lengths[b];
+      result += amp*(cosh(scale*tmp)-1);
+      slope = amp*scale*sinh(scale*tmp)/d;
+      if (local!=NULL) {
+        add_grad(i, j, slope, cor, delta, local);
+      }
+      if (nhess>0) {
+        set_hess(slope, (amp*scale*scale*cosh(scale*tmp) - slope)/(d*d), delta, hessian + 9*b);
+      }
     }
+    merge_local_gradient(n, local, gradient);
   }
   return result;
 }
+
+double ff_bond_hyper(
+  int m, int n, int periodic, double *cor, int *pairs, double *lengths,
+  double scale, double amp, double *gradient, int nhess, double *hessian,
+  double *matrix, double *reciprocal
+) {
+  return bond_hyper(m, n, periodic, cor, pairs, lengths, scale, amp, gradient, nhess, hessian, matrix, reciprocal, 0);
+}
+
+
+void ff_esp_grid(
+  int n, double *cor, int has_charges, double *charges, int has_dipoles,
+  double *dipoles, int m, double *points, double *esp
+) {
+  int i, j;
+  double dx, dy, dz, d_2, d_1, result;
+
+  #pragma omp parallel for private(i, dx, dy, dz, d_2, d_1, result)
+  for (j=0; j<m; j++) {
+    result = 0.0;
+    for (i=0; i<n; i++) {
+      dx = points[3*j  ] - cor[3*i  ];
+      dy = points[3*j+1] - cor[3*i+1];
+      dz = points[3*j+2] - cor[3*i+2];
+      d_2 = 1.0/(dx*dx + dy*dy + dz*dz);
+      d_1 = sqrt(d_2);
+      if (has_charges) {
+        result += charges[i]*d_1;
+      }
+      if (has_dipoles) {
+        result += (dipoles[3*i]*dx + dipoles[3*i+1]*dy + dipoles[3*i+2]*dz)*d_1*d_2;
+      }
+    }
+    esp[j] = result;
+  }
+}
+
+
+void ff_efield_grid(
+  int n, double *cor, int has_charges, double *charges, int has_dipoles,
+  double *dipoles, int m, double *points, double *efield
+) {
+  int i, j;
+  double dx, dy, dz, d_2, d_3, px, py, pz, tmp, fx, fy, fz;
+
+  #pragma omp parallel for private(i, dx, dy, dz, d_2, d_3, px, py, pz, tmp, fx, fy, fz)
+  for (j=0; j<m; j++) {
+    fx = 0.0;
+    fy = 0.0;
+    fz = 0.0;
+    for (i=0; i<n; i++) {
+      dx = points[3*j  ] - cor[3*i  ];
+      dy = points[3*j+1] - cor[3*i+1];
+      dz = points[3*j+2] - cor[3*i+2];
+      d_2 = 1.0/(dx*dx + dy*dy + dz*dz);
+      d_3 = d_2*sqrt(d_2);
+      if (has_charges) {
+        tmp = charges[i]*d_3;
+        fx += tmp*dx;
+        fy += tmp*dy;
+        fz += tmp*dz;
+      }
+      if (has_dipoles) {
+        px = dipoles[3*i  ];
+        py = dipoles[3*i+1];
+        pz = dipoles[3*i+2];
+        tmp = 3*(px*dx + py*dy + pz*dz)*d_2;
+        fx += (tmp*dx - px)*d_3;
+        fy += (tmp*dy - py)*d_3;
+        fz += (tmp*dz - pz)*d_3;
+      }
+    }
+    efield[3*j  ] = fx;
+    efield[3*j+1] = fy;
+    efield[3*j+2] = fz;
+  }
+}
+
+
+void ff_esp_grid_float(
+  int n, float *cor, int has_charges, float *charges, int has_dipoles,
+  float *dipoles, int m, float *points, float *esp
+) {
+  // Same as ff_esp_grid in single precision. Only the sum over the atoms is
+  // carried out in double precision, to limit the round-off errors due to
+  // cancellation of positive and negative contributions.
+  int i, j;
+  float dx, dy, dz, d_2, d_1;
+  double result;
+
+  #pragma omp parallel for private(i, dx, dy, dz, d_2, d_1, result)
+  for (j=0; j<m; j++) {
+    result = 0.0;
+    for (i=0; i<n; i++) {
+      dx = points[3*j  ] - cor[3*i  ];
+      dy = points[3*j+1] - cor[3*i+1];
+      dz = points[3*j+2] - cor[3*i+2];
+      d_2 = 1.0f/(dx*dx + dy*dy + dz*dz);
+      d_1 = sqrtf(d_2);
+      if (has_charges) {
+        result += charges[i]*d_1;
+      }
+      if (has_dipoles) {
+        result += (dipoles[3*i]*dx + dipoles[3*i+1]*dy + dipoles[3*i+2]*dz)*d_1*d_2;
+      }
+    }
+    esp[j] = result;
+  }
+}
+
+void ff_efield_grid_float(
+  int n, float *cor, int has_charges, float *charges, int has_dipoles,
+  float *dipoles, int m, float *points, float *efield
+) {
+  // Same as ff_efield_grid in single precision, see ff_esp_grid_float.
+  int i, j;
+  float dx, dy, dz, d_2, d_3, px, py, pz, tmp;
+  double fx, fy, fz;
+
+  #pragma omp parallel for private(i, dx, dy, dz, d_2, d_3, px, py, pz, tmp, fx, fy, fz)
+  for (j=0; j<m; j++) {
+    fx = 0.0;
+    fy = 0.0;
+    fz = 0.0;
+    for (i=0; i<n; i++) {
+      dx = points[3*j  ] - cor[3*i  ];
+      dy = points[3*j+1] - cor[3*i+1];
+      dz = points[3*j+2] - cor[3*i+2];
+      d_2 = 1.0f/(dx*dx + dy*dy + dz*dz);
+      d_3 = d_2*sqrtf(d_2);
+      if (has_charges) {
+        tmp = charges[i]*d_3;
+        fx += tmp*dx;
+        fy += tmp*dy;
+        fz += tmp*dz;
+      }
+      if (has_dipoles) {
+        px = dipoles[3*i  ];
+        py = dipoles[3*i+1];
+        pz = dipoles[3*i+2];
+        tmp = 3*(px*dx + py*dy + pz*dz)*d_2;
+        fx += (tmp*dx - px)*d_3;
+        fy += (tmp*dy - py)*d_3;
+        fz += (tmp*dz - pz)*d_3;
+      }
+    }
+    efield[3*j  ] = fx;
+    efield[3*j+1] = fy;
+    efield[3*j+2] = fz;
+  }
+}
+
+void ff_toyff_batch(
+  int m, int n, int periodic, double *cor, double *amps,
+  int ndm, double *dm0, double *dmk, int *dm, double *radii,
+  int nquad, int *quad_pairs, double *quad_lengths, double *quad_ks,
+  int nbond, int *bond_pairs, double *bond_lengths,
+  int nspan, int *span_pairs, double *span_lengths,
+  double *energies, double *gradients, double *matrix, double *reciprocal
+) {
+  // Evaluates all ToyFF terms for m structures with n atoms. The amplitudes
+  // are given in the order dm_quad, dm_reci, bond_quad, span_quad,
+  // bond_hyper, followed by bond_hyper_scale. The dm terms use the matrices
+  // when ndm>0 and the list of dm_quad pairs otherwise. (In the latter case
+  // the dm_reci term is not included.) The structures are processed in
+  // parallel. Each thread calls the serial kernels, which add directly to the
+  // gradient of its own structure.
+  int s;
+
+  #pragma omp parallel for schedule(dynamic)
+  for (s=0; s<m; s++) {
+    double *c, *g, e;
+    c = cor + 3*n*s;
+    g = gradients + 3*n*s;
+    e = 0.0;
+    if (amps[0] > 0) {
+      if (ndm > 0) {
+        e += dm_quad(n, periodic, c, dm0, dmk, amps[0], g, 0, NULL, matrix, reciprocal, 1);
+      } else {
+        e += dm_quad_pairs(nquad, n, periodic, c, quad_pairs, quad_lengths, quad_ks, amps[0], g, 0, NULL, matrix, reciprocal, 1);
+      }
+    }
+    if ((amps[1] != 0) && (ndm > 0)) {
+      e += dm_reci(n, periodic, c, radii, dm, amps[1], g, 0, NULL, matrix, reciprocal, 1);
+    }
+    if (amps[2] != 0) {
+      e += bond_quad(nbond, n, periodic, c, bond_pairs, bond_lengths, amps[2], g, 0, NULL, matrix, reciprocal, 1);
+    }
+    if (amps[3] != 0) {
+      e += bond_quad(nspan, n, periodic, c, span_pairs, span_lengths, amps[3], g, 0, NULL, matrix, reciprocal, 1);
+    }
+    if (amps[4] != 0) {
+      e += bond_hyper(nbond, n, periodic, c, bond_pairs, bond_lengths, amps[5], amps[4], g, 0, NULL, matrix, reciprocal, 1);
+    }
+    energies[s] = e;
+  }
+}
@@ -21,6 +21,9 @@
 //--
 
 
+#include <stdlib.h>
+
+
 void graphs_floyd_warshall(int n, int* dm) {
   int i, j, k, d_ik, d_kj, d_orig, d_new;
 
@@ -44,3 +47,160 @@ void graphs_floyd_warshall(int n, int* dm) {
     }
   }
 }
+
+
+static int bfs(int source, int *offsets, int *indexes, int max_depth, int *queue, int *depth) {
+  // Breadth-first search on a graph in the CSR format. The vertices are
+  // visited up to the given depth, or all connected vertices when max_depth
+  // is negative. Returns the number of visited vertices. Their indexes are
+  // stored in queue, in the order of the search, and their depths in depth.
+  // All elements of depth must be -1 on input. The caller must reset the
+  // visited elements to -1 afterwards, see reset_depth.
+  int begin, end, vertex, i, neighbor;
+  queue[0] = source;
+  depth[source] = 0;
+  begin = 0;
+  end = 1;
+  while (begin < end) {
+    vertex = queue[begin];
+    begin++;
+    if (depth[vertex] == max_depth) continue;
+    for (i=offsets[vertex]; i<offsets[vertex+1]; i++) {
+      neighbor = indexes[i];
+      if (depth[neighbor] < 0) {
+        depth[neighbor] = depth[vertex] + 1;
+        queue[end] = neighbor;
+        end++;
+      }
+    }
+  }
+  return end;
+}
+
+static void reset_depth(int count, int *queue, int *depth) {
+  int i;
+  for (i=0; i<count; i++) {
+    depth[queue[i]] = -1;
+  }
+}
+
+static int *new_depth(int n) {
+  int i, *depth;
+  depth = malloc(n*sizeof(int));
+  for (i=0; i<n; i++) {
+    depth[i] = -1;
+  }
+  return depth;
+}
+
+int graphs_components(int n, int *offsets, int *indexes, int *labels) {
+  // Assigns a label to each vertex, such that vertices in the same connected
+  // component have the same label. The labels are numbered in the order of
+  // the lowest vertex in each component. All labels must be -1 on input,
+  // they serve as the depth array of the search. Returns the number of
+  // components.
+  int source, count, i, result, *queue;
+  queue = malloc(n*sizeof(int));
+  result = 0;
+  for (source=0; source<n; source++) {
+    if (labels[source] >= 0) continue;
+    count = bfs(source, offsets, indexes, -1, queue, labels);
+    for (i=0; i<count; i++) {
+      labels[queue[i]] = result;
+    }
+    result++;
+  }
+  free(queue);
+  return result;
+}
+
+void graphs_bfs_distances(int n, int *offsets, int *indexes, int *dm) {
+  // Computes the all-pairs shortest path lengths with a breadth-first search
+  // from each vertex. The matrix dm must be filled with zeros on input. Pairs
+  // of vertices that are not connected keep a zero distance.
+  #pragma omp parallel
+  {
+    int source, count, i, *queue, *depth;
+    queue = malloc(n*sizeof(int));
+    depth = new_depth(n);
+    #pragma omp for schedule(dynamic, 16)
+    for (source=0; source<n; source++) {
+      count = bfs(source, offsets, indexes, -1, queue, depth);
+      for (i=0; i<count; i++) {
+        dm[(long)source*n+queue[i]] = depth[queue[i]];
+      }
+      reset_depth(count, queue, depth);
+    }
+    free(queue);
+    free(depth);
+  }
+}
+
+void graphs_bfs_eccentricities(int n, int *offsets, int *indexes, int *result) {
+  // Computes the largest distance from each vertex to any other vertex in
+  // the same connected component, without storing the distance matrix.
+  #pragma omp parallel
+  {
+    int source, count, *queue, *depth;
+    queue = malloc(n*sizeof(int));
+    depth = new_depth(n);
+    #pragma omp for schedule(dynamic, 16)
+    for (source=0; source<n; source++) {
+      count = bfs(source, offsets, indexes, -1, queue, depth);
+      result[source] = depth[queue[count-1]];
+      reset_depth(count, queue, depth);
+    }
+    free(queue);
+    free(depth);
+  }
+}
+
+void graphs_bfs_count_upto(int n, int *offsets, int *indexes, int max_depth, int *counts) {
+  // Counts for each vertex the number of vertices with a higher index within
+  // the given distance.
+  #pragma omp parallel
+  {
+    int source, count, i, *queue, *depth;
+    queue = malloc(n*sizeof(int));
+    depth = new_depth(n);
+    #pragma omp for schedule(dynamic, 16)
+    for (source=0; source<n; source++) {
+      count = bfs(source, offsets, indexes, max_depth, queue, depth);
+      counts[source] = 0;
+      for (i=1; i<count; i++) {
+        if (queue[i] > source) counts[source]++;
+      }
+      reset_depth(count, queue, depth);
+    }
+    free(queue);
+    free(depth);
+  }
+}
+
+void graphs_bfs_pairs_upto(int n, int *offsets, int *indexes, int max_depth, int *begins, int npair, int *pairs, int *distances) {
+  // Stores all pairs of vertices within the given distance, the lowest
+  // index first. The pairs of each vertex start at the position in begins,
+  // which is obtained from the cumulative sum of graphs_bfs_count_upto.
+  #pragma omp parallel
+  {
+    int source, count, i, j, *queue, *depth;
+    queue = malloc(n*sizeof(int));
+    depth = new_depth(n);
+    #pragma omp for schedule(dynamic, 16)
+    for (source=0; source<n; source++) {
+      count = bfs(source, offsets, indexes, max_depth, queue, depth);
+      j = begins[source];
+      for (i=1; i<count; i++) {
+        if (queue[i] > source) {
+          pairs[2*(long)j] = source;
+          pairs[2*(long)j+1] = queue[i];
+          distances[j] = depth[queue[i]];
+          j++;
+        }
+      }
+      reset_depth(count, queue, depth);
+    }
+    free(queue);
+    free(depth);
+  }
+}
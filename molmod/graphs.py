@@ -67,6 +67,265 @@ class GraphError(Exception):
     pass
 
 
+def _get_edge_array(edges):
+    """Check the edges and convert them into an Ex2 array
+
+       Argument:
+        | ``edges`` -- See :class:`Graph`
+
+       Each row of the result is sorted, i.e. the lowest vertex index comes
+       first. Integer arrays are checked with vectorized operations, other
+       iterables are checked edge by edge.
+    """
+    if isinstance(edges, numpy.ndarray):
+        if len(edges.shape) != 2 or edges.shape[1] != 2:
+            raise TypeError("An array with edges must have shape (E, 2).")
+        if edges.dtype.kind not in "iu":
+            raise TypeError("The edges must contain integers.")
+        if (edges[:, 0] == edges[:, 1]).any():
+            raise ValueError("A edge must contain two different values.")
+        if (edges < 0).any():
+            raise TypeError("The edges must contain positive integers.")
+        return numpy.sort(edges, axis=1).astype(numpy.int32)
+
+    tmp = []
+    for edge in edges:
+        if len(edge) != 2:
+            raise TypeError("The edges must be a iterable with 2 elements")
+        i, j = edge
+        if i == j:
+            raise ValueError("A edge must contain two different values.")
+        if not (isinstance(i, int) and isinstance(j, int)):
+            raise TypeError("The edges must contain integers.")
+        if i < 0 or j < 0:
+            raise TypeError("The edges must contain positive integers.")
+        if i < j:
+            tmp.append((i, j))
+        else:
+            tmp.append((j, i))
+    return numpy.array(tmp, numpy.int32).reshape((-1, 2))
+
+
+def _mix_hash(x):
+    """Scramble an array of 64-bit unsigned integers (splitmix64 finalizer)
+
+       Argument:
+        | ``x`` -- a numpy array with dtype uint64
+
+       The integer arithmetic wraps around, which is exactly what is needed
+       for a hash function. A new array is returned.
+    """
+    x = x ^ (x >> numpy.uint64(30))
+    x *= numpy.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> numpy.uint64(27)
+    x *= numpy.uint64(0x94d049bb133111eb)
+    x ^= x >> numpy.uint64(31)
+    return x
+
+
+def _hash_strings(strings):
+    """Convert a list of strings into an Nx2 array of 64-bit hashes
+
+       Argument:
+        | ``strings`` -- a list of strings
+
+       Only the distinct strings are hashed with SHA1. The first 128 bits of
+       the digests are used.
+    """
+    import hashlib
+    if len(strings) == 0:
+        return numpy.zeros((0, 2), numpy.uint64)
+    unique, inverse = numpy.unique(numpy.array(strings, str), return_inverse=True)
+    hashes = numpy.array([
+        numpy.frombuffer(hashlib.sha1(s).digest()[:16], numpy.uint64)
+        for s in unique
+    ])
+    return hashes[inverse]
+
+
+def _get_orbits(generators, size):
+    """Label the orbits of a permutation group
+
+       Arguments:
+        | ``generators`` -- a list of permutations (integer arrays) that
+                            generate the group
+        | ``size`` -- the number of permuted elements
+
+       Returns an array with the index of the orbit of each element. The
+       orbits are the connected components of the graph in which each element
+       is connected to its images.
+    """
+    from molmod.ext import graphs_components
+    if len(generators) == 0:
+        return numpy.arange(size, dtype=numpy.int32)
+    sources = numpy.concatenate([numpy.arange(size)]*len(generators))
+    targets = numpy.concatenate(generators)
+    mask = sources != targets
+    if not mask.any():
+        return numpy.arange(size, dtype=numpy.int32)
+    sources, targets = sources[mask], targets[mask]
+    sources, targets = numpy.concatenate([sources, targets]), numpy.concatenate([targets, sources])
+    order = sources.argsort(kind="mergesort")
+    offsets = numpy.zeros(size+1, numpy.int32)
+    offsets[1:] = numpy.bincount(sources, minlength=size).cumsum()
+    result = numpy.zeros(size, numpy.int32) - 1
+    graphs_components(offsets, targets[order].astype(numpy.int32), result)
+    return result
+
+
+class _CanonicalSearch(object):
+    """Canonical labeling of a graph with colored vertices and edges
+
+       The search follows the individualization-refinement scheme of nauty.
+       The colors are refined until the ordered partition of the vertices is
+       equitable. When some cells contain more than one vertex, each vertex of
+       the smallest cell is individualized in turn and the search continues
+       from the refined result. The leaves of this search tree are discrete
+       partitions, i.e. orderings of the vertices. The leaf that gives the
+       smallest certificate (the sorted relabeled edges) determines the
+       canonical order. Leaves with the same certificate reveal automorphisms,
+       which are used to skip subtrees that are equivalent to subtrees that
+       were already visited.
+
+       The colors are always the positions of the first vertex of each cell in
+       the ordered partition.
+    """
+
+    def __init__(self, edges, edge_codes, colors):
+        """
+           Arguments:
+            | ``edges`` -- an array (E, 2) with the edges
+            | ``edge_codes`` -- an integer array with a label for each edge
+            | ``colors`` -- the initial colors of the vertices
+
+           Once the object is created, the attribute ``colors`` contains the
+           position of each vertex in the canonical order and
+           ``certificate`` is a string that is identical for isomorphic
+           (colored) graphs.
+        """
+        self.edges = edges
+        self.edge_codes = edge_codes
+        size = len(colors)
+        # directed edges sorted by source, see get_vertex_fingerprints
+        sources = numpy.concatenate([edges[:, 0], edges[:, 1]])
+        targets = numpy.concatenate([edges[:, 1], edges[:, 0]])
+        order = sources.argsort(kind="mergesort")
+        self.targets = targets[order]
+        codes = numpy.concatenate([edge_codes, edge_codes])[order]
+        self.edge_hashes = _mix_hash(codes.astype(numpy.uint64) + numpy.uint64(0x9e3779b97f4a7c15))
+        counts = numpy.bincount(sources, minlength=size)
+        self.mask = counts > 0
+        self.begins = (counts.cumsum() - counts)[self.mask]
+
+        self.path = []
+        self.generators = []
+        self.first = None
+        self.best = None
+        self._search(numpy.array(colors), 0)
+        self.colors, self.certificate = self.best[:2]
+
+    def _refine(self, colors):
+        """Refine the colors until the partition becomes equitable"""
+        size = len(colors)
+        positions = numpy.arange(size)
+        num_cells = len(numpy.unique(colors))
+        while True:
+            work = numpy.zeros(size, numpy.uint64)
+            hashes = _mix_hash(colors.astype(numpy.uint64) + numpy.uint64(0x632be59bd9b4e019))
+            work[self.mask] = numpy.add.reduceat(_mix_hash(hashes[self.targets] ^ self.edge_hashes), self.begins)
+            # split each cell according to the neighbor hashes
+            order = numpy.lexsort([work, colors])
+            sorted_colors = colors[order]
+            sorted_work = work[order]
+            new_cell = numpy.ones(size, bool)
+            new_cell[1:] = (sorted_colors[1:] != sorted_colors[:-1]) | (sorted_work[1:] != sorted_work[:-1])
+            colors = numpy.zeros(size, int)
+            colors[order] = numpy.maximum.accumulate(positions*new_cell)
+            new_num_cells = new_cell.sum()
+            if new_num_cells == num_cells:
+                return colors
+            num_cells = new_num_cells
+
+    def _get_certificate(self, colors):
+        """Return a string with the edges relabeled by the given colors"""
+        begins = colors[self.edges[:, 0]]
+        ends = colors[self.edges[:, 1]]
+        rows = numpy.array([
+            numpy.minimum(begins, ends), numpy.maximum(begins, ends),
+            self.edge_codes
+        ]).T
+        rows = rows[numpy.lexsort(rows.T[::-1])]
+        # big endian integers sort in the same way as their bytes
+        return rows.astype(">i4").tostring()
+
+    def _search(self, colors, depth):
+        """Visit a node of the search tree
+
+           Returns None, or the depth to which the search has to backtrack
+           because the remainder of the subtree is equivalent to a subtree that
+           was already visited.
+        """
+        colors = self._refine(colors)
+        size = len(colors)
+        cell_sizes = numpy.bincount(colors, minlength=size)
+        if cell_sizes.max() == 1:
+            return self._visit_leaf(colors)
+
+        # the first smallest cell with more than one vertex
+        candidates = (cell_sizes > 1).nonzero()[0]
+        target = candidates[cell_sizes[candidates].argmin()]
+        cell = (colors == target).nonzero()[0]
+
+        self.path.append(None)
+        explored = []
+        num_generators = -1
+        for vertex in cell:
+            if len(explored) > 0:
+                if num_generators != len(self.generators):
+                    # orbits of the automorphisms that fix the current path
+                    num_generators = len(self.generators)
+                    prefix = numpy.array(self.path[:depth], int)
+                    orbits = _get_orbits([
+                        generator for generator in self.generators
+                        if (generator[prefix] == prefix).all()
+                    ], size)
+                    explored_orbits = set(orbits[explored])
+                if orbits[vertex] in explored_orbits:
+                    continue
+                explored_orbits.add(orbits[vertex])
+            explored.append(vertex)
+            self.path[depth] = vertex
+            child = colors.copy()
+            child[cell] = target+1
+            child[vertex] = target
+            jump = self._search(child, depth+1)
+            if jump is not None and jump < depth:
+                self.path.pop()
+                return jump
+        self.path.pop()
+
+    def _visit_leaf(self, colors):
+        """Compare a discrete partition with the first and the best leaf"""
+        certificate = self._get_certificate(colors)
+        leaf = (colors, certificate, list(self.path))
+        if self.first is None:
+            self.first = leaf
+            self.best = leaf
+            return
+        for other in self.first, self.best:
+            if certificate == other[1]:
+                # map each vertex to the vertex at the same position in the
+                # other leaf.
+                other_order = other[0].argsort()
+                self.generators.append(other_order[colors])
+                # backtrack to the node where both paths diverged
+                for depth, (vertex, other_vertex) in enumerate(zip(self.path, other[2])):
+                    if vertex != other_vertex:
+                        return depth
+        if certificate < self.best[1]:
+            self.best = leaf
+
+
 class Graph(ReadOnly):
     """An undirected graph, where edges have equal weight
 
@@ -95,14 +354,25 @@ class Graph(ReadOnly):
        >>> graph.vertex_property = numpy.array([6, 6, 1, 1, 1, 1], int)
        >>> # bond orders of ethene
        >>> graph.edge_property = numpy.array([2, 1, 1, 1, 1], int)
+
+       Internally, the edges are stored as an Ex2 integer array, edge_array.
+       The neighbors of all vertices are also available as two arrays in the
+       compressed sparse row (CSR) format, neighbor_offsets and
+       neighbor_indexes. The attributes edges, edge_index and neighbors are
+       derived from these arrays when they are first used. This keeps the
+       memory usage of large graphs low, e.g. for periodic frameworks, and
+       it makes vectorized graph algorithms possible.
     """
-    edges = ReadOnlyAttribute(tuple, none=False, doc="the incidence list")
+    edge_array = ReadOnlyAttribute(numpy.ndarray, none=False, npdim=2,
+        npshape=(None, 2), npdtype=numpy.int32, doc="the incidence list as "
+        "an Ex2 array, the lowest vertex index of each edge comes first")
     num_vertices = ReadOnlyAttribute(int, none=False, doc="the number of vertices")
 
     def __init__(self, edges, num_vertices=None):
         """
            Arguments:
-            | ``edges`` -- ``tuple(frozenset([vertex1, vertex2]), ...)``
+            | ``edges`` -- ``tuple(frozenset([vertex1, vertex2]), ...)`` or
+                           an integer array with shape (E, 2)
             | ``num_vertices`` -- number of vertices
 
            vertex1 to vertexN must be integers from 0 to N-1. If vertices above
@@ -110,27 +380,15 @@ class Graph(ReadOnly):
            num_vertices argument to tell what the total number of vertices is.
 
            If the edges argument does not have the correct format, it will be
-           converted.
-        """
-
-        tmp = []
-        for edge in edges:
-            if len(edge) != 2:
-                raise TypeError("The edges must be a iterable with 2 elements")
-            i, j = edge
-            if i == j:
-                raise ValueError("A edge must contain two different values.")
-            if not (isinstance(i, int) and isinstance(j, int)):
-                raise TypeError("The edges must contain integers.")
-            if i < 0 or j < 0:
-                raise TypeError("The edges must contain positive integers.")
-            tmp.append(frozenset([i, j]))
-        edges = tuple(tmp)
-
-        if len(edges) == 0:
+           converted. Large graphs are constructed most efficiently from an
+           integer array.
+        """
+        edge_array = _get_edge_array(edges)
+
+        if len(edge_array) == 0:
             real_num_vertices = 0
         else:
-            real_num_vertices = max(max(a, b) for a, b in edges)+1
+            real_num_vertices = int(edge_array[:, 1].max())+1
         if num_vertices is not None:
             if not isinstance(num_vertices, int):
                 raise TypeError("The optional argument num_vertices must be an "
@@ -140,12 +398,43 @@ class Graph(ReadOnly):
                     "number of vertices deduced from the edge list.")
             real_num_vertices = num_vertices
 
-        self.edges = edges
+        self.edge_array = edge_array
         self.num_vertices = real_num_vertices
 
-    num_edges = property(lambda self: len(self.edges),
+    num_edges = property(lambda self: len(self.edge_array),
         doc="*Read-only attribute:* the number of edges in the graph.")
 
+    def _get_init_kwargs(self):
+        """Return the keyword arguments for the constructor of a copy
+
+           See :meth:`molmod.utils.ReadOnly.copy_with`. The edge array is
+           passed as the argument edges.
+        """
+        attrs = ReadOnly._get_init_kwargs(self)
+        attrs["edges"] = attrs.pop("edge_array")
+        return attrs
+
+    def copy_with(self, **kwargs):
+        """Return a copy with (a few) changed attributes
+
+           See :meth:`molmod.utils.ReadOnly.copy_with`. New edges can be
+           given with the keyword argument edges or edge_array.
+        """
+        if "edge_array" in kwargs:
+            kwargs["edges"] = kwargs.pop("edge_array")
+        return ReadOnly.copy_with(self, **kwargs)
+
+    def __setstate__(self, state):
+        """Part of the pickle protocol
+
+           Graphs pickled before the introduction of edge_array contain a
+           tuple of edges, which is converted.
+        """
+        if "edges" in state:
+            state = state.copy()
+            state["edge_array"] = _get_edge_array(state.pop("edges"))
+        ReadOnly.__setstate__(self, state)
+
     def __mul__(self, repeat):
         """Construct a graph that repeats this graph a number of times
 
@@ -154,13 +443,8 @@ class Graph(ReadOnly):
         """
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([
-                    vertex1+i*self.num_vertices,
-                    vertex2+i*self.num_vertices
-                ]))
+        shifts = numpy.arange(repeat).reshape(-1, 1, 1)*self.num_vertices
+        new_edges = (self.edge_array + shifts).reshape(-1, 2)
         return Graph(new_edges, self.num_vertices*repeat)
 
     __rmul__ = __mul__
@@ -184,13 +468,58 @@ class Graph(ReadOnly):
         """
         return ""
 
+    def get_vertex_strings(self):
+        """Returns a list with the strings of all vertices
+
+           See get_vertex_string. Derived classes may override this method
+           with a faster implementation.
+        """
+        return [self.get_vertex_string(i) for i in xrange(self.num_vertices)]
+
+    def get_edge_strings(self):
+        """Returns a list with the strings of all edges
+
+           See get_edge_string. Derived classes may override this method with
+           a faster implementation.
+        """
+        return [self.get_edge_string(i) for i in xrange(self.num_edges)]
+
     # cached attributes:
 
+    @cached
+    def edges(self):
+        """The incidence list: ``tuple(frozenset([vertex1, vertex2]), ...)``
+
+           The edges are in the same order as the rows of edge_array.
+        """
+        return tuple(frozenset(edge) for edge in self.edge_array.tolist())
+
     @cached
     def edge_index(self):
         """A map to look up the index of a edge"""
         return dict((edge, index) for index, edge in enumerate(self.edges))
 
+    @cached
+    def neighbor_offsets(self):
+        """The offsets of the neighbors of each vertex in neighbor_indexes
+
+           This is an array with num_vertices+1 elements. The neighbors of
+           vertex i are ``neighbor_indexes[neighbor_offsets[i]:neighbor_offsets[i+1]]``.
+        """
+        result = numpy.zeros(self.num_vertices+1, numpy.int32)
+        result[1:] = numpy.bincount(self.edge_array.ravel(), minlength=self.num_vertices).cumsum()
+        return result
+
+    @cached
+    def neighbor_indexes(self):
+        """The neighbors of all vertices in one array
+
+           See neighbor_offsets. The neighbors of each vertex are sorted.
+        """
+        sources = numpy.concatenate([self.edge_array[:, 0], self.edge_array[:, 1]])
+        targets = numpy.concatenate([self.edge_array[:, 1], self.edge_array[:, 0]])
+        return targets[numpy.lexsort([targets, sources])]
+
     @cached
     def neighbors(self):
         """A dictionary with neighbors
@@ -201,42 +530,55 @@ class Graph(ReadOnly):
            implies that the following elements are part of the dictionary:
            ``{vertexY1: (vertexX, ...), vertexY2: (vertexX, ...), ...}``.
         """
-        neighbors = dict(
-            (vertex, []) for vertex
-            in xrange(self.num_vertices)
+        offsets = self.neighbor_offsets.tolist()
+        indexes = self.neighbor_indexes.tolist()
+        return dict(
+            (vertex, frozenset(indexes[offsets[vertex]:offsets[vertex+1]]))
+            for vertex in xrange(self.num_vertices)
         )
-        for a, b in self.edges:
-            neighbors[a].append(b)
-            neighbors[b].append(a)
-        # turn lists into frozensets
-        neighbors = dict((key, frozenset(val)) for key, val in neighbors.iteritems())
-        return neighbors
 
     @cached
     def distances(self):
-        """The matrix with the all-pairs shortest path lenghts"""
-        from molmod.ext import graphs_floyd_warshall
+        """The matrix with the all-pairs shortest path lenghts
+
+           The distances are computed with a breadth-first search from each
+           vertex, which scales as O(V*E) instead of O(V**3). Vertices that
+           are not connected have a zero distance. The matrix still takes
+           O(V**2) memory. When only short distances are needed, use the
+           method :meth:`distances_upto`.
+        """
+        from molmod.ext import graphs_bfs_distances
         distances = numpy.zeros((self.num_vertices,)*2, numpy.int32)
-        #distances[:] = -1 # set all -1, which is just a very big integer
-        #distances.ravel()[::len(distances)+1] = 0 # set diagonal to zero
-        for i, j in self.edges: # set edges to one
-            distances[i, j] = 1
-            distances[j, i] = 1
-        graphs_floyd_warshall(distances)
+        if self.num_edges > 0:
+            graphs_bfs_distances(self.neighbor_offsets, self.neighbor_indexes, distances)
         return distances
 
+    @cached
+    def eccentricities(self):
+        """The largest distance from each vertex to any other vertex
+
+           Only vertices in the same connected component are considered. This
+           is the maximum of each row of the distances matrix, but it is
+           computed without storing that matrix.
+        """
+        from molmod.ext import graphs_bfs_eccentricities
+        result = numpy.zeros(self.num_vertices, numpy.int32)
+        if self.num_edges > 0:
+            graphs_bfs_eccentricities(self.neighbor_offsets, self.neighbor_indexes, result)
+        return result
+
     @cached
     def max_distance(self):
         """The maximum value in the distances matrix."""
-        if self.distances.shape[0] == 0:
+        if self.num_vertices == 0:
             return 0
         else:
-            return self.distances.max()
+            return self.eccentricities.max()
 
     @cached
     def central_vertices(self):
         """Vertices that have the lowest maximum distance to any other vertex"""
-        max_distances = self.distances.max(0)
+        max_distances = self.eccentricities
         max_distances_min = max_distances[max_distances > 0].min()
         return (max_distances == max_distances_min).nonzero()[0]
 
@@ -249,29 +591,37 @@ class Graph(ReadOnly):
         """
         return self.central_vertices[0]
 
+    @cached
+    def components(self):
+        """The index of the connected component of each vertex
+
+           The components are numbered in the order of their lowest vertex.
+           They are found in a single breadth-first pass over the graph,
+           which scales linearly with the size of the graph.
+        """
+        from molmod.ext import graphs_components
+        if self.num_edges == 0:
+            return numpy.arange(self.num_vertices, dtype=numpy.int32)
+        result = numpy.zeros(self.num_vertices, numpy.int32) - 1
+        graphs_components(self.neighbor_offsets, self.neighbor_indexes, result)
+        return result
+
     @cached
     def independent_vertices(self):
         """Lists of vertices that are only interconnected within each list
 
            This means that there is no path from a vertex in one list to a
            vertex in another list. In case of a molecular graph, this would
-           yield the atoms that belong to individual molecules.
+           yield the atoms that belong to individual molecules. The lists are
+           sorted and they are in the same order as the labels in the
+           attribute components.
         """
-        candidates = set(xrange(self.num_vertices))
-
-        result = []
-        while len(candidates) > 0:
-            pivot = candidates.pop()
-            group = [
-                vertex for vertex, distance
-                in self.iter_breadth_first(pivot)
-            ]
-            candidates.difference_update(group)
-
-            # this sort makes sure that the order of the vertices is respected
-            group.sort()
-            result.append(group)
-        return result
+        if self.num_vertices == 0:
+            return []
+        # a stable sort keeps the vertices of each component sorted
+        order = self.components.argsort(kind="mergesort")
+        ends = numpy.bincount(self.components).cumsum()
+        return [group.tolist() for group in numpy.split(order, ends[:-1])]
 
     @cached
     def fingerprint(self):
@@ -281,9 +631,10 @@ class Graph(ReadOnly):
            chance that two different (molecular) graphs yield the same
            fingerprint is small but not zero. (See unit tests.)"""
         if self.num_vertices == 0:
-            return numpy.zeros(20, numpy.ubyte)
+            return numpy.zeros(16, numpy.ubyte)
         else:
-            return sum(self.vertex_fingerprints)
+            # sum the fingerprints as 64-bit integers, with wrap-around
+            return self.vertex_fingerprints.view(numpy.uint64).sum(axis=0).view(numpy.ubyte)
 
     @cached
     def vertex_fingerprints(self):
@@ -295,27 +646,25 @@ class Graph(ReadOnly):
            fingerprint.
         """
         return self.get_vertex_fingerprints(
-            [self.get_vertex_string(i) for i in xrange(self.num_vertices)],
-            [self.get_edge_string(i) for i in xrange(self.num_edges)],
+            self.get_vertex_strings(),
+            self.get_edge_strings(),
         )
 
     @cached
     def equivalent_vertices(self):
         """A dictionary with symmetrically equivalent vertices."""
-        level1 = {}
-        for i, row in enumerate(self.vertex_fingerprints):
-            key = str(buffer(row))
-            l = level1.get(key)
-            if l is None:
-                l = set([i])
-                level1[key] = l
-            else:
-                l.add(i)
-        level2 = {}
-        for key, vertices in level1.iteritems():
-            for vertex in vertices:
-                level2[vertex] = vertices
-        return level2
+        result = {}
+        if self.num_vertices == 0:
+            return result
+        # sort the fingerprints and split where they change
+        fingerprints = self.vertex_fingerprints.view(numpy.uint64)
+        order = numpy.lexsort([fingerprints[:, 1], fingerprints[:, 0]])
+        fingerprints = fingerprints[order]
+        changes = (fingerprints[1:] != fingerprints[:-1]).any(axis=1).nonzero()[0] + 1
+        for group in numpy.split(order, changes):
+            group = group.tolist()
+            result.update(dict.fromkeys(group, set(group)))
+        return result
 
     @cached
     def symmetries(self):
@@ -339,6 +688,83 @@ class Graph(ReadOnly):
             result.add(symmetry.cycles)
         return result
 
+    @cached
+    def canonical_ranks(self):
+        """The position of each vertex in the canonical order
+
+           The ranks only depend on the connectivity and the return values of
+           get_vertex_string and get_edge_string, not on the initial order of
+           the vertices. Unlike canonical_order, all vertices get a rank,
+           including the ones that are not involved in edges.
+
+           The initial order of the vertices is natural: central vertices
+           come first, followed by vertices with few equivalents, the vertex
+           string (higher atom numbers first) and the fingerprint. Remaining
+           ties are broken by a complete canonical labeling of each connected
+           component, see _CanonicalSearch. The largest components come first.
+        """
+        size = self.num_vertices
+        if size == 0:
+            return numpy.zeros(0, int)
+
+        # A) The initial ordered partition of the vertices. All these sort
+        # keys are invariant under permutation of the vertex indexes.
+        vertex_codes = numpy.unique(numpy.array(self.get_vertex_strings(), str), return_inverse=True)[1]
+        fingerprints = self.vertex_fingerprints.view(numpy.uint64)
+        order = numpy.lexsort([fingerprints[:, 1], fingerprints[:, 0]])
+        new_class = numpy.zeros(size, int)
+        new_class[1:] = (fingerprints[order][1:] != fingerprints[order][:-1]).any(axis=1)
+        fingerprint_ranks = numpy.zeros(size, int)
+        fingerprint_ranks[order] = new_class.cumsum()
+        num_equivalents = numpy.bincount(fingerprint_ranks)[fingerprint_ranks]
+        keys = numpy.array([
+            -fingerprint_ranks, -vertex_codes, num_equivalents, self.eccentricities
+        ])
+        order = numpy.lexsort(keys)
+        new_key = numpy.zeros(size, int)
+        new_key[1:] = (keys[:, order][:, 1:] != keys[:, order][:, :-1]).any(axis=0)
+        key_ranks = numpy.zeros(size, int)
+        key_ranks[order] = new_key.cumsum()
+        if self.num_edges > 0:
+            edge_codes = numpy.unique(numpy.array(self.get_edge_strings(), str), return_inverse=True)[1]
+
+        # B) Canonical labeling of each connected component.
+        components = self.components
+        num_components = components.max()+1
+        vertex_order = components.argsort(kind="mergesort")
+        vertex_ends = numpy.bincount(components).cumsum()
+        local_indexes = numpy.zeros(size, int)
+        local_indexes[vertex_order] = numpy.arange(size) - (vertex_ends - numpy.bincount(components))[components[vertex_order]]
+        edge_components = components[self.edge_array[:, 0]]
+        edge_order = edge_components.argsort(kind="mergesort")
+        edge_ends = numpy.bincount(edge_components, minlength=num_components).cumsum()
+        records = []
+        for component in xrange(num_components):
+            begin = 0 if component == 0 else vertex_ends[component-1]
+            vertices = vertex_order[begin:vertex_ends[component]]
+            if len(vertices) > 1:
+                begin = 0 if component == 0 else edge_ends[component-1]
+                edge_indexes = edge_order[begin:edge_ends[component]]
+                local_keys = key_ranks[vertices]
+                # the color of a vertex is the position of its cell
+                colors = numpy.sort(local_keys).searchsorted(local_keys)
+                search = _CanonicalSearch(
+                    local_indexes[self.edge_array[edge_indexes]],
+                    edge_codes[edge_indexes], colors
+                )
+                vertices = vertices[search.colors.argsort()]
+                certificate = search.certificate
+            else:
+                certificate = ""
+            # isomorphic components get the same sort key.
+            key = (-len(vertices), key_ranks[vertices].astype(">i4").tostring() + certificate)
+            records.append((key, vertices))
+        records.sort(key=(lambda record: record[0]))
+
+        result = numpy.zeros(size, int)
+        result[numpy.concatenate([vertices for key, vertices in records])] = numpy.arange(size)
+        return result
+
     @cached
     def canonical_order(self):
         """The vertices in a canonical or normalized order.
@@ -350,77 +776,66 @@ class Graph(ReadOnly):
            Only the vertices that are involved in edges will be included. The
            result can be given as first argument to self.get_subgraph, with
            reduce=True as second argument. This will return a complete canonical
-           graph.
-
-           The routine is designed not to use symmetry relations that are
-           obtained with the GraphSearch routine. We also tried to create an
-           ordering that feels like natural, i.e. starting in the center and
-           pushing vertices with few equivalents to the front. If necessary, the
-           nature of the vertices and  their bonds to atoms closer to the center
-           will also play a role, but only as a last resort.
-        """
-        # A) find an appropriate starting vertex.
-        # Here we take a central vertex that has a minimal number of symmetrical
-        # equivalents, 'the highest atom number', and the highest fingerprint.
-        # Note that the symmetrical equivalents are computed from the vertex
-        # fingerprints, i.e. without the GraphSearch.
-        starting_vertex = max(
-            (
-                -len(self.equivalent_vertices[vertex]),
-                self.get_vertex_string(vertex),
-                str(buffer(self.vertex_fingerprints[vertex])),
-                vertex
-            ) for vertex in self.central_vertices
-        )[-1]
-
-        # B) sort all vertices based on
-        #      1) distance from central vertex
-        #      2) number of equivalent vertices
-        #      3) vertex string, (higher atom numbers come first)
-        #      4) fingerprint
-        #      5) vertex index
-        # The last field is only included to collect the result of the sort.
-        # The fingerprint on itself would be sufficient, but the three first are
-        # there to have a naturally appealing result.
-        l = [
-            [
-                -distance,
-                -len(self.equivalent_vertices[vertex]),
-                self.get_vertex_string(vertex),
-                str(buffer(self.vertex_fingerprints[vertex])),
-                vertex
-            ] for vertex, distance in self.iter_breadth_first(starting_vertex)
-            if len(self.neighbors[vertex]) > 0
-        ]
-        l.sort(reverse=True)
-
-        # C) The order of some vertices is still not completely set. e.g.
-        # consider the case of allene. The four hydrogen atoms are equivalent,
-        # but one can have two different orders: make geminiles consecutive or
-        # don't. It is more trikcy than one would think at first sight. In the
-        # case of allene, geminility could easily solve the problem. Consider a
-        # big flat rotationally symmetric molecule (order 2). The first five
-        # shells are order 4 and one would just give a random order to four
-        # segemnts in the first shell. Only when one reaches the outer part that
-        # has order two, it turns out that the arbitrary choices in the inner
-        # shell play a role. So it does not help to look at relations with
-        # vertices at inner or current shells only. One has to consider the
-        # whole picture. (unit testing reveals troubles like these)
-
-        # I need some sleep now. The code below checks for potential fuzz and
-        # will raise an error if the ordering is not fully determined yet. One
-        # day, I'll need this code more than I do now, and I'll fix things up.
-        # I know how to do this, but I don't care enough right now.
-        # -- Toon
-        for i in xrange(1, len(l)):
-            if l[i][:-1] == l[i-1][:-1]:
-                raise NotImplementedError
-
-        # D) Return only the vertex indexes.
-        return [record[-1] for record in l]
+           graph. See canonical_ranks for the details.
+        """
+        order = self.canonical_ranks.argsort()
+        degrees = self.neighbor_offsets[1:] - self.neighbor_offsets[:-1]
+        return order[degrees[order] > 0].tolist()
+
+    @cached
+    def canonical_hash(self):
+        """A hash of the canonical form of the graph
+
+           This is the SHA1 hex digest of the vertex and edge strings of the
+           graph in canonical order. Two graphs have the same hash if and only
+           if they are isomorphic (barring hash collisions), which makes it
+           suitable as a key to find duplicate structures.
+        """
+        import hashlib
+        ranks = self.canonical_ranks
+        vertex_strings = self.get_vertex_strings()
+        edge_strings = self.get_edge_strings()
+        lines = ["%i %i" % (self.num_vertices, self.num_edges)]
+        lines.extend(vertex_strings[i] for i in ranks.argsort())
+        edges = numpy.sort(ranks[self.edge_array], axis=1)
+        for i in numpy.lexsort([edges[:, 1], edges[:, 0]]):
+            lines.append("%i %i %s" % (edges[i, 0], edges[i, 1], edge_strings[i]))
+        return hashlib.sha1("\n".join(lines)).hexdigest()
 
     # other usefull graph functions
 
+    def distances_upto(self, max_distance):
+        """Find all pairs of vertices up to a given graph distance
+
+           Argument:
+            | ``max_distance``  --  the maximum graph distance
+
+           Returns: pairs, distances. The array pairs has two columns with
+           vertex indexes, the lowest index first. The graph distance of each
+           pair is stored in distances. The pairs are sorted by the first
+           index and then by the distance.
+
+           Only the vertices within the given distance of each vertex are
+           visited in a breadth-first search. For graphs with a bounded
+           number of neighbors per vertex, the cost and the memory usage are
+           linear in the size of the graph.
+        """
+        from molmod.ext import graphs_bfs_count_upto, graphs_bfs_pairs_upto
+        if max_distance < 1 or self.num_edges == 0:
+            return numpy.zeros((0, 2), numpy.int32), numpy.zeros(0, numpy.int32)
+        offsets = self.neighbor_offsets
+        indexes = self.neighbor_indexes
+        counts = numpy.zeros(self.num_vertices, numpy.int32)
+        graphs_bfs_count_upto(offsets, indexes, max_distance, counts)
+        begins = numpy.zeros(self.num_vertices, numpy.int32)
+        begins[1:] = counts.cumsum()[:-1]
+        size = counts.sum()
+        pairs = numpy.zeros((size, 2), numpy.int32)
+        distances = numpy.zeros(size, numpy.int32)
+        if size > 0:
+            graphs_bfs_pairs_upto(offsets, indexes, max_distance, begins, pairs, distances)
+        return pairs, distances
+
     def iter_breadth_first(self, start=None, do_paths=False, do_duplicates=False):
         """Iterate over the vertices with the breadth first algorithm.
 
@@ -561,36 +976,25 @@ class Graph(ReadOnly):
            ``normalize==True``.
         """
         if normalize:
-            revorder = dict((j, i) for i, j in enumerate(subvertices))
-            new_edges = []
-            old_edge_indexes = []
-            for counter, (i, j) in enumerate(self.edges):
-                new_i = revorder.get(i)
-                if new_i is None:
-                    continue
-                new_j = revorder.get(j)
-                if new_j is None:
-                    continue
-                new_edges.append((new_i, new_j))
-                old_edge_indexes.append(counter)
-            # sort the edges
-            order = range(len(new_edges))
-            # argsort in pure python
-            order.sort( key=(lambda i: tuple(sorted(new_edges[i]))) )
-            new_edges = [new_edges[i] for i in order]
-            old_edge_indexes = [old_edge_indexes[i] for i in order]
+            subvertices = numpy.array(list(subvertices), dtype=int)
+            revorder = numpy.zeros(self.num_vertices, int) - 1
+            revorder[subvertices] = numpy.arange(len(subvertices))
+            new_edges = revorder[self.edge_array]
+            old_edge_indexes = (new_edges >= 0).all(axis=1).nonzero()[0]
+            new_edges = numpy.sort(new_edges[old_edge_indexes], axis=1)
+            # sort the edges, the order of equal edges is retained
+            order = numpy.lexsort([new_edges[:, 1], new_edges[:, 0]])
+            new_edges = new_edges[order]
+            old_edge_indexes = old_edge_indexes[order]
 
             result = Graph(new_edges, num_vertices=len(subvertices))
-            result._old_vertex_indexes = numpy.array(subvertices, dtype=int)
-            #result.new_vertex_indexes = revorder
-            result._old_edge_indexes = numpy.array(old_edge_indexes, dtype=int)
+            result._old_vertex_indexes = subvertices
+            result._old_edge_indexes = old_edge_indexes
         else:
-            subvertices = set(subvertices)
-            old_edge_indexes = numpy.array([
-                i for i, edge in enumerate(self.edges)
-                if edge.issubset(subvertices)
-            ], dtype=int)
-            new_edges = tuple(self.edges[i] for i in old_edge_indexes)
+            mask = numpy.zeros(self.num_vertices, bool)
+            mask[list(subvertices)] = True
+            old_edge_indexes = mask[self.edge_array].all(axis=1).nonzero()[0]
+            new_edges = self.edge_array[old_edge_indexes]
             result = Graph(new_edges, self.num_vertices)
             result._old_edge_indexes = old_edge_indexes
             # no need for old and new vertex_indexes because they remain the
@@ -598,38 +1002,57 @@ class Graph(ReadOnly):
         return result
 
     def get_vertex_fingerprints(self, vertex_strings, edge_strings, num_iter=None):
-        """Return an array with fingerprints for each vertex"""
-        import hashlib
-        def str2array(x):
-            """convert a has string to a numpy array of bytes"""
-            if len(x) == 0:
-                return numpy.zeros(0, numpy.ubyte)
-            else:
-                return numpy.frombuffer(x, numpy.ubyte)
-        hashrow = lambda x: numpy.frombuffer(hashlib.sha1(x.data).digest(), numpy.ubyte)
+        """Return an array with fingerprints for each vertex
+
+           Arguments:
+            | ``vertex_strings``  --  a string for each vertex, see
+                                      get_vertex_string
+            | ``edge_strings``  --  a string for each edge, see get_edge_string
+
+           Optional argument:
+            | ``num_iter``  --  the maximum number of refinement iterations
+
+           The fingerprints are computed with Weisfeiler-Lehman refinement
+           iterations. In each iteration, the hashes of the neighbors (mixed
+           with the edge hashes) are summed and combined with the hash of the
+           vertex itself. The iterations stop as soon as the number of distinct
+           fingerprints no longer increases. Each row of the result contains
+           the 128 bits of a fingerprint as 16 bytes.
+        """
+        if num_iter is None:
+            num_iter = self.num_vertices
         # initialization
-        result = numpy.zeros((self.num_vertices, 20), numpy.ubyte)
-        for i in xrange(self.num_vertices):
-            result[i] = hashrow(str2array(vertex_strings[i]))
-        for i in xrange(self.num_edges):
-            a, b = self.edges[i]
-            tmp = hashrow(str2array(edge_strings[i]))
-            result[a] += tmp
-            result[b] += tmp
-        work = result.copy()
+        result = _hash_strings(vertex_strings)
+        if self.num_edges == 0:
+            return result.view(numpy.ubyte)
+        edge_hashes = _hash_strings(edge_strings)
+        # directed edges sorted by source, i.e. in the order of neighbor_indexes
+        sources = numpy.concatenate([self.edge_array[:, 0], self.edge_array[:, 1]])
+        targets = numpy.concatenate([self.edge_array[:, 1], self.edge_array[:, 0]])
+        order = numpy.lexsort([targets, sources])
+        targets = targets[order]
+        edge_hashes = numpy.concatenate([edge_hashes, edge_hashes])[order]
+        begins = self.neighbor_offsets[:-1]
+        mask = self.neighbor_offsets[1:] > begins
+        begins = begins[mask]
+        # the two halves of the 128 bit hashes are mixed with different seeds
+        seeds = numpy.array([0x9e3779b97f4a7c15, 0x632be59bd9b4e019], numpy.uint64)
+        # include the edge strings in the initial fingerprints
+        work = numpy.zeros(result.shape, numpy.uint64)
+        work[mask] = numpy.add.reduceat(edge_hashes, begins)
+        result = _mix_hash(result ^ _mix_hash(work + seeds))
+        num_classes = len(numpy.unique(result[:, 0]))
         # iterations
-        if num_iter is None:
-            num_iter = self.max_distance
         for i in xrange(num_iter):
-            for a, b in self.edges:
-                work[a] += result[b]
-                work[b] += result[a]
-            #for a in xrange(self.num_vertices):
-            #    for b in xrange(self.num_vertices):
-            #        work[a] += hashrow(result[b]*self.distances[a, b])
-            for a in xrange(self.num_vertices):
-                result[a] = hashrow(work[a])
-        return result
+            work[mask] = numpy.add.reduceat(_mix_hash(result[targets] ^ edge_hashes), begins)
+            result = _mix_hash(result ^ _mix_hash(work + seeds))
+            # the partition can only be refined. when the number of classes
+            # remains the same, further iterations will not refine it.
+            new_num_classes = len(numpy.unique(result[:, 0]))
+            if new_num_classes == num_classes:
+                break
+            num_classes = new_num_classes
+        return result.view(numpy.ubyte)
 
     def get_halfs(self, vertex1, vertex2):
         """Split the graph in two halfs by cutting the edge: vertex1-vertex2
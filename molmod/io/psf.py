@@ -301,10 +301,7 @@ class PSFFile(object):
         if split:
             groups = molecular_graph.independent_vertices
             names = [self._get_name(molecular_graph, group) for group in groups]
-            group_indices = numpy.zeros(new, int)
-            for group_index, group in enumerate(groups):
-                for index in group:
-                    group_indices[index] = group_index
+            group_indices = molecular_graph.components
             self.names.extend([names[group_index] for group_index in group_indices])
             if prev == 0:
                 self.molecules[:] = group_indices
@@ -0,0 +1,262 @@
+// MolMod is a collection of molecular modelling tools for python.
+// Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+// for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+// reserved unless otherwise stated.
+//
+// This file is part of MolMod.
+//
+// MolMod is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// MolMod is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+
+
+#include <math.h>
+
+
+/* The tree is stored in a few arrays. Node 0 is the root. For each node:
+   - children[2*node] and children[2*node+1] are the child nodes, both -1 for
+     leaves,
+   - order[ranges[2*node]] to order[ranges[2*node+1]-1] are the indexes of the
+     points in the node,
+   - bounds[6*node] to bounds[6*node+5] are the lower and upper corners of the
+     bounding box of the points in the node. */
+
+
+void kdtree_select(double *cor, int *order, int begin, int end, int mid, int dim) {
+  /* Partially sort order[begin:end] such that the point at mid has the median
+     coordinate along dim. (Quickselect, Hoare partitioning.) */
+  int i, j, tmp;
+  double pivot;
+
+  while (end - begin > 1) {
+    pivot = cor[3*order[(begin + end)/2] + dim];
+    i = begin;
+    j = end - 1;
+    while (i <= j) {
+      while (cor[3*order[i] + dim] < pivot) i++;
+      while (cor[3*order[j] + dim] > pivot) j--;
+      if (i <= j) {
+        tmp = order[i];
+        order[i] = order[j];
+        order[j] = tmp;
+        i++;
+        j--;
+      }
+    }
+    if (mid <= j) {
+      end = j + 1;
+    } else if (mid >= i) {
+      begin = i;
+    } else {
+      return;
+    }
+  }
+}
+
+
+int kdtree_build_node(
+  double *cor, int leafsize, int maxnode, int *order, int *children,
+  int *ranges, double *bounds, int begin, int end, int *nnode
+) {
+  int node, i, k, dim, mid;
+  double *lower, *upper, extent, best;
+
+  if (*nnode >= maxnode) return -1;
+  node = *nnode;
+  (*nnode)++;
+  ranges[2*node] = begin;
+  ranges[2*node+1] = end;
+  lower = bounds + 6*node;
+  upper = bounds + 6*node + 3;
+  for (k = 0; k < 3; k++) {
+    lower[k] = 1e300;
+    upper[k] = -1e300;
+  }
+  for (i = begin; i < end; i++) {
+    for (k = 0; k < 3; k++) {
+      if (cor[3*order[i]+k] < lower[k]) lower[k] = cor[3*order[i]+k];
+      if (cor[3*order[i]+k] > upper[k]) upper[k] = cor[3*order[i]+k];
+    }
+  }
+  if (end - begin <= leafsize) {
+    children[2*node] = -1;
+    children[2*node+1] = -1;
+    return node;
+  }
+  /* split along the direction with the largest extent */
+  dim = 0;
+  best = -1.0;
+  for (k = 0; k < 3; k++) {
+    extent = upper[k] - lower[k];
+    if (extent > best) {
+      best = extent;
+      dim = k;
+    }
+  }
+  mid = (begin + end)/2;
+  kdtree_select(cor, order, begin, end, mid, dim);
+  children[2*node] = kdtree_build_node(cor, leafsize, maxnode, order, children, ranges, bounds, begin, mid, nnode);
+  if (children[2*node] < 0) return -1;
+  children[2*node+1] = kdtree_build_node(cor, leafsize, maxnode, order, children, ranges, bounds, mid, end, nnode);
+  if (children[2*node+1] < 0) return -1;
+  return node;
+}
+
+
+int kdtree_build(
+  int n, double *cor, int leafsize, int maxnode, int *order, int *children,
+  int *ranges, double *bounds
+) {
+  /* Returns the number of nodes, or -1 when maxnode is too small. */
+  int i, nnode;
+
+  for (i = 0; i < n; i++) order[i] = i;
+  nnode = 0;
+  if (kdtree_build_node(cor, leafsize, maxnode, order, children, ranges, bounds, 0, n, &nnode) < 0) return -1;
+  return nnode;
+}
+
+
+double kdtree_min_distance_sq(double *point, double *box) {
+  /* The square of the shortest distance between a point and a box */
+  int k;
+  double d, result;
+
+  result = 0.0;
+  for (k = 0; k < 3; k++) {
+    if (point[k] < box[k]) {
+      d = box[k] - point[k];
+      result += d*d;
+    } else if (point[k] > box[k+3]) {
+      d = point[k] - box[k+3];
+      result += d*d;
+    }
+  }
+  return result;
+}
+
+
+void kdtree_knn_node(
+  double *cor, int *order, int *children, int *ranges, double *bounds,
+  int node, double *point, int k, int *count, int *indexes, double *distances_sq
+) {
+  /* The found neighbors are kept sorted by distance in indexes and
+     distances_sq. */
+  int i, j, c0, c1, tmp;
+  double d_sq, delta[3];
+
+  if ((*count == k) && (kdtree_min_distance_sq(point, bounds + 6*node) >= distances_sq[k-1])) return;
+  if (children[2*node] < 0) {
+    for (i = ranges[2*node]; i < ranges[2*node+1]; i++) {
+      delta[0] = cor[3*order[i]  ] - point[0];
+      delta[1] = cor[3*order[i]+1] - point[1];
+      delta[2] = cor[3*order[i]+2] - point[2];
+      d_sq = delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2];
+      if ((*count < k) || (d_sq < distances_sq[k-1])) {
+        /* insert the new neighbor */
+        if (*count < k) (*count)++;
+        j = *count - 1;
+        while ((j > 0) && (distances_sq[j-1] > d_sq)) {
+          distances_sq[j] = distances_sq[j-1];
+          indexes[j] = indexes[j-1];
+          j--;
+        }
+        distances_sq[j] = d_sq;
+        indexes[j] = order[i];
+      }
+    }
+  } else {
+    /* first visit the child that is closest to the point */
+    c0 = children[2*node];
+    c1 = children[2*node+1];
+    if (kdtree_min_distance_sq(point, bounds + 6*c1) < kdtree_min_distance_sq(point, bounds + 6*c0)) {
+      tmp = c0;
+      c0 = c1;
+      c1 = tmp;
+    }
+    kdtree_knn_node(cor, order, children, ranges, bounds, c0, point, k, count, indexes, distances_sq);
+    kdtree_knn_node(cor, order, children, ranges, bounds, c1, point, k, count, indexes, distances_sq);
+  }
+}
+
+
+void kdtree_query_knn(
+  int n, double *cor, int nnode, int *order, int *children, int *ranges,
+  double *bounds, int m, double *points, int k, int *indexes,
+  double *distances
+) {
+  int i, j, count;
+
+  for (i = 0; i < m; i++) {
+    count = 0;
+    kdtree_knn_node(cor, order, children, ranges, bounds, 0, points + 3*i, k, &count, indexes + k*i, distances + k*i);
+    for (j = 0; j < k; j++) {
+      distances[k*i+j] = sqrt(distances[k*i+j]);
+    }
+  }
+}
+
+
+void kdtree_radius_node(
+  double *cor, int *order, int *children, int *ranges, double *bounds,
+  int node, double *point, double radius_sq, int size, int *counter,
+  int *indexes, double *distances
+) {
+  int i;
+  double d_sq, delta[3];
+
+  if (kdtree_min_distance_sq(point, bounds + 6*node) > radius_sq) return;
+  if (children[2*node] < 0) {
+    for (i = ranges[2*node]; i < ranges[2*node+1]; i++) {
+      delta[0] = cor[3*order[i]  ] - point[0];
+      delta[1] = cor[3*order[i]+1] - point[1];
+      delta[2] = cor[3*order[i]+2] - point[2];
+      d_sq = delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2];
+      if (d_sq <= radius_sq) {
+        /* When the output arrays are too small, the results are only counted
+           such that the caller can retry with larger arrays. */
+        if (*counter < size) {
+          indexes[*counter] = order[i];
+          distances[*counter] = sqrt(d_sq);
+        }
+        (*counter)++;
+      }
+    }
+  } else {
+    kdtree_radius_node(cor, order, children, ranges, bounds, children[2*node], point, radius_sq, size, counter, indexes, distances);
+    kdtree_radius_node(cor, order, children, ranges, bounds, children[2*node+1], point, radius_sq, size, counter, indexes, distances);
+  }
+}
+
+
+int kdtree_query_radius(
+  int n, double *cor, int nnode, int *order, int *children, int *ranges,
+  double *bounds, int m, double *points, double radius, int size,
+  int *offsets, int *indexes, double *distances
+) {
+  /* The results for point i are stored in indexes[offsets[i]:offsets[i+1]]
+     and distances[offsets[i]:offsets[i+1]]. Returns the total number of
+     results. */
+  int i, counter;
+
+  counter = 0;
+  for (i = 0; i < m; i++) {
+    offsets[i] = counter;
+    kdtree_radius_node(cor, order, children, ranges, bounds, 0, points + 3*i, radius*radius, size, &counter, indexes, distances);
+  }
+  offsets[m] = counter;
+  return counter;
+}
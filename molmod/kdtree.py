@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Spatial index for nearest-neighbor queries in non-periodic systems
+
+   A k-d tree recursively splits a set of points into two halves, each time
+   along the direction with the largest extent. This makes it possible to
+   find the neighbors of an arbitrary point (e.g. a grid point) without
+   looping over all points. The tree is built once and can then be used for
+   any number of queries.
+
+   Example usage::
+
+       tree = KDTree(molecule.coordinates)
+       indexes, distances = tree.query_knn(point, 3)
+       indexes, distances = tree.query_radius(point, 5*angstrom)
+"""
+
+
+from molmod.ext import kdtree_build, kdtree_query_knn, kdtree_query_radius
+
+import numpy
+
+
+__all__ = ["KDTree"]
+
+
+class KDTree(object):
+    """A k-d tree for radius and k-nearest-neighbor queries
+
+       All queries return the indexes of the points and the distances to the
+       query point. The results of a single query are sorted by increasing
+       distance. Periodic boundary conditions are not supported, use
+       :class:`molmod.binning.PairSearchIntra` for pair searches in periodic
+       systems.
+    """
+
+    def __init__(self, coordinates, leafsize=16, subset=None):
+        """
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Optional arguments:
+            | ``leafsize``  --  The maximum number of points in a leaf of the
+                                tree. [default=16]
+            | ``subset``  --  An array with indexes of the points in
+                              ``coordinates`` that are included in the tree.
+                              The queries return indexes of the full set of
+                              coordinates. [default=all points]
+        """
+        if leafsize < 1:
+            raise ValueError("The leafsize must be strictly positive.")
+        coordinates = numpy.asarray(coordinates, float)
+        if subset is None:
+            self.subset = None
+        else:
+            self.subset = numpy.array(subset, int)
+            coordinates = coordinates[self.subset]
+        self.coordinates = numpy.array(coordinates, float, order='C')
+        self.leafsize = leafsize
+        self.size = len(self.coordinates)
+
+        order = numpy.zeros(self.size, numpy.int32)
+        # Every split creates two nodes that contain at least (leafsize+1)/2
+        # points.
+        maxnode = 2*(self.size/max(1, (leafsize+1)/2)) + 1
+        children = numpy.zeros((maxnode, 2), numpy.int32)
+        ranges = numpy.zeros((maxnode, 2), numpy.int32)
+        bounds = numpy.zeros((maxnode, 6), float)
+        if self.size > 0:
+            nnode = kdtree_build(self.coordinates, leafsize, order, children, ranges, bounds)
+            if nnode < 0:
+                raise RuntimeError("Could not build the k-d tree. This is a bug.")
+        else:
+            nnode = 0
+        self.order = order
+        self.children = children[:nnode]
+        self.ranges = ranges[:nnode]
+        self.bounds = bounds[:nnode]
+
+    def _to_points(self, points):
+        """Convert the argument into a Mx3 array of query points"""
+        points = numpy.array(points, float, order='C', ndmin=2)
+        if len(points.shape) != 2 or points.shape[1] != 3:
+            raise TypeError("The query points must be given as an Mx3 array.")
+        return points
+
+    def _map_indexes(self, indexes):
+        """Convert indexes in the tree into indexes of the original points"""
+        if self.subset is None:
+            return indexes.astype(int)
+        else:
+            return self.subset[indexes]
+
+    def query_knn_batch(self, points, k):
+        """Find the k nearest neighbors of a set of points
+
+           Arguments:
+            | ``points``  --  A Mx3 array with query points
+            | ``k``  --  The number of neighbors
+
+           Returns: ``indexes``, ``distances``. Both are Mxk arrays, sorted by
+           increasing distance along the second axis.
+        """
+        points = self._to_points(points)
+        if k < 1 or k > self.size:
+            raise ValueError("k must be in the range [1,%i]." % self.size)
+        indexes = numpy.zeros((len(points), k), numpy.int32)
+        distances = numpy.zeros((len(points), k), float)
+        if len(points) > 0:
+            kdtree_query_knn(
+                self.coordinates, self.order, self.children, self.ranges,
+                self.bounds, points, indexes, distances
+            )
+        return self._map_indexes(indexes), distances
+
+    def query_knn(self, point, k):
+        """Find the k nearest neighbors of a single point
+
+           Arguments:
+            | ``point``  --  A vector with three coordinates
+            | ``k``  --  The number of neighbors
+
+           Returns: ``indexes``, ``distances``, both arrays with length k,
+           sorted by increasing distance.
+        """
+        indexes, distances = self.query_knn_batch([point], k)
+        return indexes[0], distances[0]
+
+    def query_radius_batch(self, points, radius):
+        """Find all neighbors within a radius for a set of points
+
+           Arguments:
+            | ``points``  --  A Mx3 array with query points
+            | ``radius``  --  The radius of the spheres around the query points
+
+           Returns: ``offsets``, ``indexes``, ``distances``. The neighbors of
+           query point i are ``indexes[offsets[i]:offsets[i+1]]`` at the
+           distances ``distances[offsets[i]:offsets[i+1]]``. Within each
+           query, the results are sorted by increasing distance.
+        """
+        points = self._to_points(points)
+        offsets = numpy.zeros(len(points)+1, numpy.int32)
+        if self.size == 0 or len(points) == 0:
+            return offsets.astype(int), numpy.zeros(0, int), numpy.zeros(0, float)
+        size = max(16, 4*len(points))
+        while True:
+            indexes = numpy.zeros(size, numpy.int32)
+            distances = numpy.zeros(size, float)
+            count = kdtree_query_radius(
+                self.coordinates, self.order, self.children, self.ranges,
+                self.bounds, points, radius, offsets, indexes, distances
+            )
+            if count <= size:
+                break
+            size = count
+        indexes = indexes[:count]
+        distances = distances[:count]
+        # sort the results of each query by distance
+        segments = numpy.repeat(numpy.arange(len(points)), numpy.diff(offsets))
+        permutation = numpy.lexsort((distances, segments))
+        return offsets.astype(int), self._map_indexes(indexes[permutation]), distances[permutation]
+
+    def query_radius(self, point, radius):
+        """Find all neighbors within a radius of a single point
+
+           Arguments:
+            | ``point``  --  A vector with three coordinates
+            | ``radius``  --  The radius of the sphere around the query point
+
+           Returns: ``indexes``, ``distances``, sorted by increasing distance.
+        """
+        offsets, indexes, distances = self.query_radius_batch([point], radius)
+        return indexes, distances
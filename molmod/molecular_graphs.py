@@ -25,13 +25,14 @@
 
 from molmod.graphs import cached, Graph, CustomPattern
 from molmod.utils import ReadOnlyAttribute
-from molmod.binning import PairSearchIntra
+from molmod.binning import PairSearchIntra, NeighborList
+from molmod.units import angstrom
 
 import numpy
 
 
 __all__ = [
-    "MolecularGraph",
+    "MolecularGraph", "BondPerceiver",
     "HasAtomNumber", "HasNumNeighbors", "HasNeighborNumbers", "HasNeighbors",
     "BondLongerThan", "atom_criteria",
     "BondPattern", "BendingAnglePattern", "DihedralAnglePattern",
@@ -39,6 +40,73 @@ __all__ = [
 ]
 
 
+def _get_bond_thresholds(numbers, scaling=1.0):
+    """Return a table with the bond thresholds for the elements present
+
+       Argument:
+        | ``numbers``  --  the atomic numbers
+
+       Optional argument:
+        | ``scaling``  --  scale the threshold for the connectivity, see
+                           :meth:`MolecularGraph.from_geometry`
+
+       Returns: ``kinds``, ``thresholds``. The first is an integer array with
+       the index of the element of each atom. The second is a square array
+       with the longest distance at which two elements may be bonded.
+    """
+    from molmod.bonds import bonds, bond_types
+
+    elements, kinds = numpy.unique(numbers, return_inverse=True)
+    thresholds = numpy.zeros((len(elements), len(elements)), float)
+    for i0, n0 in enumerate(elements):
+        for i1, n1 in enumerate(elements):
+            max_length = 0.0
+            for bond_type in bond_types:
+                length = bonds.get_length(n0, n1, bond_type)
+                if length is not None and length > max_length:
+                    max_length = length
+            thresholds[i0, i1] = min(bonds.max_length, max_length*scaling)*bonds.bond_tolerance
+    return kinds, thresholds
+
+
+def _get_slated_bonds(c, ns, coordinates, unit_cell=None):
+    """Return the bonds of an atom that are too close to a shorter bond
+
+       Arguments:
+        | ``c``  --  the index of the central atom
+        | ``ns``  --  the indexes of the neighbors of the central atom
+        | ``coordinates``  --  the Cartesian coordinates of all atoms
+
+       Optional argument:
+        | ``unit_cell``  --  the periodic boundary conditions
+
+       If two bonds point in a direction that differs only by 45 deg. the
+       longest of the two is discarded. The double loop over the neighbors is
+       done such that the longest bonds are eliminated first. The result is a
+       set of pairs (c, n) of bonds that must be removed.
+    """
+    result = set([])
+    threshold = 0.5**0.5
+    lengths_ns = []
+    for n in ns:
+        delta = coordinates[n] - coordinates[c]
+        if unit_cell is not None:
+            delta = unit_cell.shortest_vector(delta)
+        length = numpy.linalg.norm(delta)
+        lengths_ns.append([length, delta, n])
+    lengths_ns.sort(reverse=True, cmp=(lambda r0, r1: cmp(r0[0], r1[0])))
+    for i0, (length0, delta0, n0) in enumerate(lengths_ns):
+        for i1, (length1, delta1, n1) in enumerate(lengths_ns[:i0]):
+            if length1 == 0.0:
+                continue
+            cosine = numpy.dot(delta0, delta1)/length0/length1
+            if cosine > threshold:
+                # length1 > length0
+                result.add((c,n1))
+                lengths_ns[i1][0] = 0.0
+    return result
+
+
 class MolecularGraph(Graph):
     """Describes a molecular graph: connectivity, atom numbers and bond orders.
 
@@ -78,7 +146,7 @@ class MolecularGraph(Graph):
         "atoms, which can be element names for force-field atom types")
 
     @classmethod
-    def from_geometry(cls, molecule, do_orders=False, scaling=1.0):
+    def from_geometry(cls, molecule, do_orders=False, scaling=1.0, workers=1):
         """Construct a MolecularGraph object based on interatomic distances
 
            All short distances are computed with the binning module and compared
@@ -93,27 +161,36 @@ class MolecularGraph(Graph):
             | ``scaling``  --  scale the threshold for the connectivity. increase
                                this to 1.5 in case of transition states when a
                                fully connected topology is required.
+            | ``workers``  --  the number of threads used to search for short
+                               distances.
         """
         from molmod.bonds import bonds
 
         unit_cell = molecule.unit_cell
-        pair_search = PairSearchIntra(
-            molecule.coordinates,
-            bonds.max_length*bonds.bond_tolerance,
-            unit_cell
-        )
+
+        # Only search for pairs that are short enough to be a bond between
+        # the elements that are present in the molecule.
+        kinds, thresholds = _get_bond_thresholds(molecule.numbers, scaling)
+        cutoff = thresholds.max() if len(thresholds) > 0 else 0.0
 
         orders = []
         lengths = []
         edges = []
 
-        for i0, i1, delta, distance in pair_search:
-            bond_order = bonds.bonded(molecule.numbers[i0], molecule.numbers[i1], distance/scaling)
-            if bond_order is not None:
-                if do_orders:
-                    orders.append(bond_order)
-                lengths.append(distance)
-                edges.append((i0,i1))
+        if cutoff > 0:
+            i0s, i1s, deltas, distances = PairSearchIntra(
+                molecule.coordinates, cutoff, unit_cell, workers=workers
+            ).get_arrays()
+            # Only the pairs below the threshold for their elements can be
+            # bonded. The bond type is only estimated for these pairs.
+            mask = distances < thresholds[kinds[i0s], kinds[i1s]]
+            for i0, i1, distance in zip(i0s[mask], i1s[mask], distances[mask]):
+                bond_order = bonds.bonded(molecule.numbers[i0], molecule.numbers[i1], distance/scaling)
+                if bond_order is not None:
+                    if do_orders:
+                        orders.append(bond_order)
+                    lengths.append(distance)
+                    edges.append((int(i0), int(i1)))
 
         if do_orders:
             result = cls(edges, molecule.numbers, orders, symbols=molecule.symbols)
@@ -121,29 +198,10 @@ class MolecularGraph(Graph):
             result = cls(edges, molecule.numbers, symbols=molecule.symbols)
 
         # run a check on all neighbors. if two bonds point in a direction that
-        # differs only by 45 deg. the longest of the two is discarded. the
-        # double loop over the neighbors is done such that the longest bonds
-        # are eliminated first
+        # differs only by 45 deg. the longest of the two is discarded.
         slated_for_removal = set([])
-        threshold = 0.5**0.5
         for c, ns in result.neighbors.iteritems():
-            lengths_ns = []
-            for n in ns:
-                delta = molecule.coordinates[n] - molecule.coordinates[c]
-                if unit_cell is not None:
-                    delta = unit_cell.shortest_vector(delta)
-                length = numpy.linalg.norm(delta)
-                lengths_ns.append([length, delta, n])
-            lengths_ns.sort(reverse=True, cmp=(lambda r0, r1: cmp(r0[0], r1[0])))
-            for i0, (length0, delta0, n0) in enumerate(lengths_ns):
-                for i1, (length1, delta1, n1) in enumerate(lengths_ns[:i0]):
-                    if length1 == 0.0:
-                        continue
-                    cosine = numpy.dot(delta0, delta1)/length0/length1
-                    if cosine > threshold:
-                        # length1 > length0
-                        slated_for_removal.add((c,n1))
-                        lengths_ns[i1][0] = 0.0
+            slated_for_removal.update(_get_slated_bonds(c, ns, molecule.coordinates, unit_cell))
         # construct a mask
         mask = numpy.ones(len(edges), bool)
         for i0, i1 in slated_for_removal:
@@ -154,7 +212,7 @@ class MolecularGraph(Graph):
         # actual removal
         edges = [edges[i] for i in xrange(len(edges)) if mask[i]]
         if do_orders:
-            bond_order = [bond_order[i] for i in xrange(len(bond_order)) if mask[i]]
+            orders = [orders[i] for i in xrange(len(orders)) if mask[i]]
             result = cls(edges, molecule.numbers, orders)
         else:
             result = cls(edges, molecule.numbers)
@@ -215,10 +273,8 @@ class MolecularGraph(Graph):
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
         # copy edges
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([vertex1+i*self.num_vertices, vertex2+i*self.num_vertices]))
+        shifts = numpy.arange(repeat).reshape(-1, 1, 1)*self.num_vertices
+        new_edges = (self.edge_array + shifts).reshape(-1, 2)
         # copy numbers
         new_numbers = numpy.zeros((repeat, len(self.numbers)), int)
         new_numbers[:] = self.numbers
@@ -261,6 +317,20 @@ class MolecularGraph(Graph):
             # pad with zeros to make sure that string sort is identical to number sort
             return "%03i" % order
 
+    def get_vertex_strings(self):
+        """Return the strings of all atoms, formatted once per atom number"""
+        if self.num_vertices == 0:
+            return []
+        unique, first, inverse = numpy.unique(self.numbers, return_index=True, return_inverse=True)
+        return numpy.array([self.get_vertex_string(i) for i in first])[inverse]
+
+    def get_edge_strings(self):
+        """Return the strings of all bonds, formatted once per bond order"""
+        if self.num_edges == 0:
+            return []
+        unique, first, inverse = numpy.unique(self.orders, return_index=True, return_inverse=True)
+        return numpy.array([self.get_edge_string(i) for i in first])[inverse]
+
     def get_subgraph(self, subvertices, normalize=False):
         """Creates a subgraph of the current graph
 
@@ -278,7 +348,7 @@ class MolecularGraph(Graph):
         else:
             new_symbols = self.symbols
         new_orders = self.orders[graph._old_edge_indexes]
-        result = MolecularGraph(graph.edges, new_numbers, new_orders, new_symbols)
+        result = MolecularGraph(graph.edge_array, new_numbers, new_orders, new_symbols)
         if normalize:
             result._old_vertex_indexes = graph._old_vertex_indexes
         result._old_edge_indexes = graph._old_edge_indexes
@@ -334,6 +404,159 @@ class MolecularGraph(Graph):
 
 # basic criteria for molecular patterns
 
+class BondPerceiver(object):
+    """Incremental detection of bonds along a trajectory
+
+       Example usage::
+
+           perceiver = BondPerceiver(molecule.numbers, skin=1.0*angstrom)
+           for coordinates in frames:
+               formed, broken = perceiver.update(coordinates)
+               for i0, i1 in formed:
+                   print "New bond", i0, i1
+
+       The bonds are detected with the same criteria as in
+       :meth:`MolecularGraph.from_geometry`. Candidate pairs are kept in a
+       :class:`molmod.binning.NeighborList`. In each frame, the distances of
+       all candidate pairs are compared with the bond thresholds in one
+       vectorized step, and so are the angles between bonds with a common
+       atom. The expensive 45 deg. check for bonds that point in the same
+       direction is only carried out for the few atoms that are involved in
+       a bond that changes or in an angle below 45 deg.
+    """
+
+    def __init__(self, numbers, graph=None, unit_cell=None, scaling=1.0, skin=0.5*angstrom, workers=1):
+        """
+           Argument:
+            | ``numbers``  --  The atom numbers
+
+           Optional arguments:
+            | ``graph``  --  The molecular graph of the previous frame. When
+                             given, the events of the first update are relative
+                             to this graph. [default=no bonds]
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``scaling``  --  scale the threshold for the connectivity, see
+                               :meth:`MolecularGraph.from_geometry`
+            | ``skin``  --  The skin of the neighbor list
+            | ``workers``  --  the number of threads used to search for short
+                               distances.
+        """
+        self.numbers = numpy.array(numbers, int)
+        self.unit_cell = unit_cell
+        self.scaling = scaling
+
+        # A table with the bond thresholds for all pairs of elements that are
+        # present, the same as in MolecularGraph.from_geometry. The thresholds
+        # are looked up through the array _kinds.
+        self._kinds, self._thresholds = _get_bond_thresholds(self.numbers, scaling)
+        cutoff = self._thresholds.max() if len(self._thresholds) > 0 else 0.0
+        self.neighbor_list = NeighborList(cutoff, skin, unit_cell, workers=workers)
+
+        # The bonds without the 45 deg. check, as a set of sorted pairs.
+        self._raw = set([])
+        # The bonds removed by the 45 deg. check, for each central atom.
+        self._removed = {}
+        if graph is None:
+            self._edges = set([])
+        else:
+            self._edges = set(tuple(sorted(edge)) for edge in graph.edges)
+            self._raw.update(self._edges)
+        self._graph = graph
+        self._update_angles()
+
+    def _update_angles(self):
+        """Collect all pairs of bonds with a common atom
+
+           The result is stored as three integer arrays in self._angles: the
+           common atoms and the other atoms of both bonds.
+        """
+        self._neighbors = {}
+        for i0, i1 in self._raw:
+            self._neighbors.setdefault(i0, []).append(i1)
+            self._neighbors.setdefault(i1, []).append(i0)
+        angles = []
+        for c, ns in self._neighbors.iteritems():
+            for j0 in xrange(len(ns)):
+                for j1 in xrange(j0):
+                    angles.append((c, ns[j0], ns[j1]))
+        angles = numpy.array(angles, int).reshape(-1, 3)
+        self._angles = angles[:,0], angles[:,1], angles[:,2]
+
+    def _get_graph(self):
+        """the molecular graph of the last frame"""
+        if self._graph is None:
+            self._graph = MolecularGraph(sorted(self._edges), self.numbers)
+        return self._graph
+
+    graph = property(_get_graph)
+
+    def update(self, coordinates):
+        """Detect the changes in the bonds for a new frame
+
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Returns: ``formed``, ``broken``. Both are sorted lists with pairs of
+           atom indexes, (i0, i1) with i0 < i1, of the bonds that are formed
+           or broken since the previous frame.
+        """
+        self.neighbor_list.update(coordinates)
+        i0s, i1s, deltas, distances = self.neighbor_list.get_arrays()
+        mask = distances < self._thresholds[self._kinds[i0s], self._kinds[i1s]]
+        # the bonds without the 45 deg. check
+        raw = set(zip(
+            numpy.minimum(i0s[mask], i1s[mask]).tolist(),
+            numpy.maximum(i0s[mask], i1s[mask]).tolist(),
+        ))
+
+        changed = raw ^ self._raw
+        if len(changed) > 0:
+            self._raw = raw
+            self._update_angles()
+
+        # The 45 deg. check is only repeated for atoms involved in a bond that
+        # changed, for atoms with two bonds within 45 deg. and for atoms that
+        # had such bonds in the previous frame.
+        centers, others0, others1 = self._angles
+        if len(centers) > 0:
+            deltas0 = coordinates[others0] - coordinates[centers]
+            deltas1 = coordinates[others1] - coordinates[centers]
+            if self.unit_cell is not None:
+                deltas0 = self.unit_cell.shortest_vector(deltas0)
+                deltas1 = self.unit_cell.shortest_vector(deltas1)
+            cosines = (deltas0*deltas1).sum(axis=1)/numpy.sqrt(
+                (deltas0*deltas0).sum(axis=1)*(deltas1*deltas1).sum(axis=1)
+            )
+            suspects = set(centers[cosines > 0.5**0.5].tolist())
+        else:
+            suspects = set([])
+        for i0, i1 in changed:
+            suspects.add(i0)
+            suspects.add(i1)
+        suspects.update(self._removed)
+        if len(suspects) == 0:
+            return [], []
+        for c in suspects:
+            ns = self._neighbors.get(c)
+            removed = None
+            if ns is not None:
+                removed = _get_slated_bonds(c, ns, coordinates, self.unit_cell)
+            if removed:
+                self._removed[c] = set(tuple(sorted(pair)) for pair in removed)
+            else:
+                self._removed.pop(c, None)
+
+        edges = raw.copy()
+        for pairs in self._removed.itervalues():
+            edges -= pairs
+        formed = sorted(edges - self._edges)
+        broken = sorted(self._edges - edges)
+        if len(formed) > 0 or len(broken) > 0:
+            self._edges = edges
+            self._graph = None
+        return formed, broken
+
+
 class HasAtomNumber(object):
     """Criterion for the atom number of a vertex"""
 
@@ -39,3 +39,19 @@ void molecules_distance_matrix(int n, double *cor, int periodic, double *matrix,
     }
   }
 }
+
+void molecules_distance_matrix_float(int n, float *cor, int periodic, double *matrix, double *reciprocal, float *dm) {
+  int i, j;
+  float d;
+  for (i=0; i<n; i++) {
+    for (j=0; j<i; j++) {
+      if (periodic) {
+        d = distance_periodic_float(cor + 3*i, cor + 3*j, matrix, reciprocal);
+      } else {
+        d = distance_float(cor + 3*i, cor + 3*j);
+      }
+      dm[i*n+j] = d;
+      dm[j*n+i] = d;
+    }
+  }
+}
@@ -83,8 +83,8 @@ class Molecule(ReadOnly):
     numbers = ReadOnlyAttribute(numpy.ndarray, none=False, npdim=1, npdtype=int,
         doc="the atomic numbers")
     coordinates = ReadOnlyAttribute(numpy.ndarray, npdim=2, npshape=(None,3),
-        npdtype=float, check=_check_coordinates, doc="atomic Cartesian "
-        "coordinates")
+        npdtype=float, allow_float32=True, check=_check_coordinates,
+        doc="atomic Cartesian coordinates")
     title = ReadOnlyAttribute(basestring, doc="a short description of the system")
     masses = ReadOnlyAttribute(numpy.ndarray, npdim=1, npdtype=float,
         check=_check_masses, doc="the atomic masses")
@@ -160,10 +160,45 @@ class Molecule(ReadOnly):
 
     @cached
     def distance_matrix(self):
-        """the matrix with all atom pair distances"""
+        """the matrix with all atom pair distances
+
+           When the coordinates are stored in single precision (float32), e.g.
+           frames read with :class:`molmod.io.gromacs.GroReader`, the distance
+           matrix is also computed and stored in single precision. This avoids
+           a conversion of the coordinates and halves the memory usage.
+        """
+        if self.coordinates.dtype == numpy.float32:
+            from molmod.ext import molecules_distance_matrix_float
+            return molecules_distance_matrix_float(self.coordinates)
         from molmod.ext import molecules_distance_matrix
         return molecules_distance_matrix(self.coordinates)
 
+    @cached
+    def kdtree(self):
+        """a k-d tree for nearest-neighbor queries on the atoms
+
+           See :class:`molmod.kdtree.KDTree`. Periodic boundary conditions are
+           not taken into account.
+        """
+        from molmod.kdtree import KDTree
+        return KDTree(self.coordinates)
+
+    @cached
+    def element_kdtrees(self):
+        """a dictionary with a k-d tree for the atoms of each element
+
+           The keys are atom numbers. The indexes returned by the queries
+           refer to atoms in the molecule. Example::
+
+               indexes, distances = mol.element_kdtrees[8].query_knn(point, 1)
+        """
+        from molmod.kdtree import KDTree
+        result = {}
+        for number in numpy.unique(self.numbers):
+            subset = (self.numbers == number).nonzero()[0]
+            result[number] = KDTree(self.coordinates, subset=subset)
+        return result
+
     @cached
     def mass(self):
         """the total mass of the molecule"""
@@ -27,13 +27,53 @@
 """
 
 import numpy as np
+import threading
 
 
 __all__ = [
-    "PairFF", "CoulombFF", "DispersionFF", "PauliFF", "ExpRepFF",
+    "get_dense_geometry", "PairFF", "CoulombFF", "DispersionFF", "PauliFF", "ExpRepFF",
 ]
 
 
+def _get_pair_values(values, index1, index2):
+    """Look up pair parameters
+
+       Arguments:
+         values  --  an NxN array with a value for each pair of atoms or a
+                     tuple (types, table), where types is an array with an
+                     atom type for each atom and table is a matrix with a
+                     value for each pair of atom types
+         index1, index2  --  atom indexes or arrays with atom indexes
+    """
+    if isinstance(values, tuple):
+        types, table = values
+        return table[types[index1], types[index2]]
+    else:
+        return values[index1, index2]
+
+
+def get_dense_geometry(coordinates):
+    """Compute the relative vectors and distances between all atoms
+
+       Argument:
+         coordinates  --  Nx3 array with Cartesian coordinates
+
+       Returns: deltas, distances, directions, dirouters. These are NxNx3,
+       NxN, NxNx3 and NxNx3x3 arrays with the relative vectors (r_i - r_j),
+       the distances, the unit vectors along the relative vectors and their
+       outer products.
+    """
+    size = len(coordinates)
+    deltas = coordinates.reshape((-1, 1, 3)) - coordinates
+    distances = np.sqrt((deltas**2).sum(axis=2))
+    # avoid the division by zero on the diagonal, where the deltas are zero
+    tmp = distances.copy()
+    tmp.ravel()[::size+1] = 1
+    directions = deltas/tmp.reshape((size, size, 1))
+    dirouters = directions.reshape((size, size, 3, 1))*directions.reshape((size, size, 1, 3))
+    return deltas, distances, directions, dirouters
+
+
 class PairFF(object):
     """Evaluates the energy, gradient and Hessian of pairwise potential
 
@@ -42,48 +82,105 @@ class PairFF(object):
        In the derived classes one must provide functions that iterate over all
        the corresponding function values, derivatives and second derivatives of
        s and v for a given r_ij.
+
+       The methods energy, gradient and hessian evaluate all pairs at once with
+       numpy arrays. For this purpose, derived classes should also implement
+       the methods yield_pair_energy_arrays, yield_pair_gradient_arrays and
+       yield_pair_hessian_arrays, which are vectorized versions of the per-pair
+       methods. The default implementations of the array methods just call the
+       per-pair methods for each pair.
+
+       By default, all pairs of atoms are included and the relative vectors
+       and distances are stored as dense NxN arrays. When a cutoff is given,
+       only the pairs within the cutoff are included and stored as compact
+       pair arrays. This makes it possible to treat large systems. The per-pair
+       methods (yield_pair_*, *_component) are only available in the dense
+       mode.
     """
 
-    def __init__(self, scaling, coordinates=None):
+    def __init__(self, scaling, coordinates=None, cutoff=None, unit_cell=None, workers=1):
         """Initialize a pair potential object
 
            Arguments:
              scaling  --  symmetric NxN array with pairwise scaling factors.
                           When an element is set to zero, it will be excluded.
+                          In the cutoff mode, one may also give a tuple
+                          (types, table), see below, or None to include all
+                          pairs with a scaling factor of one.
 
            Optional argument:
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+             cutoff  --  when given, only pairs with a distance below the
+                         cutoff are included
+             unit_cell  --  the periodic boundary conditions, only supported
+                            in combination with a cutoff
+             workers  --  the number of threads used for the pair search in
+                          the cutoff mode
+
+           Pairwise parameters of derived classes can be given as a tuple
+           (types, table) instead of an NxN array. The first element is an
+           array with an integer atom type for each atom. The second is a
+           matrix with a parameter for each pair of atom types.
         """
+        if unit_cell is not None and cutoff is None:
+            raise ValueError("Periodic boundary conditions require a cutoff.")
+        self.cutoff = cutoff
+        self.unit_cell = unit_cell
+        self.workers = workers
+        self.scaling = scaling
+        if isinstance(self.scaling, np.ndarray):
+            self.scaling.ravel()[::len(self.scaling)+1] = 0
+        elif cutoff is None:
+            raise TypeError("Without a cutoff, the scaling must be an NxN array.")
         if coordinates is not None:
             self.update_coordinates(coordinates)
-        self.scaling = scaling
-        self.scaling.ravel()[::len(self.scaling)+1] = 0
 
-    def update_coordinates(self, coordinates=None):
+    def update_coordinates(self, coordinates=None, geometry=None):
         """Update the coordinates (and derived quantities)
 
            Argument:
              coordinates  --  new Cartesian coordinates of the system
+
+           Optional argument:
+             geometry  --  precomputed geometric quantities, which are
+                           otherwise computed from scratch. In the dense mode,
+                           this is the return value of get_dense_geometry. In
+                           the cutoff mode, this is a tuple (index1, index2,
+                           deltas, distances) as returned by the get_arrays
+                           method of PairSearchIntra or NeighborList, with a
+                           cutoff not smaller than the one of this object.
+                           This makes it possible to share the geometry
+                           between several force fields, see
+                           :class:`molmod.compositeff.CompositeFF`.
+
+           In the dense mode, the NxN arrays deltas, distances, directions
+           and dirouters are computed. In the cutoff mode, the arrays
+           pair_indexes, pair_deltas and pair_distances contain the atom
+           indexes, the relative vectors (r_i - r_j) and the distances of
+           all pairs within the cutoff. Each pair is included once.
         """
         if coordinates is not None:
             self.coordinates = coordinates
         self.numc = len(self.coordinates)
-        self.distances = np.zeros((self.numc, self.numc), float)
-        self.deltas = np.zeros((self.numc, self.numc, 3), float)
-        self.directions = np.zeros((self.numc, self.numc, 3), float)
-        self.dirouters = np.zeros((self.numc, self.numc, 3, 3), float)
-        for index1, coordinate1 in enumerate(self.coordinates):
-            for index2, coordinate2 in enumerate(self.coordinates):
-                delta = coordinate1 - coordinate2
-                self.deltas[index1, index2] = delta
-                distance = np.linalg.norm(delta)
-                self.distances[index1, index2] = distance
-                if index1 != index2:
-                    tmp = delta/distance
-                    self.directions[index1, index2] = tmp
-                    self.dirouters[index1, index2] = np.outer(tmp, tmp)
+        if self.cutoff is None:
+            if geometry is None:
+                geometry = get_dense_geometry(self.coordinates)
+            self.deltas, self.distances, self.directions, self.dirouters = geometry
+        else:
+            if geometry is None:
+                from molmod.binning import PairSearchIntra
+                geometry = PairSearchIntra(
+                    self.coordinates, self.cutoff, self.unit_cell,
+                    workers=self.workers
+                ).get_arrays()
+            index1, index2, deltas, distances = geometry
+            # the pair search returns the relative vectors r_j - r_i
+            mask = (distances <= self.cutoff) & (self._get_scaling(index1, index2) > 0)
+            self.pair_indexes = index1[mask], index2[mask]
+            self.pair_deltas = -deltas[mask]
+            self.pair_distances = distances[mask]
 
     def yield_pair_energies(self, index1, index2):
         """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
@@ -97,16 +194,203 @@ class PairFF(object):
         """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
         raise NotImplementedError
 
+    def _iter_arrays(self, yield_pair, index1, index2):
+        """Collect the results of a per-pair method into arrays"""
+        terms = zip(*[list(yield_pair(i1, i2)) for i1, i2 in zip(index1, index2)])
+        for term in terms:
+            s, v = zip(*term)
+            yield np.array(s, float), np.array(v, float)
+
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of pairs
+
+           Arguments:
+             index1, index2  --  arrays with the atom indexes of the pairs
+             deltas  --  the relative vectors r_i - r_j of the pairs
+             distances  --  the distances of the pairs
+
+           The radial parts are arrays with one value per pair. The angular
+           parts are arrays with one value per pair, or a constant that is the
+           same for all pairs.
+        """
+        return self._iter_arrays(self.yield_pair_energies, index1, index2)
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of pairs
+
+           See yield_pair_energy_arrays. The angular parts are Px3 arrays or
+           a constant vector.
+        """
+        return self._iter_arrays(self.yield_pair_gradients, index1, index2)
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of pairs
+
+           See yield_pair_energy_arrays. The angular parts are Px3x3 arrays or
+           a constant matrix.
+        """
+        return self._iter_arrays(self.yield_pair_hessians, index1, index2)
+
+    def _get_scaling(self, index1, index2):
+        """Return the scaling factors for arrays of pairs"""
+        if self.scaling is None:
+            return np.ones(len(index1), float)
+        else:
+            return _get_pair_values(self.scaling, index1, index2)
+
+    def _get_pairs(self, ordered=True):
+        """Return all pairs with a non-zero scaling
+
+           Optional argument:
+             ordered  --  when True, both (i,j) and (j,i) are included.
+                          Otherwise, each pair is only included once.
+
+           Returns: index1, index2, deltas, distances
+        """
+        if self.cutoff is None:
+            index1, index2 = (self.scaling > 0).nonzero()
+            if not ordered:
+                mask = index2 < index1
+                index1 = index1[mask]
+                index2 = index2[mask]
+            return index1, index2, self.deltas[index1, index2], self.distances[index1, index2]
+        else:
+            index1, index2 = self.pair_indexes
+            if ordered:
+                return (
+                    np.concatenate([index1, index2]),
+                    np.concatenate([index2, index1]),
+                    np.concatenate([self.pair_deltas, -self.pair_deltas]),
+                    np.concatenate([self.pair_distances, self.pair_distances]),
+                )
+            else:
+                return index1, index2, self.pair_deltas, self.pair_distances
+
     def energy(self):
         """Compute the energy of the system"""
+        index1, index2, deltas, distances = self._get_pairs(ordered=False)
+        scaling = self._get_scaling(index1, index2)
         result = 0.0
-        for index1 in xrange(self.numc):
-            for index2 in xrange(index1):
-                if self.scaling[index1, index2] > 0:
-                    for se, ve in self.yield_pair_energies(index1, index2):
-                        result += se*ve*self.scaling[index1, index2]
+        for se, ve in self.yield_pair_energy_arrays(index1, index2, deltas, distances):
+            result += (se*ve*scaling).sum()
         return result
 
+    def _pair_gradients(self, index1, index2, deltas, distances):
+        """Compute the gradient contribution of each pair to the first atom"""
+        scaling = self._get_scaling(index1, index2).reshape(-1, 1)
+        directions = deltas/distances.reshape(-1, 1)
+        result = np.zeros((len(index1), 3), float)
+        for (se, ve), (sg, vg) in zip(
+            self.yield_pair_energy_arrays(index1, index2, deltas, distances),
+            self.yield_pair_gradient_arrays(index1, index2, deltas, distances)
+        ):
+            ve = np.asarray(ve)[..., None]
+            result += (sg.reshape(-1, 1)*directions*ve + se.reshape(-1, 1)*vg)*scaling
+        return result
+
+    def _pair_hessians(self, index1, index2, deltas, distances):
+        """Compute the Hessian block of each pair (first atom, first atom)"""
+        scaling = self._get_scaling(index1, index2).reshape(-1, 1, 1)
+        d_1 = 1/distances.reshape(-1, 1, 1)
+        directions = deltas/distances.reshape(-1, 1)
+        dirouters = directions[:, :, None]*directions[:, None, :]
+        result = np.zeros((len(index1), 3, 3), float)
+        for (se, ve), (sg, vg), (sh, vh) in zip(
+            self.yield_pair_energy_arrays(index1, index2, deltas, distances),
+            self.yield_pair_gradient_arrays(index1, index2, deltas, distances),
+            self.yield_pair_hessian_arrays(index1, index2, deltas, distances)
+        ):
+            se = se.reshape(-1, 1, 1)
+            sg = sg.reshape(-1, 1, 1)
+            sh = sh.reshape(-1, 1, 1)
+            ve = np.asarray(ve)[..., None, None]
+            vg = np.asarray(vg)
+            result += (
+                +sh*dirouters*ve
+                +sg*(np.identity(3, float) - dirouters)*ve*d_1
+                +sg*directions[:, :, None]*vg[..., None, :]
+                +sg*vg[..., :, None]*directions[:, None, :]
+                +se*vh
+            )*scaling
+        return result
+
+    def _get_batch_pairs(self, coordinates):
+        """Return all ordered pairs of a stack of geometries
+
+           Argument:
+             coordinates  --  an MxNx3 array with Cartesian coordinates
+
+           Returns: structs, index1, index2, deltas, distances. The first
+           array contains the index of the geometry of each pair.
+        """
+        size, numc = coordinates.shape[:2]
+        if self.cutoff is None:
+            index1, index2 = (self.scaling > 0).nonzero()
+            structs = np.repeat(np.arange(size), len(index1))
+            deltas = (coordinates[:, index1] - coordinates[:, index2]).reshape(-1, 3)
+            index1 = np.tile(index1, size)
+            index2 = np.tile(index2, size)
+        else:
+            from molmod.binning import PairSearchIntra
+            all_pairs = []
+            for i in xrange(size):
+                index1, index2, deltas, distances = PairSearchIntra(
+                    coordinates[i], self.cutoff, self.unit_cell,
+                    workers=self.workers
+                ).get_arrays()
+                mask = (distances <= self.cutoff) & (self._get_scaling(index1, index2) > 0)
+                index1 = index1[mask]
+                index2 = index2[mask]
+                # the pair search returns the relative vectors r_j - r_i
+                deltas = -deltas[mask]
+                all_pairs.append((
+                    np.zeros(2*len(index1), int) + i,
+                    np.concatenate([index1, index2]),
+                    np.concatenate([index2, index1]),
+                    np.concatenate([deltas, -deltas]),
+                ))
+            structs, index1, index2, deltas = [np.concatenate(arrays) for arrays in zip(*all_pairs)]
+            deltas = deltas.reshape(-1, 3)
+        distances = np.sqrt((deltas*deltas).sum(axis=1))
+        return structs, index1, index2, deltas, distances
+
+    def batch(self, coordinates, do_gradient=False):
+        """Compute the energies (and gradients) of a stack of geometries
+
+           Argument:
+             coordinates  --  an MxNx3 array with the Cartesian coordinates of
+                              M geometries of the same system
+
+           Optional argument:
+             do_gradient  --  when set to True, an MxNx3 array with the
+                              gradients is also returned. [default=False]
+
+           Returns: an array with M energies (and the gradients). The pairs of
+           all geometries are evaluated together with the array methods,
+           instead of calling update_coordinates, energy and gradient for
+           each geometry. The state of this object is not changed. This
+           requires array methods that only depend on their arguments, which
+           is the case for all force fields in this module.
+        """
+        coordinates = np.asarray(coordinates, float)
+        size, numc = coordinates.shape[:2]
+        structs, index1, index2, deltas, distances = self._get_batch_pairs(coordinates)
+        # each pair is included twice for the gradient, but only once for
+        # the energy
+        mask = index2 < index1
+        scaling = self._get_scaling(index1[mask], index2[mask])
+        energies = np.zeros(size, float)
+        for se, ve in self.yield_pair_energy_arrays(index1[mask], index2[mask], deltas[mask], distances[mask]):
+            energies += np.bincount(structs[mask], se*ve*scaling, minlength=size)
+        if not do_gradient:
+            return energies
+        pair_gradients = self._pair_gradients(index1, index2, deltas, distances)
+        gradients = np.zeros((size*numc, 3), float)
+        keys = structs*numc + index1
+        for j in xrange(3):
+            gradients[:, j] = np.bincount(keys, pair_gradients[:, j], minlength=size*numc)
+        return energies, gradients.reshape(size, numc, 3)
+
     def gradient_component(self, index1):
         """Compute the gradient of the energy for one atom"""
         result = np.zeros(3, float)
@@ -118,9 +402,11 @@ class PairFF(object):
 
     def gradient(self):
         """Compute the gradient of the energy for all atoms"""
+        index1, index2, deltas, distances = self._get_pairs()
+        pair_gradients = self._pair_gradients(index1, index2, deltas, distances)
         result = np.zeros((self.numc, 3), float)
-        for index1 in xrange(self.numc):
-            result[index1] = self.gradient_component(index1)
+        for j in xrange(3):
+            result[:, j] = np.bincount(index1, pair_gradients[:, j], minlength=self.numc)
         return result
 
     def hessian_component(self, index1, index2):
@@ -158,12 +444,36 @@ class PairFF(object):
                 )*self.scaling[index1, index2]
         return result
 
+    def hessian_sparse(self):
+        """Compute the hessian of the energy in a sparse block format
+
+           Returns: offsets, columns, blocks. The non-zero 3x3 blocks of the
+           Hessian in block row i are blocks[offsets[i]:offsets[i+1]]. The
+           corresponding block columns are columns[offsets[i]:offsets[i+1]].
+           Within each row, the columns are sorted. Only the blocks of the
+           pairs with a non-zero scaling and the diagonal blocks are present.
+        """
+        index1, index2, deltas, distances = self._get_pairs()
+        pair_hessians = self._pair_hessians(index1, index2, deltas, distances)
+        diagonal = np.zeros((self.numc, 3, 3), float)
+        for j in xrange(3):
+            for k in xrange(3):
+                diagonal[:, j, k] = np.bincount(index1, pair_hessians[:, j, k], minlength=self.numc)
+        rows = np.concatenate([index1, np.arange(self.numc)])
+        columns = np.concatenate([index2, np.arange(self.numc)])
+        blocks = np.concatenate([-pair_hessians, diagonal])
+        order = np.lexsort((columns, rows))
+        offsets = np.zeros(self.numc+1, int)
+        offsets[1:] = np.bincount(rows, minlength=self.numc).cumsum()
+        return offsets, columns[order], blocks[order]
+
     def hessian(self):
         """Compute the hessian of the energy"""
+        offsets, columns, blocks = self.hessian_sparse()
+        rows = np.repeat(np.arange(self.numc), np.diff(offsets))
         result = np.zeros((self.numc, 3, self.numc, 3), float)
-        for index1 in xrange(self.numc):
-            for index2 in xrange(self.numc):
-                result[index1, :, index2, :] = self.hessian_component(index1, index2)
+        # a view with the 3x3 blocks as the last two axes
+        result.transpose(0, 2, 1, 3)[rows, columns] = blocks
         return result
 
     def gradient_flat(self):
@@ -178,7 +488,7 @@ class PairFF(object):
 class CoulombFF(PairFF):
     """Computes the electrostatic interactions using charges and point dipoles"""
 
-    def __init__(self, scaling, charges=None, dipoles=None, coordinates=None):
+    def __init__(self, scaling, charges=None, dipoles=None, coordinates=None, cutoff=None, unit_cell=None, workers=1):
         """Initialize a CoulombFF object
 
            Arguments:
@@ -191,8 +501,9 @@ class CoulombFF(PairFF):
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+             cutoff, unit_cell, workers  --  see PairFF
         """
-        PairFF.__init__(self, scaling, coordinates)
+        PairFF.__init__(self, scaling, coordinates, cutoff, unit_cell, workers)
         self.charges = charges
         self.dipoles = dipoles
 
@@ -253,17 +564,133 @@ class CoulombFF(PairFF):
                 yield 12*c1*d_5, np.zeros((3, 3))
                 yield 12*c2*d_5, np.zeros((3, 3))
 
-    def esp_point(self, point):
-        result = 0.0
-        for index2 in xrange(self.numc):
-            delta = point - self.coordinates[index2]
-            d = np.linalg.norm(delta)
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of pairs"""
+        d_1 = 1/distances
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield c1*c2*d_1, 1
+        if self.dipoles is not None:
+            d_3 = d_1**3
+            d_5 = d_1**5
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            yield d_3*(p1*p2).sum(axis=1), 1
+            yield -3*d_5, (p1*deltas).sum(axis=1)*(deltas*p2).sum(axis=1)
             if self.charges is not None:
-                result += self.charges[index2]/d
-            if self.dipoles is not None:
-                direction = delta/d
-                result += np.dot(self.dipoles[index2], direction)/d**2
-        return result
+                yield c1*d_3, (p2*deltas).sum(axis=1)
+                yield c2*d_3, -(p1*deltas).sum(axis=1)
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of pairs"""
+        d_2 = 1/distances**2
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield -c1*c2*d_2, np.zeros(3)
+        if self.dipoles is not None:
+            d_4 = d_2**2
+            d_6 = d_2**3
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            yield -3*d_4*(p1*p2).sum(axis=1), np.zeros(3)
+            yield 15*d_6, p1*(p2*deltas).sum(axis=1).reshape(-1, 1) + p2*(p1*deltas).sum(axis=1).reshape(-1, 1)
+            if self.charges is not None:
+                yield -3*c1*d_4, p2
+                yield -3*c2*d_4, -p1
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of pairs"""
+        d_1 = 1/distances
+        d_3 = d_1**3
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield 2*c1*c2*d_3, np.zeros((3, 3))
+        if self.dipoles is not None:
+            d_5 = d_1**5
+            d_7 = d_1**7
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            yield 12*d_5*(p1*p2).sum(axis=1), np.zeros((3, 3))
+            outer = p1[:, :, None]*p2[:, None, :]
+            yield -90*d_7, outer + outer.transpose(0, 2, 1)
+            if self.charges is not None:
+                yield 12*c1*d_5, np.zeros((3, 3))
+                yield 12*c2*d_5, np.zeros((3, 3))
+
+    def update_coordinates(self, coordinates=None, geometry=None):
+        """Update the coordinates (and derived quantities)
+
+           Argument:
+             coordinates  --  new Cartesian coordinates of the system
+
+           Optional argument:
+             geometry  --  see :meth:`PairFF.update_coordinates`
+        """
+        PairFF.update_coordinates(self, coordinates, geometry)
+        self._kdtree = None
+
+    def _get_kdtree(self):
+        """Return a k-d tree of the atoms, built the first time it is needed"""
+        if self._kdtree is None:
+            from molmod.kdtree import KDTree
+            self._kdtree = KDTree(self.coordinates)
+        return self._kdtree
+
+    def _get_point_pairs(self, points, cutoff):
+        """Return all relevant (point, atom) pairs for the given points
+
+           Returns: segments, indexes, deltas, distances. The arrays segments
+           and indexes contain the index of the point and the atom of each
+           pair, respectively. When a cutoff is given, only pairs with a
+           distance below the cutoff are included. These are found with a
+           k-d tree (see :class:`molmod.kdtree.KDTree`) that is built the
+           first time it is needed.
+        """
+        if cutoff is None:
+            segments = np.repeat(np.arange(len(points)), self.numc)
+            indexes = np.tile(np.arange(self.numc), len(points))
+        else:
+            offsets, indexes = self._get_kdtree().query_radius_batch(points, cutoff)[:2]
+            segments = np.repeat(np.arange(len(points)), np.diff(offsets))
+        deltas = points[segments] - self.coordinates[indexes]
+        distances = np.sqrt((deltas**2).sum(axis=1))
+        return segments, indexes, deltas, distances
+
+    def esp_points(self, points, cutoff=None):
+        """Compute the electrostatic potential in a set of points
+
+           Arguments:
+             points  --  Mx3 array with Cartesian coordinates
+
+           Optional argument:
+             cutoff  --  When given, only the atoms within the cutoff of a
+                         point contribute to the potential in that point.
+                         This is an approximation that becomes much faster
+                         than the exact result for large sets of points,
+                         e.g. the points of a cube file.
+        """
+        points = np.array(points, float, ndmin=2)
+        segments, indexes, deltas, distances = self._get_point_pairs(points, cutoff)
+        contributions = np.zeros(len(indexes), float)
+        if self.charges is not None:
+            contributions += self.charges[indexes]/distances
+        if self.dipoles is not None:
+            contributions += (self.dipoles[indexes]*deltas).sum(axis=1)/distances**3
+        return np.bincount(segments, contributions, minlength=len(points))
+
+    def esp_point(self, point, cutoff=None):
+        """Compute the electrostatic potential in a point
+
+           Arguments:
+             point  --  Cartesian coordinates of the point
+
+           Optional argument:
+             cutoff  --  See :meth:`esp_points`
+        """
+        return self.esp_points([point], cutoff)[0]
 
     def esp_component(self, index1):
         result = 0.0
@@ -283,19 +710,41 @@ class CoulombFF(PairFF):
             result[index1] = self.esp_component(index1)
         return result
 
-    def efield_point(self, point):
-        result = 0.0
-        for index2 in xrange(self.numc):
-            delta = point - self.coordinates[index2]
-            d = np.linalg.norm(delta)
-            direction = delta/d
-            if self.charges is not None:
-                result += self.charges[index2]*direction/d**2
-            if self.dipoles is not None:
-                p = self.dipoles[index2]
-                result += (3*np.dot(p, direction)*direction - p)/d**3
+    def efield_points(self, points, cutoff=None):
+        """Compute the electric field in a set of points
+
+           Arguments:
+             points  --  Mx3 array with Cartesian coordinates
+
+           Optional argument:
+             cutoff  --  See :meth:`esp_points`
+        """
+        points = np.array(points, float, ndmin=2)
+        segments, indexes, deltas, distances = self._get_point_pairs(points, cutoff)
+        contributions = np.zeros((len(indexes), 3), float)
+        directions = deltas/distances.reshape(-1, 1)
+        if self.charges is not None:
+            contributions += directions*(self.charges[indexes]/distances**2).reshape(-1, 1)
+        if self.dipoles is not None:
+            p = self.dipoles[indexes]
+            projections = (p*directions).sum(axis=1).reshape(-1, 1)
+            contributions += (3*projections*directions - p)/distances.reshape(-1, 1)**3
+        result = np.zeros((len(points), 3), float)
+        for j in xrange(3):
+            result[:, j] = np.bincount(segments, contributions[:, j], minlength=len(result))
         return result
 
+    def efield_point(self, point, cutoff=None):
+        """Compute the electric field in a point
+
+           Arguments:
+             point  --  Cartesian coordinates of the point
+
+           Optional argument:
+             cutoff  --  See :meth:`esp_points`
+        """
+        return self.efield_points([point], cutoff)[0]
+
     def efield_component(self, index1):
         result = 0.0
         for index2 in xrange(self.numc):
@@ -316,12 +765,159 @@ class CoulombFF(PairFF):
             result[index1] = self.efield_component(index1)
         return result
 
+    def _prepare_grid(self, points, out, extra):
+        """Check the arguments of esp_grid or efield_grid
+
+           Returns: points as a contiguous Mx3 array, the output array and a
+           view of the output array with M rows. Single precision points
+           (float32) are not converted and then the output array must also
+           be in single precision.
+        """
+        points = np.asarray(points)
+        if points.dtype != np.float32:
+            points = points.astype(float)
+        if points.ndim == 0 or points.shape[-1] != 3:
+            raise TypeError("The last axis of the points array must have size three.")
+        shape = points.shape[:-1] + extra
+        if out is None:
+            out = np.zeros(shape, points.dtype)
+        elif out.shape != shape or out.dtype != points.dtype or not out.flags.c_contiguous:
+            raise TypeError("The output must be a contiguous array of type %s with shape %s." % (points.dtype, shape))
+        points = np.ascontiguousarray(points).reshape(-1, 3)
+        return points, out, out.reshape((len(points),) + extra)
+
+    def _get_grid_parameters(self, dtype):
+        """Return the coordinates, charges and dipoles converted to dtype
+
+           The conversion is done once, instead of for each chunk. Charges
+           and dipoles that are not present remain None.
+        """
+        def convert(array):
+            if array is not None:
+                return np.ascontiguousarray(array, dtype)
+        return convert(self.coordinates), convert(self.charges), convert(self.dipoles)
+
+    def _compute_grid(self, points, rows, compute, chunk_size, workers):
+        """Evaluate a quantity in a large set of points, chunk by chunk
+
+           Arguments:
+             points  --  contiguous Mx3 array with Cartesian coordinates
+             rows  --  contiguous output array with M rows
+             compute  --  function that takes a chunk of points and fills in
+                          the corresponding chunk of rows
+             chunk_size  --  the number of points per chunk
+             workers  --  the number of threads
+        """
+        begins = range(0, len(points), chunk_size)
+        if workers <= 1:
+            for begin in begins:
+                compute(points[begin:begin+chunk_size], rows[begin:begin+chunk_size])
+            return
+        errors = []
+
+        def work(index):
+            try:
+                for begin in begins[index::workers]:
+                    compute(points[begin:begin+chunk_size], rows[begin:begin+chunk_size])
+            except Exception, e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=work, args=(index,))
+            for index in xrange(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def esp_grid(self, points, cutoff=None, out=None, chunk_size=4096, workers=1):
+        """Compute the electrostatic potential in a large set of points
+
+           Arguments:
+             points  --  array with Cartesian coordinates, e.g. the points of
+                         a cube file with shape (N0,N1,N2,3). The last axis
+                         must have size three.
+
+           Optional arguments:
+             cutoff  --  See :meth:`esp_points`
+             out  --  a contiguous array to store the result in. Its shape
+                      must be points.shape[:-1] and its type must be the same
+                      as that of points.
+             chunk_size  --  the number of points that are processed at once.
+                             This limits the size of the temporary arrays.
+             workers  --  the number of threads. The compiled routines
+                          release the GIL, such that the chunks are really
+                          processed in parallel.
+
+           Returns: an array with the potential in each point. Example::
+
+             >>> cube.data[:] = ff.esp_grid(cube.get_points())
+
+           or, without a temporary array::
+
+             >>> ff.esp_grid(cube.get_points(), out=cube.data)
+
+           When the points are given in single precision (float32), the
+           result is also computed and stored in single precision. The sum
+           over the atoms is still carried out in double precision. This
+           halves the memory usage of large grids.
+        """
+        points, out, rows = self._prepare_grid(points, out, ())
+        if cutoff is None:
+            if points.dtype == np.float32:
+                from molmod.ext import ff_esp_grid_float as ff_esp_grid
+            else:
+                from molmod.ext import ff_esp_grid
+            coordinates, charges, dipoles = self._get_grid_parameters(points.dtype)
+            def compute(chunk, result):
+                ff_esp_grid(coordinates, chunk, result, charges=charges, dipoles=dipoles)
+        else:
+            self._get_kdtree()
+            def compute(chunk, result):
+                result[:] = self.esp_points(chunk, cutoff)
+        self._compute_grid(points, rows, compute, chunk_size, workers)
+        return out
+
+    def efield_grid(self, points, cutoff=None, out=None, chunk_size=4096, workers=1):
+        """Compute the electric field in a large set of points
+
+           Arguments:
+             points  --  array with Cartesian coordinates, e.g. the points of
+                         a cube file with shape (N0,N1,N2,3). The last axis
+                         must have size three.
+
+           Optional arguments:
+             cutoff, out, chunk_size, workers  --  See :meth:`esp_grid`. The
+                                                   shape of out must be the
+                                                   same as that of points.
+
+           Returns: an array with the electric field vector in each point.
+           Single precision points are treated as in :meth:`esp_grid`.
+        """
+        points, out, rows = self._prepare_grid(points, out, (3,))
+        if cutoff is None:
+            if points.dtype == np.float32:
+                from molmod.ext import ff_efield_grid_float as ff_efield_grid
+            else:
+                from molmod.ext import ff_efield_grid
+            coordinates, charges, dipoles = self._get_grid_parameters(points.dtype)
+            def compute(chunk, result):
+                ff_efield_grid(coordinates, chunk, result, charges=charges, dipoles=dipoles)
+        else:
+            self._get_kdtree()
+            def compute(chunk, result):
+                result[:] = self.efield_points(chunk, cutoff)
+        self._compute_grid(points, rows, compute, chunk_size, workers)
+        return out
 
 
 class DispersionFF(PairFF):
     """Computes the London dispersion interaction"""
 
-    def __init__(self, scaling, strengths, coordinates=None):
+    def __init__(self, scaling, strengths, coordinates=None, cutoff=None, unit_cell=None, workers=1):
         """Initialize a DispersionFF object
 
            Arguments:
@@ -334,33 +930,49 @@ class DispersionFF(PairFF):
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+             cutoff, unit_cell, workers  --  see PairFF
         """
-        PairFF.__init__(self, scaling, coordinates)
+        PairFF.__init__(self, scaling, coordinates, cutoff, unit_cell, workers)
         self.strengths = strengths
 
     def yield_pair_energies(self, index1, index2):
         """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield strength*distance**(-6), 1
 
     def yield_pair_gradients(self, index1, index2):
         """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield -6*strength*distance**(-7), np.zeros(3)
 
     def yield_pair_hessians(self, index1, index2):
         """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield 42*strength*distance**(-8), np.zeros((3, 3))
 
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield strength*distances**(-6), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield -6*strength*distances**(-7), np.zeros(3)
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield 42*strength*distances**(-8), np.zeros((3, 3))
+
 
 class PauliFF(PairFF):
     """Computes the Pauli repulsion interaction"""
 
-    def __init__(self, scaling, strengths, coordinates=None):
+    def __init__(self, scaling, strengths, coordinates=None, cutoff=None, unit_cell=None, workers=1):
         """Initialize a PauliFF
 
            Arguments:
@@ -373,33 +985,49 @@ class PauliFF(PairFF):
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+             cutoff, unit_cell, workers  --  see PairFF
         """
-        PairFF.__init__(self, scaling, coordinates)
+        PairFF.__init__(self, scaling, coordinates, cutoff, unit_cell, workers)
         self.strengths = strengths
 
     def yield_pair_energies(self, index1, index2):
         """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield strength*distance**(-12), 1
 
     def yield_pair_gradients(self, index1, index2):
         """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield -12*strength*distance**(-13), np.zeros(3)
 
     def yield_pair_hessians(self, index1, index2):
         """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
-        strength = self.strengths[index1, index2]
+        strength = _get_pair_values(self.strengths, index1, index2)
         distance = self.distances[index1, index2]
         yield 12*13*strength*distance**(-14), np.zeros((3, 3))
 
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield strength*distances**(-12), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield -12*strength*distances**(-13), np.zeros(3)
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of pairs"""
+        strength = _get_pair_values(self.strengths, index1, index2)
+        yield 12*13*strength*distances**(-14), np.zeros((3, 3))
+
 
 class ExpRepFF(PairFF):
     """Computes the exponential repulsion interaction"""
 
-    def __init__(self, scaling, As, Bs, coordinates=None):
+    def __init__(self, scaling, As, Bs, coordinates=None, cutoff=None, unit_cell=None, workers=1):
         """Initialize a ExpRepFF
 
            Arguments:
@@ -414,28 +1042,47 @@ class ExpRepFF(PairFF):
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+             cutoff, unit_cell, workers  --  see PairFF
         """
-        PairFF.__init__(self, scaling, coordinates)
+        PairFF.__init__(self, scaling, coordinates, cutoff, unit_cell, workers)
         self.As = As
         self.Bs = Bs
 
     def yield_pair_energies(self, index1, index2):
         """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
-        A = self.As[index1, index2]
-        B = self.Bs[index1, index2]
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
         distance = self.distances[index1, index2]
         yield A*np.exp(-B*distance), 1
 
     def yield_pair_gradients(self, index1, index2):
         """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij))"""
-        A = self.As[index1, index2]
-        B = self.Bs[index1, index2]
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
         distance = self.distances[index1, index2]
         yield -B*A*np.exp(-B*distance), np.zeros(3)
 
     def yield_pair_hessians(self, index1, index2):
         """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
-        A = self.As[index1, index2]
-        B = self.Bs[index1, index2]
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
         distance = self.distances[index1, index2]
         yield B*B*A*np.exp(-B*distance), np.zeros((3, 3))
+
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of pairs"""
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
+        yield A*np.exp(-B*distances), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of pairs"""
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
+        yield -B*A*np.exp(-B*distances), np.zeros(3)
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of pairs"""
+        A = _get_pair_values(self.As, index1, index2)
+        B = _get_pair_values(self.Bs, index1, index2)
+        yield B*B*A*np.exp(-B*distances), np.zeros((3, 3))
@@ -338,10 +338,14 @@ def check_nonbond(molecule, thresholds):
        a coarse guess of a proper threshold value.
     """
 
-    # check that no atoms overlap
-    for atom1 in xrange(molecule.graph.num_vertices):
+    # check that no atoms overlap. Pairs within two bonds and pairs in
+    # different molecules are not checked.
+    graph = molecule.graph
+    close = set(tuple(pair) for pair in graph.distances_upto(2)[0].tolist())
+    components = graph.components
+    for atom1 in xrange(graph.num_vertices):
         for atom2 in xrange(atom1):
-            if molecule.graph.distances[atom1, atom2] > 2:
+            if components[atom1] == components[atom2] and (atom2, atom1) not in close:
                 distance = numpy.linalg.norm(molecule.coordinates[atom1] - molecule.coordinates[atom2])
                 if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
                     return False
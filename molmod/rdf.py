@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Radial distribution functions and coordination numbers
+
+   The pair distances in a trajectory are histogrammed frame by frame, such
+   that long trajectories can be processed with a small memory footprint::
+
+       rdf = RadialDistribution(molecule.numbers, [(8, 8), (8, 1)], 8*angstrom, 80)
+       rdf.add_frames(XYZReader("traj.xyz"), lambda frame: (frame[1], unit_cell))
+       g = rdf.get_rdf()
+       n = rdf.get_coordination()
+"""
+
+
+from molmod.binning import PairSearchIntra, PairSearchImages
+
+import numpy
+
+
+__all__ = ["RadialDistribution"]
+
+
+class RadialDistribution(object):
+    """Streaming accumulator for radial distribution functions
+
+       The histograms of the distances are kept for a list of label pairs.
+       Frames can be added one at a time with ``add_frame`` or from any
+       iterator, e.g. a :class:`molmod.io.common.SlicedReader`, with
+       ``add_frames``.
+
+       In periodic systems, all periodic images within the cutoff are
+       included, such that the cutoff may be larger than half the size of the
+       unit cell. See :class:`molmod.binning.PairSearchImages`.
+    """
+
+    def __init__(self, labels, label_pairs, cutoff, num_bins):
+        """
+           Arguments:
+            | ``labels``  --  An array with a label for each atom, e.g. the
+                              atom numbers
+            | ``label_pairs``  --  A list of label pairs, e.g. ``[(8, 1)]`` for
+                                   the O-H radial distribution function
+            | ``cutoff``  --  The largest distance in the histograms
+            | ``num_bins``  --  The number of bins in the histograms
+        """
+        self.labels = numpy.asarray(labels)
+        self.label_pairs = list(label_pairs)
+        self.cutoff = cutoff
+        self.num_bins = num_bins
+
+        if len(set(self.label_pairs)) != len(self.label_pairs):
+            raise ValueError("Some label pairs are given more than once.")
+
+        # The atoms get an index based on their label and a table is used to
+        # look up the (unordered) pair of label indexes. The label pairs (a, b)
+        # and (b, a) share the same histogram.
+        unique_labels, self._label_indexes = numpy.unique(self.labels, return_inverse=True)
+        self._table = numpy.zeros((len(unique_labels), len(unique_labels)), int)
+        self._table[:] = -1
+        self._unordered = numpy.zeros(len(self.label_pairs), int)
+        self.counts_a = numpy.zeros(len(self.label_pairs), int)
+        self.counts_b = numpy.zeros(len(self.label_pairs), int)
+        num_unordered = 0
+        for index, (label_a, label_b) in enumerate(self.label_pairs):
+            index_a = unique_labels.searchsorted(label_a)
+            index_b = unique_labels.searchsorted(label_b)
+            if index_a >= len(unique_labels) or unique_labels[index_a] != label_a or \
+               index_b >= len(unique_labels) or unique_labels[index_b] != label_b:
+                raise ValueError("Label pair %s does not occur in the labels." % str((label_a, label_b)))
+            if self._table[index_a, index_b] == -1:
+                self._table[index_a, index_b] = num_unordered
+                self._table[index_b, index_a] = num_unordered
+                num_unordered += 1
+            self._unordered[index] = self._table[index_a, index_b]
+            self.counts_a[index] = (self.labels == label_a).sum()
+            self.counts_b[index] = (self.labels == label_b).sum()
+        self._num_unordered = num_unordered
+        self._same = numpy.array([label_a == label_b for label_a, label_b in self.label_pairs], bool)
+
+        self.edges = numpy.arange(num_bins + 1)*(cutoff/float(num_bins))
+        self.centers = 0.5*(self.edges[1:] + self.edges[:-1])
+        self.histograms = numpy.zeros((len(self.label_pairs), num_bins), int)
+        self.num_frames = 0
+        # the sum of the inverse volumes of all (periodic) frames
+        self._inverse_volume_sum = 0.0
+        self._num_periodic = 0
+
+    def add_frame(self, coordinates, unit_cell=None):
+        """Add the pair distances of a single frame to the histograms
+
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Optional argument:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+        """
+        if len(coordinates) != len(self.labels):
+            raise ValueError("The number of coordinates does not match the number of labels.")
+        if unit_cell is None:
+            i0, i1, deltas, distances = PairSearchIntra(coordinates, self.cutoff).get_arrays()
+        else:
+            i0, i1, images, deltas, distances = PairSearchImages(coordinates, self.cutoff, unit_cell).get_arrays()
+            if unit_cell.active.all():
+                self._inverse_volume_sum += 1.0/abs(unit_cell.volume)
+                self._num_periodic += 1
+
+        histogram_indexes = self._table[self._label_indexes[i0], self._label_indexes[i1]]
+        bin_indexes = (distances*(self.num_bins/self.cutoff)).astype(int)
+        mask = (histogram_indexes >= 0) & (bin_indexes < self.num_bins)
+        histograms = numpy.bincount(
+            histogram_indexes[mask]*self.num_bins + bin_indexes[mask],
+            minlength=self._num_unordered*self.num_bins
+        ).reshape(self._num_unordered, self.num_bins)
+        self.histograms += histograms[self._unordered]
+        self.num_frames += 1
+
+    def add_frames(self, frames, extract=None):
+        """Add the pair distances of a series of frames to the histograms
+
+           Argument:
+            | ``frames``  --  An iterator over frames, e.g. a
+                              :class:`molmod.io.common.SlicedReader`
+
+           Optional argument:
+            | ``extract``  --  A function that converts a frame into a tuple
+                               ``(coordinates, unit_cell)``. When not given,
+                               each frame must be such a tuple.
+
+           The frames are processed one at a time, such that the memory usage
+           does not depend on the length of the trajectory.
+        """
+        for frame in frames:
+            if extract is not None:
+                frame = extract(frame)
+            self.add_frame(*frame)
+
+    def _get_pair_counts(self):
+        """The histograms with each pair counted in both directions"""
+        return self.histograms*(1 + self._same).reshape(-1, 1)
+
+    def get_rdf(self):
+        """Return the radial distribution functions
+
+           The result is an array with one row for each label pair and one
+           column for each bin. This is only possible when all frames were
+           periodic in three dimensions.
+        """
+        if self.num_frames == 0 or self._num_periodic != self.num_frames:
+            raise ValueError("The radial distribution function can only be computed for three-dimensional periodic frames.")
+        shell_volumes = (4.0/3.0)*numpy.pi*(self.edges[1:]**3 - self.edges[:-1]**3)
+        # an atom is not paired with itself when both labels are the same
+        expected = numpy.outer(self.counts_a*(self.counts_b - self._same)*self._inverse_volume_sum, shell_volumes)
+        return self._get_pair_counts()/expected
+
+    def get_coordination(self):
+        """Return the running coordination numbers
+
+           The result is an array with one row for each label pair ``(a, b)``
+           and one column for each bin. Each element is the average number of
+           atoms with label ``b`` within the upper edge of the bin from an atom
+           with label ``a``.
+        """
+        if self.num_frames == 0:
+            raise ValueError("No frames were added yet.")
+        return self._get_pair_counts().cumsum(axis=1)/(self.num_frames*self.counts_a.reshape(-1, 1).astype(float))
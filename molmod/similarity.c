@@ -45,6 +45,16 @@ void similarity_table_distances(int n, double *distance_matrix, double *distance
   }
 }
 
+void similarity_table_distances_float(int n, float *distance_matrix, float *distances_table) {
+  int i,j;
+  for (i=0; i<n; i++) {
+    for (j=0; j<i; j++) {
+      (*distances_table) = distance_matrix[i*n+j];
+      distances_table++;
+    }
+  }
+}
+
 #define PAIR_LESS(l1,l2) (l1[0]==l2[0]?(l1[1]<l2[1]):(l1[0]<l2[0]))
 #define PAIR_GREATER(l1,l2) (l1[0]==l2[0]?(l1[1]>l2[1]):(l1[0]>l2[0]))
 #define PAIR_EQUAL(l1,l2) (l1[0]==l2[0]&&l1[1]==l2[1])
@@ -103,3 +113,55 @@ next_iter:
 
   return result;
 }
+
+double similarity_measure_float(int n1, int *labels1, float *distances1, int n2, int *labels2, float *distances2, double margin, double cutoff) {
+  // Same as similarity_measure, but with single precision distances. The
+  // result is still accumulated in double precision.
+  double result, dav, delta;
+  int i1, i2, c2;
+  int *c_labels2;
+  float *c_distances2;
+
+  result = 0.0;
+
+  i2 = 0;
+  for (i1=0;i1<n1;i1++) {
+    if (PAIR_LESS(labels1,labels2)) {
+      goto next_iter;
+    }
+    while (PAIR_GREATER(labels1,labels2) && i2 < n2) {
+      labels2 += 2;
+      distances2++;
+      i2++;
+    }
+    if (i2 >= n2) {
+      break; // end of the second table is reached.
+    }
+    if (PAIR_LESS(labels1,labels2)) {
+      goto next_iter;
+    }
+
+    c_labels2 = labels2;
+    c_distances2 = distances2;
+    c2 = i2;
+    while (PAIR_EQUAL(labels1,c_labels2) && c2 < n2) {
+      dav = 0.5*(*distances1 + *c_distances2);
+      if (dav < cutoff) {
+        delta = fabs(*distances1 - *c_distances2);
+        if (delta < margin) {
+          result += (1-dav/cutoff)*0.5*(cos(delta/margin/M_PI)+1);
+        }
+      }
+      c_labels2 += 2;
+      c_distances2++;
+      c2++;
+    }
+
+next_iter:
+    // iterate to the next pair in table 1
+    labels1 += 2;
+    distances1++;
+  }
+
+  return result;
+}
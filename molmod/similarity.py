@@ -39,7 +39,8 @@ a1 = SimilarityDescriptor(distance_matrix, labels)
 
 
 from molmod.ext import similarity_table_labels, similarity_table_distances, \
-    similarity_measure
+    similarity_table_distances_float, similarity_measure, \
+    similarity_measure_float
 
 import numpy
 
@@ -57,8 +58,15 @@ class SimilarityDescriptor(object):
                                   also be distances in a graph
              labels  --  a list with integer labels used to identify atoms of
                          the same type
+
+           When the distance matrix is a float32 array, the table of distances
+           is also stored in single precision.
         """
-        self.table_distances = similarity_table_distances(distance_matrix)
+        distance_matrix = numpy.asarray(distance_matrix)
+        if distance_matrix.dtype == numpy.float32:
+            self.table_distances = similarity_table_distances_float(distance_matrix)
+        else:
+            self.table_distances = similarity_table_distances(distance_matrix)
         self.table_labels = similarity_table_labels(labels.astype(numpy.int32))
         order = numpy.lexsort([self.table_labels[:, 1], self.table_labels[:, 0]])
         self.table_labels = self.table_labels[order]
@@ -101,8 +109,13 @@ class SimilarityDescriptor(object):
              labels  --  a list with integer labels used to identify atoms of
                          the same type
         """
-        from molmod.ext import molecules_distance_matrix
-        distance_matrix = molecules_distance_matrix(coordinates)
+        coordinates = numpy.asarray(coordinates)
+        if coordinates.dtype == numpy.float32:
+            from molmod.ext import molecules_distance_matrix_float
+            distance_matrix = molecules_distance_matrix_float(coordinates)
+        else:
+            from molmod.ext import molecules_distance_matrix
+            distance_matrix = molecules_distance_matrix(coordinates)
         return cls(distance_matrix, labels)
 
 
@@ -130,8 +143,17 @@ def compute_similarity(a, b, margin=1.0, cutoff=10.0):
        might be useful to normalize them in some way, e.g.
 
        similarity(a, b)/(similarity(a, a)*similarity(b, b))**0.5
+
+       When both descriptors have distances in single precision, the single
+       precision routine is used. Otherwise the distances are compared in
+       double precision.
     """
-    return similarity_measure(
+    if a.table_distances.dtype == numpy.float32 and \
+       b.table_distances.dtype == numpy.float32:
+        measure = similarity_measure_float
+    else:
+        measure = similarity_measure
+    return measure(
         a.table_labels, a.table_distances,
         b.table_labels, b.table_distances,
         margin, cutoff
@@ -33,7 +33,11 @@ from molmod import context
 from molmod.molecules import Molecule
 from molmod.periodic import periodic
 
-from molmod.ext import ff_dm_quad, ff_dm_reci, ff_bond_quad, ff_bond_hyper
+from molmod.binning import NeighborList, PairSearchIntra
+from molmod.units import angstrom
+
+from molmod.ext import ff_dm_quad, ff_dm_reci, ff_dm_quad_pairs, \
+    ff_dm_reci_pairs, ff_bond_quad, ff_bond_hyper, ff_toyff_batch
 
 import numpy
 
@@ -41,7 +45,7 @@ import numpy
 __all__ = ["guess_geometry", "tune_geometry", "ToyFF", "SpecialAngles"]
 
 
-def guess_geometry(graph, unit_cell=None, verbose=False):
+def guess_geometry(graph, unit_cell=None, verbose=False, max_graph_distance=None):
     """Construct a molecular geometry based on a molecular graph.
 
        This routine does not require initial coordinates and will give a very
@@ -57,6 +61,9 @@ def guess_geometry(graph, unit_cell=None, verbose=False):
         | ``unit_cell``  --  periodic boundry conditions, see
                              :class:`molmod.unit_cells.UnitCell`
         | ``verbose``  --  Show optimizer progress when True
+        | ``max_graph_distance``  --  When given, the sparse mode of the ToyFF
+                                      is used, which is recommended for large
+                                      systems. See :class:`ToyFF`.
     """
 
     N = len(graph.numbers)
@@ -68,7 +75,7 @@ def guess_geometry(graph, unit_cell=None, verbose=False):
     convergence = ConvergenceCondition(grad_rms=1e-6, step_rms=1e-6)
     stop_loss = StopLossCondition(max_iter=500, fun_margin=0.1)
 
-    ff = ToyFF(graph, unit_cell)
+    ff = ToyFF(graph, unit_cell, max_graph_distance)
     x_init = numpy.random.normal(0, 1, N*3)
 
     #  level 1 geometry optimization: graph based
@@ -105,7 +112,7 @@ def guess_geometry(graph, unit_cell=None, verbose=False):
     return mol
 
 
-def tune_geometry(graph, mol, unit_cell=None, verbose=False):
+def tune_geometry(graph, mol, unit_cell=None, verbose=False, max_graph_distance=None):
     """Fine tune a molecular geometry, starting from a (very) poor guess of
        the initial geometry.
 
@@ -122,6 +129,9 @@ def tune_geometry(graph, mol, unit_cell=None, verbose=False):
         | ``unit_cell``  --  periodic boundry conditions, see
                              :class:`molmod.unit_cells.UnitCell`
         | ``verbose``  --  Show optimizer progress when True
+        | ``max_graph_distance``  --  When given, the sparse mode of the ToyFF
+                                      is used, which is recommended for large
+                                      systems. See :class:`ToyFF`.
     """
 
     N = len(graph.numbers)
@@ -133,7 +143,7 @@ def tune_geometry(graph, mol, unit_cell=None, verbose=False):
     convergence = ConvergenceCondition(grad_rms=1e-6, step_rms=1e-6)
     stop_loss = StopLossCondition(max_iter=500, fun_margin=1.0)
 
-    ff = ToyFF(graph, unit_cell)
+    ff = ToyFF(graph, unit_cell, max_graph_distance)
     x_init = mol.coordinates.ravel()
 
     #  level 3 geometry optimization: bond lengths + pauli
@@ -160,9 +170,15 @@ class ToyFF(object):
 
        See :func:guess_geomtry and :func:tune_geomtry for two practical use
        cases.
+
+       The compiled routines are parallelized with OpenMP, when the extension
+       is built with OpenMP support. The number of threads is controlled with
+       the environment variable OMP_NUM_THREADS. The routines also release
+       the GIL, such that several ToyFF objects can be evaluated concurrently
+       in Python threads.
     """
 
-    def __init__(self, graph, unit_cell=None):
+    def __init__(self, graph, unit_cell=None, max_graph_distance=None, skin=1.0*angstrom):
         """
            Argument:
             | ``graph``  --  the molecular graph from which the force field terms
@@ -172,6 +188,20 @@ class ToyFF(object):
            Optional argument:
             | ``unit_cell``  --  periodic boundry conditions, see
                                  :class:`molmod.unit_cells.UnitCell`
+            | ``max_graph_distance``  --  when given, the sparse mode is used,
+                                          see below.
+            | ``skin``  --  the skin of the neighbor list in the sparse mode
+                            [default=1.0*angstrom]
+
+           By default, the dm_quad and dm_reci terms loop over all pairs of
+           atoms and the graph distance matrix is stored, which scales
+           quadratically with the system size. In the sparse mode, the
+           dm_quad term only includes pairs whose graph distance does not
+           exceed max_graph_distance. These pairs are stored as a list. The
+           dm_reci term is then driven by a neighbor list
+           (:class:`molmod.binning.NeighborList`), as it only acts on pairs
+           closer than the sum of their van der Waals radii. Both terms then
+           scale linearly with the system size.
         """
         from molmod.bonds import bonds
 
@@ -182,11 +212,26 @@ class ToyFF(object):
             self.matrix = unit_cell.matrix
             self.reciprocal = unit_cell.reciprocal
 
-        self.dm = graph.distances.astype(numpy.int32)
-        dm = self.dm.astype(float)
-        self.dm0 = dm**2
-        self.dmk = (dm+0.1)**(-3)
+        self.max_graph_distance = max_graph_distance
         self.vdw_radii = numpy.array([periodic[number].vdw_radius for number in graph.numbers], dtype=float)
+        if max_graph_distance is None:
+            self.dm = graph.distances.astype(numpy.int32)
+            dm = self.dm.astype(float)
+            self.dm0 = dm**2
+            self.dmk = (dm+0.1)**(-3)
+        else:
+            if max_graph_distance < 1:
+                raise ValueError("The maximum graph distance must be at least one.")
+            pairs, distances = graph.distances_upto(max_graph_distance)
+            self.components = graph.components
+            self.dm_pairs = pairs.astype(numpy.int32)
+            dm = distances.astype(float)
+            self.dm_lengths = dm**2
+            self.dm_ks = (dm+0.1)**(-3)
+            # keys of the bonded pairs, these are excluded from dm_reci
+            bonded = pairs[distances == 1]
+            self.bond_keys = bonded[:, 0]*graph.num_vertices + bonded[:, 1]
+            self.neighbor_list = NeighborList(2*self.vdw_radii.max(), skin, unit_cell)
         self.covalent_radii = numpy.array([periodic[number].covalent_radius for number in graph.numbers], dtype=float)
 
         bond_edges = []
@@ -224,7 +269,7 @@ class ToyFF(object):
             for j in neighbors:
                 number_j = graph.numbers[j]
                 for k in neighbors:
-                    if j < k and not frozenset([j, k]) in graph.edges:
+                    if j < k and not frozenset([j, k]) in graph.edge_index:
                         number_k = graph.numbers[k]
 
                         triplet = (
@@ -251,43 +296,250 @@ class ToyFF(object):
         self.span_quad = 0.0
         self.bond_hyper = 0.0
         self.bond_hyper_scale = 5.0
+        self._candidate_pairs = None
 
-    def __call__(self, x, do_gradient=False):
-        """Compute the energy (and gradient) for a set of Cartesian coordinates
+    def _get_candidate_pairs(self):
+        """Return the atom pairs of each term, in the order of the Hessian blocks
 
-           Argument:
-            | ``x``  --  the Cartesian coordinates
-            | ``do_gradient``  --  when set to True, the gradient is also
-                                   computed and returned. [default=False]
+           The compiled routines return one 3x3 Hessian block for each
+           candidate pair of a term. Pairs of the dm_reci term that are
+           further apart than the sum of the van der Waals radii get a zero
+           block.
+        """
+        if self._candidate_pairs is None:
+            self._candidate_pairs = {
+                "bond": self.bond_edges.reshape(-1, 2),
+                "span": self.span_edges.reshape(-1, 2),
+            }
+            if self.max_graph_distance is None:
+                # the same loop order as in ff.c: i > j, row by row
+                lower = numpy.tril(numpy.ones(self.dm.shape, bool), -1)
+                self._candidate_pairs["dm_quad"] = numpy.array((lower & (self.dm0 > 0)).nonzero()).transpose()
+                self._candidate_pairs["dm_reci"] = numpy.array((lower & (self.dm > 1)).nonzero()).transpose()
+            else:
+                self._candidate_pairs["dm_quad"] = self.dm_pairs
+        return self._candidate_pairs
+
+    def _get_reci_pairs(self, x):
+        """Return the pairs for the dm_reci term in the sparse mode
+
+           These are the pairs in the neighbor list that are not bonded and
+           that belong to the same connected component of the graph.
+        """
+        self.neighbor_list.update(x)
+        index1, index2 = self.neighbor_list.get_arrays()[:2]
+        return self._filter_reci_pairs(index1, index2, len(x))
+
+    def _filter_reci_pairs(self, index1, index2, size):
+        """Select the pairs for the dm_reci term from a list of close pairs"""
+        low = numpy.minimum(index1, index2)
+        high = numpy.maximum(index1, index2)
+        mask = self.components[index1] == self.components[index2]
+        mask &= ~numpy.in1d(low*size + high, self.bond_keys)
+        return numpy.array([low[mask], high[mask]], numpy.int32).transpose()
+
+    def _compute(self, x, do_hessian):
+        """Compute the energy, the gradient and optionally the Hessian blocks
+
+           Returns: energy, gradient, pairs, blocks. The last two are None
+           when do_hessian is False. Otherwise pairs is a Kx2 array with atom
+           indexes and blocks is a Kx3x3 array with the second derivatives of
+           the energy towards the coordinates of the first atom in each pair.
+           Pairs may occur several times.
         """
         x = x.reshape((-1, 3))
         result = 0.0
-
         gradient = numpy.zeros(x.shape, float)
-        if self.dm_quad > 0.0:
-            result += ff_dm_quad(x, self.dm0, self.dmk, self.dm_quad,
-                                 gradient, self.matrix, self.reciprocal)
-        if self.dm_reci:
-            result += ff_dm_reci(x, self.vdw_radii, self.dm, self.dm_reci,
-                                 gradient, self.matrix, self.reciprocal)
+        all_pairs = []
+        all_blocks = []
+        if do_hessian:
+            candidate_pairs = self._get_candidate_pairs()
+
+        def get_blocks(key, pairs=None):
+            if do_hessian:
+                if pairs is None:
+                    pairs = candidate_pairs[key]
+                all_pairs.append(pairs)
+                all_blocks.append(numpy.zeros((len(pairs), 3, 3), float))
+                return all_blocks[-1]
+            else:
+                return numpy.zeros((0, 3, 3), float)
+
+        if self.max_graph_distance is None:
+            if self.dm_quad > 0.0:
+                result += ff_dm_quad(x, self.dm0, self.dmk, self.dm_quad,
+                                     gradient, get_blocks("dm_quad"),
+                                     self.matrix, self.reciprocal)
+            if self.dm_reci:
+                result += ff_dm_reci(x, self.vdw_radii, self.dm, self.dm_reci,
+                                     gradient, get_blocks("dm_reci"),
+                                     self.matrix, self.reciprocal)
+        else:
+            if self.dm_quad > 0.0:
+                result += ff_dm_quad_pairs(x, self.dm_pairs, self.dm_lengths,
+                                           self.dm_ks, self.dm_quad, gradient,
+                                           get_blocks("dm_quad"), self.matrix,
+                                           self.reciprocal)
+            if self.dm_reci:
+                pairs = self._get_reci_pairs(x)
+                result += ff_dm_reci_pairs(x, pairs, self.vdw_radii,
+                                           self.dm_reci, gradient,
+                                           get_blocks("dm_reci", pairs),
+                                           self.matrix, self.reciprocal)
         if self.bond_quad:
             result += ff_bond_quad(x, self.bond_edges, self.bond_lengths,
-                                   self.bond_quad, gradient, self.matrix,
-                                   self.reciprocal)
+                                   self.bond_quad, gradient, get_blocks("bond"),
+                                   self.matrix, self.reciprocal)
         if self.span_quad:
             result += ff_bond_quad(x, self.span_edges, self.span_lengths,
-                                   self.span_quad, gradient, self.matrix,
-                                   self.reciprocal)
+                                   self.span_quad, gradient, get_blocks("span"),
+                                   self.matrix, self.reciprocal)
         if self.bond_hyper:
             result += ff_bond_hyper(x, self.bond_edges, self.bond_lengths,
                                     self.bond_hyper_scale, self.bond_hyper,
-                                    gradient, self.matrix, self.reciprocal)
+                                    gradient, get_blocks("bond"), self.matrix,
+                                    self.reciprocal)
 
-        if do_gradient:
+        if not do_hessian:
+            return result, gradient, None, None
+        elif len(all_pairs) == 0:
+            return result, gradient, numpy.zeros((0, 2), int), numpy.zeros((0, 3, 3), float)
+        else:
+            return result, gradient, numpy.concatenate(all_pairs), numpy.concatenate(all_blocks)
+
+    def __call__(self, x, do_gradient=False, do_hessian=False):
+        """Compute the energy (and gradient) for a set of Cartesian coordinates
+
+           Argument:
+            | ``x``  --  the Cartesian coordinates
+            | ``do_gradient``  --  when set to True, the gradient is also
+                                   computed and returned. [default=False]
+            | ``do_hessian``  --  when set to True, the gradient and the
+                                  (dense) Hessian are also computed and
+                                  returned. [default=False]
+        """
+        result, gradient, pairs, blocks = self._compute(x, do_hessian)
+        if do_hessian:
+            size = len(gradient)
+            hessian = numpy.zeros((size, 3, size, 3), float)
+            index1 = pairs[:, 0]
+            index2 = pairs[:, 1]
+            # each pair contributes to four blocks, (i,i), (j,j), (i,j) and
+            # (j,i). The pairs are not unique, hence the bincount.
+            keys = numpy.concatenate([
+                index1*size + index1, index2*size + index2,
+                index1*size + index2, index2*size + index1,
+            ])
+            signs = numpy.repeat([1.0, 1.0, -1.0, -1.0], len(pairs))
+            for k in xrange(3):
+                for l in xrange(3):
+                    hessian[:, k, :, l] = numpy.bincount(
+                        keys, numpy.tile(blocks[:, k, l], 4)*signs,
+                        minlength=size*size
+                    ).reshape(size, size)
+            return result, gradient.ravel(), hessian.reshape(3*size, 3*size)
+        elif do_gradient:
             return result, gradient.ravel()
         else:
             return result
 
+    def batch(self, xs, do_gradient=False):
+        """Compute the energies (and gradients) of a stack of geometries
+
+           Argument:
+            | ``xs``  --  an MxNx3 array with the Cartesian coordinates of M
+                          geometries of the same system
+
+           Optional argument:
+            | ``do_gradient``  --  when set to True, an MxNx3 array with the
+                                   gradients is also returned. [default=False]
+
+           Returns: an array with M energies (and the gradients). All terms
+           of all geometries are computed in a single compiled call, which is
+           parallelized over the geometries with OpenMP. This avoids the
+           Python overhead of calling the force field M times. In the sparse
+           mode, the pairs of the dm_reci term are searched for each geometry
+           separately, without the neighbor list.
+        """
+        xs = numpy.asarray(xs, float)
+        size = len(self.vdw_radii)
+        xs = xs.reshape((-1, size, 3))
+        energies = numpy.zeros(len(xs), float)
+        gradients = numpy.zeros(xs.shape, float)
+        amps = numpy.array([
+            self.dm_quad, self.dm_reci, self.bond_quad, self.span_quad,
+            self.bond_hyper, self.bond_hyper_scale
+        ], float)
+        empty_pairs = numpy.zeros((0, 2), numpy.int32)
+        empty = numpy.zeros(0, float)
+        if self.max_graph_distance is None:
+            dm0, dmk, dm = self.dm0, self.dmk, self.dm
+            quad_pairs, quad_lengths, quad_ks = empty_pairs, empty, empty
+        else:
+            dm0 = numpy.zeros((0, 0), float)
+            dmk = dm0
+            dm = numpy.zeros((0, 0), numpy.int32)
+            quad_pairs, quad_lengths, quad_ks = self.dm_pairs, self.dm_lengths, self.dm_ks
+        def fill(a):
+            # f2py rejects empty arrays with an assumed size (see ext.pyf).
+            # The lengths are derived from the pair arrays and dm0 instead.
+            if a.size == 0:
+                return numpy.zeros(1, a.dtype)
+            return a
+        ff_toyff_batch(
+            xs, amps, dm0, fill(dmk), fill(dm), self.vdw_radii, quad_pairs,
+            fill(quad_lengths), fill(quad_ks), self.bond_edges.reshape(-1, 2),
+            fill(self.bond_lengths), self.span_edges.reshape(-1, 2),
+            fill(self.span_lengths), energies, gradients, self.matrix,
+            self.reciprocal
+        )
+        if self.max_graph_distance is not None and self.dm_reci:
+            cutoff = self.neighbor_list.cutoff
+            unit_cell = self.neighbor_list.unit_cell
+            for i in xrange(len(xs)):
+                index1, index2 = PairSearchIntra(xs[i], cutoff, unit_cell).get_arrays()[:2]
+                pairs = self._filter_reci_pairs(index1, index2, size)
+                energies[i] += ff_dm_reci_pairs(
+                    xs[i], pairs, self.vdw_radii, self.dm_reci, gradients[i],
+                    numpy.zeros((0, 3, 3), float), self.matrix,
+                    self.reciprocal
+                )
+        if do_gradient:
+            return energies, gradients
+        else:
+            return energies
+
+    def hessian_sparse(self, x):
+        """Compute the Hessian in a sparse block format
+
+           Argument:
+            | ``x``  --  the Cartesian coordinates
+
+           Returns: offsets, columns, blocks. The non-zero 3x3 blocks of the
+           Hessian in block row i are blocks[offsets[i]:offsets[i+1]]. The
+           corresponding block columns are columns[offsets[i]:offsets[i+1]].
+           Within each row, the columns are sorted. This is the same format
+           as :meth:`molmod.pairff.PairFF.hessian_sparse`.
+        """
+        pairs, blocks = self._compute(x, True)[2:]
+        size = x.size/3
+        index1 = pairs[:, 0]
+        index2 = pairs[:, 1]
+        diagonal = numpy.arange(size)
+        rows = numpy.concatenate([index1, index2, index1, index2, diagonal])
+        columns = numpy.concatenate([index1, index2, index2, index1, diagonal])
+        blocks = numpy.concatenate([blocks, blocks, -blocks, -blocks, numpy.zeros((size, 3, 3), float)])
+        # add up the blocks with the same row and column
+        keys, inverse = numpy.unique(rows*size + columns, return_inverse=True)
+        result = numpy.zeros((len(keys), 3, 3), float)
+        for k in xrange(3):
+            for l in xrange(3):
+                result[:, k, l] = numpy.bincount(inverse, blocks[:, k, l], minlength=len(keys))
+        rows = keys/size
+        offsets = numpy.zeros(size+1, int)
+        offsets[1:] = numpy.bincount(rows, minlength=size).cumsum()
+        return offsets, keys % size, result
+
 
 class SpecialAngles(object):
     """A database with precomputed valence angles from small molecules"""
@@ -197,6 +197,57 @@ class UnitCell(ReadOnly):
         order = active + inactive
         return UnitCell(self.matrix[:,order], self.active[order])
 
+    @cached
+    def reduced(self):
+        """An equivalent unit cell with short and nearly orthogonal cell vectors
+
+           Integer multiples of one active cell vector are subtracted from
+           another as long as this makes the latter shorter. The result
+           describes the same lattice as the original unit cell, but it is
+           much less skewed. Inactive cell vectors are not changed.
+        """
+        matrix = self.matrix.copy()
+        active = self.active_inactive[0]
+        changed = True
+        while changed:
+            changed = False
+            for i in active:
+                for j in active:
+                    if i == j:
+                        continue
+                    norm_sq = numpy.dot(matrix[:, i], matrix[:, i])
+                    factor = numpy.round(numpy.dot(matrix[:, i], matrix[:, j])/numpy.dot(matrix[:, j], matrix[:, j]))
+                    if factor == 0:
+                        continue
+                    vector = matrix[:, i] - factor*matrix[:, j]
+                    if numpy.dot(vector, vector) < norm_sq*(1 - self.eps):
+                        matrix[:, i] = vector
+                        changed = True
+        return UnitCell(matrix, self.active)
+
+    @cached
+    def image_shifts(self):
+        """Lattice vectors that may shorten the result of shortest_vector
+
+           The relative vectors returned by shortest_vector have fractional
+           coordinates in the range [-0.5,0.5[. For skewed unit cells, adding
+           one of these lattice vectors may result in a shorter relative
+           vector. The returned array is empty for orthorhombic cells.
+        """
+        matrix = self.matrix*self.active
+        # All relevant lattice vectors are shorter than the sum of the lengths
+        # of the cell vectors.
+        radius = numpy.sqrt((matrix**2).sum(axis=0)).sum()
+        ranges = numpy.floor(radius*numpy.sqrt((self.reciprocal**2).sum(axis=0))).astype(int)
+        indexes = numpy.indices(2*ranges+1).reshape(3, -1).transpose() - ranges
+        shifts = self.to_cartesian(indexes)
+        norms_sq = (shifts**2).sum(axis=1)
+        # A relative vector in the range of shortest_vector can be shortened by
+        # a lattice vector t if sum_i abs(dot(a_i, t)) > dot(t, t), where a_i
+        # are the active cell vectors.
+        bounds = abs(numpy.dot(shifts, matrix)).sum(axis=1)
+        return shifts[(norms_sq > 0) & (bounds > norms_sq*(1 + self.eps))]
+
     @cached
     def alignment_a(self):
         """Computes the rotation matrix that aligns the unit cell with the
@@ -267,18 +318,34 @@ class UnitCell(ReadOnly):
         """
         return numpy.dot(fractional, self.matrix.transpose())
 
-    def shortest_vector(self, delta):
+    def shortest_vector(self, delta, exact=False):
         """Compute the relative vector under periodic boundary conditions.
 
            Argument:
             | ``delta``  --  the relative vector between two points
 
-           The return value is not necessarily the shortest possible vector,
-           but instead is the vector with fractional coordinates in the range
-           [-0.5,0.5[. This is most of the times the shortest vector between
-           the two points, but not always. (See commented test.) It is always
-           the shortest vector for orthorombic cells.
+           Optional argument:
+            | ``exact``  --  When True, the true minimum image is returned, also
+                             for skewed unit cells. [default=False]
+
+           By default, the return value is not necessarily the shortest possible
+           vector, but instead is the vector with fractional coordinates in the
+           range [-0.5,0.5[. This is most of the times the shortest vector
+           between the two points, but not always. (See commented test.) It is
+           always the shortest vector for orthorombic cells.
         """
+        if exact:
+            reduced = self.reduced
+            wrapped = reduced.shortest_vector(delta)
+            delta = wrapped
+            norms_sq = (delta**2).sum(axis=-1)
+            for shift in reduced.image_shifts:
+                candidate = wrapped + shift
+                candidate_norms_sq = (candidate**2).sum(axis=-1)
+                mask = candidate_norms_sq < norms_sq
+                delta = numpy.where(numpy.expand_dims(mask, -1), candidate, delta)
+                norms_sq = numpy.where(mask, candidate_norms_sq, norms_sq)
+            return delta
         fractional = self.to_fractional(delta)
         fractional = numpy.floor(fractional + 0.5)
         return delta - self.to_cartesian(fractional)
@@ -110,7 +110,7 @@ class ReadOnlyAttribute(object):
     """
 
     def __init__(self, ptype=None, none=True, check=None, npdim=None,
-                 npshape=None, npdtype=None, doc=None):
+                 npshape=None, npdtype=None, allow_float32=False, doc=None):
         """
            One can impose detailed type checking on the attribute through the
            following options.
@@ -121,6 +121,9 @@ class ReadOnlyAttribute(object):
             | ``npdim`` -- In case of numpy arrays: the number of dimensions.
             | ``npshape`` -- In case of numpy arrays: the expected shape.
             | ``npdtype`` -- In case of numpy arrays: the expected dtype.
+            | ``allow_float32`` -- When True and npdtype is float, single
+                                   precision arrays are not converted to
+                                   double precision.
             | ``check`` -- A method to check the validity of the attribute.
             | ``doc`` -- Short description.
 
@@ -151,9 +154,12 @@ class ReadOnlyAttribute(object):
                 self.npdim = npdim
                 self.npshape = npshape
                 self.npdtype = npdtype
-        elif not (npdim is None and npshape is None and npdtype is None):
-            raise ValueError("The arguments npdim, npshape and npdtype are "
-                "only allowed when ptype is a subclass of numpy.ndarray.")
+                self.allow_float32 = allow_float32
+        elif not (npdim is None and npshape is None and npdtype is None and
+                  not allow_float32):
+            raise ValueError("The arguments npdim, npshape, npdtype and "
+                "allow_float32 are only allowed when ptype is a subclass of "
+                "numpy.ndarray.")
         # make a nice docstring
         self.__doc__ = "*Read-only attribute:* %s.\n\n" % doc
         check_lines = []
@@ -201,7 +207,13 @@ class ReadOnlyAttribute(object):
         if not (self.ptype is None or value is None):
             # Only type check if there is one and the value is not None.
             if issubclass(self.ptype, numpy.ndarray):
-                if hasattr(value, "__len__"):
+                if isinstance(value, numpy.ndarray) and \
+                   self.allow_float32 and self.npdtype is float and \
+                   value.dtype == numpy.float32:
+                    # single precision arrays, e.g. frames of a trajectory,
+                    # are not converted to double precision when allowed.
+                    pass
+                elif hasattr(value, "__len__"):
                     # try to turn non-arrays into arrays.
                     value = numpy.array(value, dtype=self.npdtype, copy=False)
                 else:
@@ -306,6 +318,19 @@ class ReadOnly(object):
                 continue
             descriptor.check_wrapper(self, val)
 
+    def _get_init_kwargs(self):
+        """Return the keyword arguments for the constructor of a copy
+
+           By default, these are all read-only attributes. Derived classes
+           can override this method when the constructor arguments have
+           different names.
+        """
+        attrs = {}
+        for key, descriptor in self.__class__.__dict__.iteritems():
+            if isinstance(descriptor, ReadOnlyAttribute):
+                attrs[key] = descriptor.__get__(self)
+        return attrs
+
     def copy_with(self, **kwargs):
         """Return a copy with (a few) changed attributes
 
@@ -314,10 +339,7 @@ class ReadOnly(object):
            original object. This only works if the constructor takes all
            (read-only) attributes as arguments.
         """
-        attrs = {}
-        for key, descriptor in self.__class__.__dict__.iteritems():
-            if isinstance(descriptor, ReadOnlyAttribute):
-                attrs[key] = descriptor.__get__(self)
+        attrs = self._get_init_kwargs()
         for key in kwargs:
             if key not in attrs:
                 raise TypeError("Unknown attribute: %s" % key)
@@ -65,7 +65,7 @@ class ZMatrixGenerator(object):
         # We will try to take the original order as long as it satisfies the
         # constraint.
         for i in xrange(1, graph.num_vertices):
-            if (graph.distances[i][new_order] == 1).any():
+            if not graph.neighbors[i].isdisjoint(new_order):
                 new_order.append(i)
             else:
                 break
@@ -75,7 +75,7 @@ class ZMatrixGenerator(object):
         remaining = range(len(new_order), graph.num_vertices)
         while len(remaining) > 0:
             pivot = remaining.pop()
-            if (graph.distances[pivot][new_order] == 1).any():
+            if not graph.neighbors[pivot].isdisjoint(new_order):
                 new_order.append(pivot)
             else:
                 remaining.insert(0, pivot)
@@ -23,7 +23,10 @@
 #--
 
 
-import glob, os
+import glob, os, shutil, tempfile
+from distutils.ccompiler import new_compiler
+from distutils.errors import CompileError, LinkError
+from distutils.sysconfig import customize_compiler
 from numpy.distutils.core import setup
 from numpy.distutils.extension import Extension
 from numpy.distutils.command.install_data import install_data
@@ -51,6 +54,39 @@ class MyInstallData(install_data):
                     f.close()
 
 
+def get_openmp_flags():
+    """Return the compiler flags for OpenMP, or an empty list if not supported
+
+       The compiled force-field routines are parallelized with OpenMP. They
+       also work without OpenMP, in which case they are simply serial. Set
+       the environment variable MOLMOD_NO_OPENMP to disable OpenMP.
+    """
+    if "MOLMOD_NO_OPENMP" in os.environ:
+        return []
+    flags = ["-fopenmp"]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn_c = os.path.join(tmpdir, "test_openmp.c")
+        f = file(fn_c, "w")
+        print >> f, "#include <omp.h>"
+        print >> f, "int main(void) { return omp_get_max_threads() < 1; }"
+        f.close()
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        try:
+            objects = compiler.compile([fn_c], output_dir=tmpdir, extra_postargs=flags)
+            compiler.link_executable(objects, os.path.join(tmpdir, "test_openmp"), extra_postargs=flags)
+        except (CompileError, LinkError):
+            print "OpenMP is not supported by the compiler, building serial code."
+            return []
+        return flags
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+openmp_flags = get_openmp_flags()
+
+
 setup(
     name='MolMod',
     version='0.004',
@@ -72,10 +108,10 @@ setup(
         ]),
     ],
     ext_modules=[
-        Extension("molmod.ext", ["molmod/ext.pyf", "molmod/common.c",
-            "molmod/ff.c", "molmod/graphs.c", "molmod/similarity.c",
-            "molmod/molecules.c", "molmod/unit_cells.c",
-        ]),
+        Extension("molmod.ext", ["molmod/ext.pyf", "molmod/binning.c",
+            "molmod/common.c", "molmod/ewald.c", "molmod/ff.c", "molmod/graphs.c", "molmod/kdtree.c",
+            "molmod/similarity.c", "molmod/molecules.c", "molmod/unit_cells.c",
+        ], extra_compile_args=openmp_flags, extra_link_args=openmp_flags),
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',
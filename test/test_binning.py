@@ -61,7 +61,7 @@ class BinningTestCase(unittest.TestCase):
                 fast_distance = distances.get(identifier)
                 if fast_distance is None:
                     missing_pairs.append(tuple(identifier) + (distance,))
-                elif fast_distance != distance:
+                elif abs(fast_distance - distance) > 1e-10:
                     wrong_distances.append(tuple(identifier) + (fast_distance, distance))
                 else:
                     num_correct += 1
@@ -77,7 +77,7 @@ class BinningTestCase(unittest.TestCase):
             message += "%10s %10s: \t % 10.7f != % 10.7f\n" % wrong_distance
         message += "UNWANTED PAIRS: %i\n" % len(distances)
         for identifier, fast_distance in distances.iteritems():
-            message += "%10s %10s: \t % 10.7f\n" % (identifier, fast_distance)
+            message += "%10s %10s: \t % 10.7f\n" % (tuple(identifier) + (fast_distance,))
         message += "TOTAL PAIRS: %i\n" % num_total
         message += "CORRECT PAIRS: %i\n" % num_correct
         message += "-"*50+"\n"
@@ -224,3 +224,254 @@ class BinningTestCase(unittest.TestCase):
                 in pair_search
             ]
             self.verify_distances_inter(coordinates0, coordinates1, cutoff, distances, unit_cell)
+
+    def test_arrays_intra_random_periodic(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(0,1,(20,3))
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(coordinates)*3-unit_cell.matrix.sum(axis=1)
+            cutoff = numpy.random.uniform(1, 6)
+
+            i0, i1, deltas, distances = PairSearchIntra(coordinates, cutoff, unit_cell).get_arrays()
+            self.assertEqual(deltas.shape, (len(i0), 3))
+            self.assert_((i1 < i0).all())
+            self.assert_(abs(deltas - unit_cell.shortest_vector(coordinates[i1] - coordinates[i0])).max() < 1e-10)
+            self.assert_(abs(numpy.sqrt((deltas**2).sum(axis=1)) - distances).max() < 1e-10)
+            distances = [
+                (frozenset([j0, j1]), distance)
+                for j0, j1, distance in zip(i0, i1, distances)
+            ]
+            self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
+
+    def test_arrays_inter_random(self):
+        for i in xrange(10):
+            coordinates0 = numpy.random.uniform(0,5,(20,3))
+            coordinates1 = numpy.random.uniform(0,5,(20,3))
+            cutoff = numpy.random.uniform(1, 6)
+            i0, i1, deltas, distances = PairSearchInter(coordinates0, coordinates1, cutoff).get_arrays()
+            self.assert_(abs(deltas - (coordinates1[i1] - coordinates0[i0])).max() < 1e-10)
+            distances = [
+                ((j0, j1), distance)
+                for j0, j1, distance in zip(i0, i1, distances)
+            ]
+            self.verify_distances_inter(coordinates0, coordinates1, cutoff, distances)
+
+    def test_arrays_empty(self):
+        coordinates = numpy.array([[0.0, 0.0, 0.0], [5.0, 0.0, 0.0]])
+        i0, i1, deltas, distances = PairSearchIntra(coordinates, 1.0).get_arrays()
+        self.assertEqual(i0.shape, (0,))
+        self.assertEqual(deltas.shape, (0, 3))
+        self.assertEqual(list(PairSearchIntra(coordinates, 1.0)), [])
+
+    def test_arrays_intra_dilute(self):
+        # A few clusters far apart, such that most of the bounding box is empty.
+        coordinates = numpy.concatenate([
+            numpy.random.uniform(0,3,(30,3)) + center
+            for center in [[0,0,0], [1e3,0,0], [0,2e3,-1e3]]
+        ])
+        cutoff = 2.0
+        i0, i1, deltas, distances = PairSearchIntra(coordinates, cutoff).get_arrays()
+        distances = [
+            (frozenset([j0, j1]), distance)
+            for j0, j1, distance in zip(i0, i1, distances)
+        ]
+        self.verify_distances_intra(coordinates, cutoff, distances)
+
+    def test_arrays_sparse_grid(self):
+        # An explicit fine grid for a dilute system: only the occupied bins
+        # are stored.
+        coordinates = numpy.concatenate([
+            numpy.random.uniform(0,6,(20,3)) + center
+            for center in [[0,0,0], [400,0,0], [0,400,397]]
+        ])
+        cutoff = 5.0
+        pair_search = PairSearchIntra(coordinates, cutoff, grid=1.0)
+        self.assert_(pair_search.bins.cells is not None)
+        self.assert_(len(pair_search.bins.offsets) <= 61)
+        i0, i1, deltas, distances = pair_search.get_arrays()
+        self.assert_(abs(deltas - (coordinates[i1] - coordinates[i0])).max() < 1e-10)
+        self.verify_distances_intra(coordinates, cutoff, [
+            (frozenset([j0, j1]), distance)
+            for j0, j1, distance in zip(i0, i1, distances)
+        ])
+        pair_search.workers = 3
+        self.assert_((pair_search.get_arrays()[3] == distances).all())
+        # periodic, with pairs across the border of the unit cell
+        unit_cell = UnitCell(numpy.identity(3)*400.0)
+        coordinates = numpy.concatenate([
+            numpy.random.uniform(-4,4,(20,3)) % 400.0,
+            numpy.random.uniform(146,154,(20,3)),
+        ])
+        pair_search = PairSearchIntra(coordinates, cutoff, unit_cell, grid=1.0)
+        self.assert_(pair_search.bins.cells is not None)
+        self.verify_bins_intra_periodic(pair_search.bins)
+        i0, i1, deltas, distances = pair_search.get_arrays()
+        self.verify_distances_intra(coordinates, cutoff, [
+            (frozenset([j0, j1]), distance)
+            for j0, j1, distance in zip(i0, i1, distances)
+        ], unit_cell)
+        pair_search = PairSearchInter(coordinates[::2], coordinates[1::2], cutoff, unit_cell, grid=1.0)
+        self.assert_(pair_search.bins0.cells is not None)
+        self.verify_bins_inter_periodic(pair_search.bins0, pair_search.bins1)
+        i0, i1, deltas, distances = pair_search.get_arrays()
+        self.verify_distances_inter(coordinates[::2], coordinates[1::2], cutoff, [
+            ((j0, j1), distance) for j0, j1, distance in zip(i0, i1, distances)
+        ], unit_cell)
+
+    def test_arrays_intra_dense(self):
+        # More pairs than the initial size of the output arrays.
+        coordinates = numpy.random.uniform(0,1,(200,3))
+        i0, i1, deltas, distances = PairSearchIntra(coordinates, 2.0).get_arrays()
+        self.assertEqual(len(distances), 200*199/2)
+        self.assertEqual(len(set(zip(i0, i1))), 200*199/2)
+
+    def verify_neighbor_list(self, neighbor_list, coordinates, cutoff, unit_cell=None):
+        i0, i1, deltas, distances = neighbor_list.get_arrays()
+        j0, j1, deltas_ref, distances_ref = PairSearchIntra(coordinates, cutoff, unit_cell).get_arrays()
+        pairs = dict(((k0, k1), distance) for k0, k1, distance in zip(i0, i1, distances))
+        pairs_ref = dict(((k0, k1), distance) for k0, k1, distance in zip(j0, j1, distances_ref))
+        self.assertEqual(set(pairs), set(pairs_ref))
+        for key, distance in pairs.iteritems():
+            self.assertAlmostEqual(distance, pairs_ref[key])
+        if unit_cell is None:
+            self.assert_(abs(deltas - (coordinates[i1] - coordinates[i0])).max() < 1e-10)
+        else:
+            self.assert_(abs(deltas - unit_cell.shortest_vector(coordinates[i1] - coordinates[i0])).max() < 1e-10)
+
+    def test_neighbor_list(self):
+        coordinates = numpy.random.uniform(0,10,(100,3))
+        neighbor_list = NeighborList(3.0, 0.4)
+        self.assertRaises(RuntimeError, neighbor_list.get_arrays)
+        self.assert_(neighbor_list.update(coordinates))
+        for i in xrange(20):
+            self.verify_neighbor_list(neighbor_list, coordinates, 3.0)
+            coordinates = coordinates + numpy.random.uniform(-0.05,0.05,coordinates.shape)
+            neighbor_list.update(coordinates)
+        self.assert_(neighbor_list.num_builds > 1)
+        self.assert_(neighbor_list.num_builds < 20)
+
+    def test_neighbor_list_periodic(self):
+        unit_cell = UnitCell(numpy.array([[10.0, 1.0, 0.0], [0.0, 9.0, 2.0], [0.0, 0.0, 11.0]]))
+        coordinates = unit_cell.to_cartesian(numpy.random.uniform(0,1,(100,3)))
+        neighbor_list = NeighborList(3.0, 0.5, unit_cell)
+        for i in xrange(20):
+            neighbor_list.update(coordinates)
+            self.verify_neighbor_list(neighbor_list, coordinates, 3.0, unit_cell)
+            coordinates = coordinates + numpy.random.uniform(-0.05,0.05,coordinates.shape)
+            # put atoms back in the central cell, which does not trigger a rebuild
+            fractional = unit_cell.to_fractional(coordinates)
+            coordinates = unit_cell.to_cartesian(fractional - numpy.floor(fractional))
+        self.assert_(neighbor_list.num_builds < 20)
+
+    def test_binning_compact(self):
+        coordinates = numpy.random.uniform(-5,5,(100,3))
+        bins = PairSearchIntra(coordinates, 2.0).bins
+        self.assertEqual(bins.offsets[-1], 100)
+        self.assertEqual(sorted(bins.order), range(100))
+        for key, indexes in bins:
+            self.assert_(len(indexes) > 0)
+            for i in indexes:
+                fractional = bins.grid_cell.to_fractional(coordinates[i])
+                self.assertEqual(key, tuple(numpy.floor(fractional).astype(int)))
+
+    def test_arrays_intra_skewed_grid(self):
+        # The unit cell vectors are not parallel to those of the grid.
+        unit_cell = UnitCell(numpy.array([[6.0, 3.0, 0.0], [0.0, 6.0, 0.0], [0.0, 0.0, 6.0]]))
+        for i in xrange(5):
+            coordinates = numpy.random.uniform(-10,10,(50,3))
+            pair_search = PairSearchIntra(coordinates, 2.5, unit_cell, 1.5)
+            self.verify_bins_intra_periodic(pair_search.bins)
+            i0, i1, deltas, distances = pair_search.get_arrays()
+            distances = [
+                (frozenset([j0, j1]), distance)
+                for j0, j1, distance in zip(i0, i1, distances)
+            ]
+            self.verify_distances_intra(coordinates, 2.5, distances, unit_cell)
+
+    def test_arrays_intra_exact(self):
+        for i in xrange(10):
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(-5,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.active.any() and unit_cell.spacings[unit_cell.active].min() > 0.5:
+                    break
+            coordinates = numpy.random.uniform(-5,5,(40,3))
+            cutoff = numpy.random.uniform(1, 4)
+            i0, i1, deltas, distances = PairSearchIntra(coordinates, cutoff, unit_cell, exact=True).get_arrays()
+            self.assert_(abs(deltas - unit_cell.shortest_vector(coordinates[i1] - coordinates[i0], exact=True)).max() < 1e-10)
+            # brute force
+            j0, j1 = numpy.tril_indices(len(coordinates), -1)
+            deltas_ref = unit_cell.shortest_vector(coordinates[j1] - coordinates[j0], exact=True)
+            mask = (deltas_ref**2).sum(axis=1) <= cutoff**2
+            self.assertEqual(set(zip(i0, i1)), set(zip(j0[mask], j1[mask])))
+
+    def test_arrays_inter_exact(self):
+        unit_cell = UnitCell(numpy.array([[5.0, 4.0, 3.5], [0.0, 1.0, 0.5], [0.0, 0.0, 1.5]]))
+        coordinates0 = numpy.random.uniform(-5,5,(40,3))
+        coordinates1 = numpy.random.uniform(-5,5,(40,3))
+        i0, i1, deltas, distances = PairSearchInter(coordinates0, coordinates1, 2.0, unit_cell, exact=True).get_arrays()
+        deltas_ref = unit_cell.shortest_vector(coordinates1[i1] - coordinates0[i0], exact=True)
+        self.assert_(abs(deltas - deltas_ref).max() < 1e-10)
+        j0, j1 = numpy.indices((40, 40)).reshape(2, -1)
+        deltas_ref = unit_cell.shortest_vector(coordinates1[j1] - coordinates0[j0], exact=True)
+        mask = (deltas_ref**2).sum(axis=1) <= 2.0**2
+        self.assertEqual(set(zip(i0, i1)), set(zip(j0[mask], j1[mask])))
+
+    def test_arrays_images(self):
+        for i in xrange(10):
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(-2,2,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.active.any() and unit_cell.spacings[unit_cell.active].min() > 0.5:
+                    break
+            coordinates = numpy.random.uniform(-3,3,(10,3))
+            # larger than half the spacings
+            cutoff = numpy.random.uniform(1, 4)
+            pair_search = PairSearchImages(coordinates, cutoff, unit_cell)
+            i0, i1, images, deltas, distances = pair_search.get_arrays()
+            deltas_ref = coordinates[i1] - coordinates[i0] + unit_cell.to_cartesian(images)
+            self.assert_(abs(deltas - deltas_ref).max() < 1e-10)
+            self.assert_(abs(numpy.sqrt((deltas**2).sum(axis=1)) - distances).max() < 1e-10)
+            self.assert_((images[:,True^unit_cell.active] == 0).all())
+            # brute force
+            ranges = unit_cell.get_radius_ranges(cutoff) + unit_cell.active
+            indexes = numpy.indices(2*ranges+1).reshape(3, -1).transpose() - ranges
+            expected = set([])
+            for j0 in xrange(len(coordinates)):
+                for j1 in xrange(j0+1):
+                    delta = coordinates[j1] - coordinates[j0]
+                    center = -numpy.floor(unit_cell.to_fractional(delta) + 0.5).astype(int)
+                    for image in indexes + center:
+                        signs = image[image != 0]
+                        if j1 == j0 and (len(signs) == 0 or signs[0] < 0):
+                            continue
+                        if numpy.linalg.norm(delta + unit_cell.to_cartesian(image)) <= cutoff:
+                            expected.add((j0, j1) + tuple(image))
+            found = [(j0, j1) + tuple(image) for j0, j1, image in zip(i0, i1, images)]
+            self.assertEqual(len(found), len(set(found)))
+            self.assertEqual(set(found), expected)
+
+    def test_arrays_workers(self):
+        coordinates = numpy.random.uniform(0,10,(500,3))
+        unit_cell = UnitCell(numpy.identity(3)*10)
+        for workers in 2, 3, 7:
+            for pair_search in [
+                PairSearchIntra(coordinates, 2.0),
+                PairSearchIntra(coordinates, 2.0, unit_cell),
+                PairSearchInter(coordinates[:200], coordinates[200:], 2.0, unit_cell),
+            ]:
+                result_serial = pair_search.get_arrays()
+                pair_search.workers = workers
+                result_parallel = pair_search.get_arrays()
+                for array_serial, array_parallel in zip(result_serial, result_parallel):
+                    self.assert_((array_serial == array_parallel).all())
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from molmod.compositeff import *
+from molmod.pairff import CoulombFF, DispersionFF, PauliFF
+from molmod.toyff import ToyFF
+from molmod.molecules import Molecule
+from molmod.molecular_graphs import MolecularGraph
+from molmod.unit_cells import UnitCell
+from molmod.units import angstrom
+
+import unittest, numpy, os
+
+
+__all__ = ["CompositeFFTestCase"]
+
+
+class CompositeFFTestCase(unittest.TestCase):
+    def get_terms(self, size, cutoff=None, unit_cell=None):
+        if cutoff is None:
+            scaling = 1 - numpy.identity(size)
+        else:
+            scaling = None
+        charges = numpy.random.uniform(-1, 1, size)
+        strengths = numpy.random.uniform(1, 2, (size, size))
+        strengths = 0.5*(strengths + strengths.transpose())
+        return [
+            CoulombFF(scaling, charges, cutoff=cutoff, unit_cell=unit_cell),
+            DispersionFF(scaling, strengths, cutoff=cutoff, unit_cell=unit_cell),
+            PauliFF(scaling, strengths, cutoff=None if cutoff is None else 0.8*cutoff, unit_cell=unit_cell),
+        ]
+
+    def check_sum(self, terms, x):
+        ff = CompositeFF(terms)
+        energy, gradient = ff(x, True)
+        self.assertAlmostEqual(ff(x), energy)
+        self.assertEqual(ff.names[0], "CoulombFF")
+        # compare with the separate evaluation of each term
+        expected_energies = []
+        expected_gradient = numpy.zeros(len(x), float)
+        for term in terms:
+            if hasattr(term, "update_coordinates"):
+                term.update_coordinates(x.reshape((-1, 3)))
+                expected_energies.append(term.energy())
+                expected_gradient += term.gradient().ravel()
+            else:
+                term_energy, term_gradient = term(x, True)
+                expected_energies.append(term_energy)
+                expected_gradient += term_gradient
+        # Random geometries may contain close contacts with steep terms, hence
+        # the relative tolerances.
+        scale = abs(numpy.array(expected_energies)).max()
+        for energy1, energy2 in zip(ff.energies, expected_energies):
+            self.assert_(abs(energy1 - energy2) <= 1e-10*scale)
+        self.assert_(abs(energy - sum(expected_energies)) <= 1e-10*scale)
+        self.assert_(abs(gradient - expected_gradient).max() <= 1e-10*abs(expected_gradient).max())
+        self.assertEqual(len(ff.timings), len(terms))
+
+    def test_dense(self):
+        molecule = Molecule.from_file(os.path.join("input", "dopamine.xyz"))
+        graph = MolecularGraph.from_geometry(molecule)
+        toyff = ToyFF(graph)
+        toyff.bond_quad = 1.0
+        toyff.dm_reci = 0.2
+        terms = [toyff] + self.get_terms(molecule.size)
+        self.check_sum(terms[1:] + terms[:1], molecule.coordinates.ravel())
+
+    def test_cutoff(self):
+        unit_cell = UnitCell(numpy.identity(3)*20.0)
+        x = numpy.random.uniform(0, 20.0, 300)
+        terms = self.get_terms(100, 6.0, unit_cell)
+        ff = CompositeFF(terms)
+        self.assertAlmostEqual(ff.neighbor_list.cutoff, 6.0)
+        self.check_sum(terms, x)
+        # small displacements reuse the neighbor list
+        ff(x, True)
+        ff(x + numpy.random.uniform(-0.01, 0.01, 300), True)
+        self.assertEqual(ff.neighbor_list.num_builds, 1)
+        # all terms with a cutoff must use the same unit cell
+        terms.append(CoulombFF(None, numpy.ones(100), cutoff=5.0))
+        self.assertRaises(ValueError, CompositeFF, terms)
+        self.assertRaises(TypeError, CompositeFF, terms[:2], ["a"])
+
+    def test_function(self):
+        x = numpy.random.uniform(0, 5.0, 30)
+        def harmonic(x, do_gradient=False):
+            if do_gradient:
+                return 0.5*(x**2).sum(), x.copy()
+            else:
+                return 0.5*(x**2).sum()
+        terms = self.get_terms(10)
+        self.check_sum(terms + [harmonic], x)
+        ff = CompositeFF(terms + [harmonic], ["ei", "disp", "pauli", "harmonic"])
+        ff(x)
+        self.assertAlmostEqual(ff.energies[3], 0.5*(x**2).sum())
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from molmod.ewald import *
+from molmod.unit_cells import UnitCell
+
+import numpy, unittest
+
+
+__all__ = ["EwaldTestCase"]
+
+
+class EwaldTestCase(unittest.TestCase):
+    def get_rocksalt(self, size=2.0):
+        # conventional cubic cell of NaCl with a nearest-neighbor distance of size/2
+        unit_cell = UnitCell(numpy.identity(3)*size)
+        fractional = numpy.array([
+            [0.0, 0.0, 0.0], [0.0, 0.5, 0.5], [0.5, 0.0, 0.5], [0.5, 0.5, 0.0],
+            [0.5, 0.5, 0.5], [0.5, 0.0, 0.0], [0.0, 0.5, 0.0], [0.0, 0.0, 0.5],
+        ])
+        charges = numpy.array([1.0]*4 + [-1.0]*4)
+        return charges, unit_cell, unit_cell.to_cartesian(fractional)
+
+    def get_random(self, size=20):
+        matrix = numpy.identity(3)*8.0 + numpy.random.uniform(-1, 1, (3, 3))
+        unit_cell = UnitCell(matrix)
+        coordinates = unit_cell.to_cartesian(numpy.random.uniform(0, 1, (size, 3)))
+        charges = numpy.random.uniform(-1, 1, size)
+        charges -= charges.mean()
+        return charges, unit_cell, coordinates
+
+    def check_gradient(self, ff, coordinates):
+        energy = ff.energy()
+        gradient = ff.gradient()
+        eps = 1e-5
+        for i in xrange(3):
+            for c in xrange(3):
+                tmp = coordinates.copy()
+                tmp[i, c] += eps
+                ff.update_coordinates(tmp)
+                energy1 = ff.energy()
+                tmp[i, c] -= 2*eps
+                ff.update_coordinates(tmp)
+                energy2 = ff.energy()
+                self.assertAlmostEqual((energy1 - energy2)/(2*eps), gradient[i, c], 5)
+        ff.update_coordinates(coordinates)
+
+    def test_madelung(self):
+        charges, unit_cell, coordinates = self.get_rocksalt()
+        for alpha in 1.0, 2.0, 3.0:
+            ff = EwaldFF(charges, unit_cell, coordinates, alpha=alpha, accuracy=1e-12)
+            # four ion pairs, nearest-neighbor distance 1
+            self.assertAlmostEqual(ff.energy()/4, -1.747564594633, 8)
+            self.assert_(abs(ff.gradient()).max() < 1e-8)
+
+    def test_alpha(self):
+        charges, unit_cell, coordinates = self.get_random()
+        ff1 = EwaldFF(charges, unit_cell, coordinates, alpha=0.3, accuracy=1e-12)
+        ff2 = EwaldFF(charges, unit_cell, coordinates, alpha=0.6, accuracy=1e-12)
+        ff3 = EwaldFF(charges, unit_cell, coordinates, accuracy=1e-12)
+        self.assertAlmostEqual(ff1.energy(), ff2.energy(), 8)
+        self.assertAlmostEqual(ff1.energy(), ff3.energy(), 8)
+        self.assert_(abs(ff1.gradient() - ff2.gradient()).max() < 1e-7)
+
+    def test_charged(self):
+        # with the neutralizing background, the result is independent of alpha
+        charges, unit_cell, coordinates = self.get_random()
+        charges += 0.1
+        ff1 = EwaldFF(charges, unit_cell, coordinates, alpha=0.3, accuracy=1e-12)
+        ff2 = EwaldFF(charges, unit_cell, coordinates, alpha=0.6, accuracy=1e-12)
+        self.assertAlmostEqual(ff1.energy(), ff2.energy(), 8)
+
+    def test_gradient(self):
+        charges, unit_cell, coordinates = self.get_random()
+        self.check_gradient(EwaldFF(charges, unit_cell, coordinates), coordinates)
+        self.check_gradient(PMEFF(charges, unit_cell, coordinates, rcut=6.0), coordinates)
+
+    def test_pme(self):
+        charges, unit_cell, coordinates = self.get_random(50)
+        ff_ref = EwaldFF(charges, unit_cell, coordinates, accuracy=1e-12)
+        for order in 6, 7, 8:
+            ff = PMEFF(charges, unit_cell, coordinates, rcut=6.0, order=order, spacing=0.3)
+            self.assert_(abs(ff.energy() - ff_ref.energy()) < 1e-4*abs(ff_ref.energy()))
+            error = abs(ff.gradient() - ff_ref.gradient()).max()
+            self.assert_(error < 1e-3*abs(ff_ref.gradient()).max())
+        ff = PMEFF(charges, unit_cell, coordinates, rcut=6.0, shape=[20, 24, 25])
+        self.assertEqual(list(ff.shape), [20, 24, 25])
+
+    def test_pme_madelung(self):
+        charges, unit_cell, coordinates = self.get_rocksalt(10.0)
+        ff = PMEFF(charges, unit_cell, coordinates, rcut=9.0, spacing=0.4)
+        self.assertAlmostEqual(ff.energy()/4*5, -1.747564594633, 5)
+
+    def test_errors(self):
+        charges, unit_cell, coordinates = self.get_random()
+        unit_cell = UnitCell(unit_cell.matrix, [True, True, False])
+        self.assertRaises(ValueError, EwaldFF, charges, unit_cell, coordinates)
+        charges, unit_cell, coordinates = self.get_random()
+        self.assertRaises(ValueError, PMEFF, charges, unit_cell, coordinates, order=2)
+        self.assertRaises(ValueError, PMEFF, charges, unit_cell, coordinates, shape=[4, 20, 20])
@@ -289,6 +289,27 @@ class GraphTestCase(unittest.TestCase):
         self.assertEqual(expecting.shape,graph.distances.shape)
         self.assert_((expecting==graph.distances).all())
 
+    def test_distances_bfs(self):
+        from molmod.ext import graphs_floyd_warshall
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            expected = numpy.zeros((g.num_vertices,)*2, numpy.int32)
+            expected[g.edge_array[:, 0], g.edge_array[:, 1]] = 1
+            expected[g.edge_array[:, 1], g.edge_array[:, 0]] = 1
+            graphs_floyd_warshall(expected)
+            self.assert_((g.distances == expected).all())
+            self.assert_((g.eccentricities == expected.max(axis=1)).all())
+            self.assertEqual(g.max_distance, expected.max())
+            for max_distance in 0, 1, 2, 3:
+                pairs, distances = g.distances_upto(max_distance)
+                self.assert_((pairs[:, 0] < pairs[:, 1]).all())
+                self.assert_((distances == expected[pairs[:, 0], pairs[:, 1]]).all())
+                mask = (expected > 0) & (expected <= max_distance)
+                self.assertEqual(len(pairs), mask.sum()/2)
+        g = Graph([], 3)
+        self.assert_((g.distances == 0).all())
+        self.assertEqual(len(g.distances_upto(2)[0]), 0)
+
     def test_neighbors(self):
         for case in self.iter_cases():
             g = case.graph
@@ -299,6 +320,44 @@ class GraphTestCase(unittest.TestCase):
                     self.assert_(frozenset([central,neighbor]) in g.edges)
             self.assertEqual(counter, len(g.edges)*2)
 
+    def test_edge_array(self):
+        import pickle
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            self.assertEqual(g.edge_array.dtype, numpy.int32)
+            self.assertEqual(g.edge_array.shape, (g.num_edges, 2))
+            self.assert_((g.edge_array[:, 0] < g.edge_array[:, 1]).all())
+            for row, edge in zip(g.edge_array, g.edges):
+                self.assertEqual(frozenset(row), edge)
+            # construction from an array gives the same graph
+            g2 = Graph(g.edge_array[:, ::-1].astype(int), g.num_vertices)
+            self.assertEqual(g2.edges, g.edges)
+            # the neighbors in the CSR format
+            self.assertEqual(len(g.neighbor_offsets), g.num_vertices+1)
+            for vertex in xrange(g.num_vertices):
+                row = g.neighbor_indexes[g.neighbor_offsets[vertex]:g.neighbor_offsets[vertex+1]]
+                self.assert_((row[1:] > row[:-1]).all())
+                self.assertEqual(frozenset(row), g.neighbors[vertex])
+            # copies
+            g3 = g.copy_with()
+            self.assertEqual(g3.edges, g.edges)
+            self.assertEqual(g3.num_vertices, g.num_vertices)
+            g4 = pickle.loads(pickle.dumps(g))
+            self.assertEqual(g4.edges, g.edges)
+        g = Graph(numpy.array([[0, 1], [1, 2]])).copy_with(edge_array=numpy.array([[0, 2]]))
+        self.assertEqual(g.edges, (frozenset([0, 2]),))
+        self.assertRaises(ValueError, Graph, numpy.array([[0, 1], [1, 1]]))
+        self.assertRaises(TypeError, Graph, numpy.array([[0, 1], [1, -2]]))
+        self.assertRaises(TypeError, Graph, numpy.array([[0, 1, 2]]))
+        self.assertRaises(TypeError, Graph, numpy.array([[0.0, 1.0]]))
+
+    def test_mul(self):
+        g = Graph([(0, 1), (1, 2)])*3
+        self.assertEqual(g.num_vertices, 9)
+        self.assertEqual(g.edges, tuple(
+            frozenset([i+3*k, i+1+3*k]) for k in xrange(3) for i in xrange(2)
+        ))
+
     def test_central_vertices(self):
         for case in self.iter_cases():
             g = case.graph
@@ -314,6 +373,17 @@ class GraphTestCase(unittest.TestCase):
         g = Graph(edges)
         self.assertEqual(g.independent_vertices, [[0, 1, 2, 3, 4, 5], [6, 7, 8, 9, 10, 11]])
 
+    def test_components(self):
+        g = Graph([(0, 5), (1, 2), (5, 3), (2, 6)], 8)
+        self.assertEqual(g.components.tolist(), [0, 1, 1, 0, 2, 0, 1, 3])
+        self.assertEqual(g.independent_vertices, [[0, 3, 5], [1, 2, 6], [4], [7]])
+        self.assertEqual(Graph([], 2).independent_vertices, [[0], [1]])
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            for group in g.independent_vertices:
+                self.assert_((g.components[group] == g.components[group[0]]).all())
+                self.assertEqual(sorted(v for v, d in g.iter_breadth_first(group[0])), group)
+
     def test_fingerprints(self):
         for case in self.iter_cases():
             g0 = case.graph
@@ -324,6 +394,51 @@ class GraphTestCase(unittest.TestCase):
             for i in xrange(g0.num_vertices):
                 self.assert_((g0.vertex_fingerprints[i]==g1.vertex_fingerprints[permutation[i]]).all())
 
+    def test_fingerprint_refinement(self):
+        # a chain of seven vertices and an isolated vertex
+        g = Graph([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6)], 8)
+        expected = [[0, 6], [1, 5], [2, 4], [3], [2, 4], [1, 5], [0, 6], [7]]
+        for i in xrange(g.num_vertices):
+            self.assertEqual(g.equivalent_vertices[i], set(expected[i]))
+        self.assertEqual(g.vertex_fingerprints.shape, (8, 16))
+        self.assertEqual(g.fingerprint.shape, (16,))
+        # a limited number of iterations can not distinguish all vertices
+        fingerprints = g.get_vertex_fingerprints([""]*8, [""]*6, num_iter=1)
+        self.assert_((fingerprints[2] == fingerprints[3]).all())
+        self.assert_((fingerprints[1] != fingerprints[2]).any())
+
+    def test_canonical_order(self):
+        def check(g0):
+            order0 = g0.canonical_order
+            g0_bis = g0.get_subgraph(order0, normalize=True)
+            for i in xrange(3):
+                permutation = numpy.random.permutation(g0.num_vertices)
+                new_edges = tuple((permutation[i], permutation[j]) for i,j in g0.edges)
+                g1 = Graph(new_edges, g0.num_vertices)
+                order1 = g1.canonical_order
+                self.assertEqual(sorted(order1), sorted(permutation[order0]))
+                g1_bis = g1.get_subgraph(order1, normalize=True)
+                self.assertEqual(g0_bis.edges, g1_bis.edges)
+                self.assertEqual(g0.canonical_hash, g1.canonical_hash)
+
+        for case in self.iter_cases(disconnected=True):
+            check(case.graph)
+        # a hypercube and a periodic grid are highly symmetric
+        edges = [(i, i ^ (1 << b)) for i in xrange(32) for b in xrange(5) if i < i ^ (1 << b)]
+        check(Graph(edges))
+        indexes = numpy.arange(216).reshape(6, 6, 6)
+        check(Graph(numpy.concatenate([
+            numpy.array([indexes.ravel(), numpy.roll(indexes, 1, axis=axis).ravel()]).T
+            for axis in xrange(3)
+        ])))
+
+    def test_canonical_hash(self):
+        # two triangles and a hexagon have the same fingerprints
+        g0 = Graph([(0, 1), (1, 2), (2, 0), (3, 4), (4, 5), (5, 3)])
+        g1 = Graph([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 0)])
+        self.assert_((g0.fingerprint == g1.fingerprint).all())
+        self.assertNotEqual(g0.canonical_hash, g1.canonical_hash)
+
     def test_symmetries(self):
         cases = self.iter_cases()
         for case in cases:
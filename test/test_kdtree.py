@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from molmod.kdtree import *
+
+import numpy, unittest
+
+
+__all__ = ["KDTreeTestCase"]
+
+
+class KDTreeTestCase(unittest.TestCase):
+    def get_distances(self, coordinates, points):
+        deltas = points.reshape(-1, 1, 3) - coordinates
+        return numpy.sqrt((deltas**2).sum(axis=2))
+
+    def test_knn(self):
+        for leafsize in 1, 2, 16:
+            coordinates = numpy.random.uniform(0, 10, (200, 3))
+            tree = KDTree(coordinates, leafsize)
+            points = numpy.random.uniform(-2, 12, (50, 3))
+            indexes, distances = tree.query_knn_batch(points, 5)
+            self.assertEqual(indexes.shape, (50, 5))
+            all_distances = self.get_distances(coordinates, points)
+            for i in xrange(len(points)):
+                expected = all_distances[i].argsort()[:5]
+                self.assertEqual(list(indexes[i]), list(expected))
+                self.assert_(abs(distances[i] - all_distances[i, expected]).max() < 1e-10)
+            index, distance = tree.query_knn(points[0], 5)
+            self.assertEqual(list(index), list(indexes[0]))
+
+    def test_radius(self):
+        coordinates = numpy.random.uniform(0, 10, (300, 3))
+        tree = KDTree(coordinates, 4)
+        points = numpy.random.uniform(0, 10, (40, 3))
+        offsets, indexes, distances = tree.query_radius_batch(points, 2.5)
+        self.assertEqual(len(offsets), 41)
+        all_distances = self.get_distances(coordinates, points)
+        for i in xrange(len(points)):
+            expected = (all_distances[i] <= 2.5).nonzero()[0]
+            expected = expected[all_distances[i, expected].argsort()]
+            self.assertEqual(list(indexes[offsets[i]:offsets[i+1]]), list(expected))
+            self.assert_(abs(distances[offsets[i]:offsets[i+1]] - all_distances[i, expected]).max() < 1e-10)
+        index, distance = tree.query_radius(points[0], 2.5)
+        self.assertEqual(list(index), list(indexes[offsets[0]:offsets[1]]))
+        # no results
+        index, distance = tree.query_radius([100.0, 0.0, 0.0], 2.5)
+        self.assertEqual(len(index), 0)
+
+    def test_subset(self):
+        coordinates = numpy.random.uniform(0, 10, (100, 3))
+        subset = numpy.arange(1, 100, 3)
+        tree = KDTree(coordinates, subset=subset)
+        point = numpy.random.uniform(0, 10, 3)
+        index, distance = tree.query_knn(point, 1)
+        distances = numpy.sqrt(((coordinates[subset] - point)**2).sum(axis=1))
+        self.assertEqual(index[0], subset[distances.argmin()])
+        self.assertAlmostEqual(distance[0], distances.min())
+
+    def test_duplicates(self):
+        coordinates = numpy.zeros((50, 3), float)
+        coordinates[25:, 0] = 1.0
+        tree = KDTree(coordinates, 2)
+        index, distance = tree.query_radius([0.1, 0.0, 0.0], 0.5)
+        self.assertEqual(sorted(index), range(25))
+        index, distance = tree.query_knn([0.9, 0.0, 0.0], 25)
+        self.assertEqual(sorted(index), range(25, 50))
+
+    def test_errors(self):
+        tree = KDTree(numpy.random.uniform(0, 10, (10, 3)))
+        self.assertRaises(ValueError, tree.query_knn, numpy.zeros(3), 11)
+        self.assertRaises(ValueError, tree.query_knn, numpy.zeros(3), 0)
+        self.assertRaises(TypeError, tree.query_radius, numpy.zeros(2), 1.0)
+        self.assertRaises(ValueError, KDTree, numpy.zeros((10, 3)), 0)
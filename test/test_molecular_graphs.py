@@ -443,23 +443,34 @@ class MolecularGraphTestCase(unittest.TestCase):
             self.assertEqual(len(match), g.num_vertices)
 
     def test_canonical_order(self):
-        # TODO: analogous tests voor pure graphs + fixen
-        for molecule in self.iter_molecules():
-            try:
-                g0 = molecule.graph
-                order0 = g0.canonical_order
-                g0_bis = g0.get_subgraph(order0, normalize=True)
-
-                permutation = numpy.random.permutation(g0.num_vertices)
-                g1 = g0.get_subgraph(permutation, normalize=True)
-                order1 = g1.canonical_order
-                g1_bis = g1.get_subgraph(order1, normalize=True)
+        for molecule in self.iter_molecules(allow_multi=True):
+            g0 = molecule.graph
+            order0 = g0.canonical_order
+            g0_bis = g0.get_subgraph(order0, normalize=True)
 
-                self.assertEqual(str(g0_bis), str(g1_bis))
-                self.assert_((g0_bis.numbers==g1_bis.numbers).all())
-                self.assert_((g0_bis.orders==g1_bis.orders).all())
-            except NotImplementedError:
-                pass
+            permutation = numpy.random.permutation(g0.num_vertices)
+            g1 = g0.get_subgraph(permutation, normalize=True)
+            order1 = g1.canonical_order
+            g1_bis = g1.get_subgraph(order1, normalize=True)
+
+            self.assertEqual(str(g0_bis), str(g1_bis))
+            self.assert_((g0_bis.numbers==g1_bis.numbers).all())
+            self.assert_((g0_bis.orders==g1_bis.orders).all())
+            self.assertEqual(g0.canonical_hash, g1.canonical_hash)
+
+    def test_canonical_hash_numbers(self):
+        g0 = MolecularGraph([(0, 1), (0, 2)], numpy.array([8, 1, 1]))
+        g1 = MolecularGraph([(0, 1), (0, 2)], numpy.array([16, 1, 1]))
+        self.assertNotEqual(g0.canonical_hash, g1.canonical_hash)
+
+    def test_canonical_order_allene(self):
+        g0 = MolecularGraph([(0, 1), (1, 2), (0, 3), (0, 4), (2, 5), (2, 6)], numpy.array([6, 6, 6, 1, 1, 1, 1]))
+        order0 = g0.canonical_order
+        self.assertEqual(order0[0], 1)
+        for i in xrange(5):
+            g1 = g0.get_subgraph(numpy.random.permutation(7), normalize=True)
+            order1 = g1.canonical_order
+            self.assertEqual(str(g0.get_subgraph(order0, normalize=True)), str(g1.get_subgraph(order1, normalize=True)))
 
     def test_blob(self):
         for molecule in self.iter_molecules(allow_multi=True):
@@ -542,3 +553,87 @@ class MolecularGraphTestCase(unittest.TestCase):
     def test_copy_with(self):
         for mol in self.iter_molecules():
             graph = mol.graph.copy_with()
+
+    def test_bond_perceiver(self):
+        for mol in self.iter_molecules(allow_multi=True):
+            perceiver = BondPerceiver(mol.numbers, unit_cell=mol.unit_cell)
+            expected = MolecularGraph.from_geometry(mol)
+            formed, broken = perceiver.update(mol.coordinates)
+            self.assertEqual(set(formed), set(tuple(sorted(edge)) for edge in expected.edges))
+            self.assertEqual(broken, [])
+            self.assertEqual(set(perceiver.graph.edges), set(expected.edges))
+            self.assertEqual(perceiver.update(mol.coordinates), ([], []))
+
+    def test_bond_perceiver_scaling(self):
+        from molmod.bonds import bonds
+        # two francium atoms around the largest tabulated bond length
+        numbers = numpy.array([87, 87])
+        for scaling in 0.8, 1.0, 1.5:
+            for factor in 0.7, 0.9, 1.1, 1.2, 1.4:
+                distance = factor*bonds.max_length*bonds.bond_tolerance
+                mol = Molecule(numbers, numpy.array([[0.0, 0.0, 0.0], [0.0, 0.0, distance]]))
+                expected = MolecularGraph.from_geometry(mol, scaling=scaling)
+                perceiver = BondPerceiver(numbers, scaling=scaling)
+                perceiver.update(mol.coordinates)
+                self.assertEqual(set(perceiver.graph.edges), set(expected.edges))
+
+    def test_bond_perceiver_events(self):
+        mol = self.load_molecule("water.xyz")
+        perceiver = BondPerceiver(mol.numbers, mol.graph)
+        self.assertEqual(perceiver.update(mol.coordinates), ([], []))
+        coordinates = mol.coordinates.copy()
+        coordinates[1] += (coordinates[1] - coordinates[0])*2
+        formed, broken = perceiver.update(coordinates)
+        self.assertEqual(formed, [])
+        self.assertEqual(broken, [(0, 1)])
+        self.assertEqual(perceiver.graph.num_edges, 1)
+        formed, broken = perceiver.update(mol.coordinates)
+        self.assertEqual(formed, [(0, 1)])
+        self.assertEqual(broken, [])
+        self.assertEqual(perceiver.graph.num_edges, 2)
+
+    def test_bond_perceiver_trajectory(self):
+        mol = self.load_molecule("thf.xyz")
+        perceiver = BondPerceiver(mol.numbers, mol.graph, skin=0.3*angstrom)
+        edges = set(tuple(sorted(edge)) for edge in mol.graph.edges)
+        coordinates = mol.coordinates.copy()
+        num_events = 0
+        for i in xrange(10):
+            coordinates += numpy.random.normal(0, 0.05*angstrom, coordinates.shape)
+            formed, broken = perceiver.update(coordinates)
+            num_events += len(formed) + len(broken)
+            edges.update(formed)
+            edges.difference_update(broken)
+            expected = MolecularGraph.from_geometry(Molecule(mol.numbers, coordinates))
+            self.assertEqual(set(perceiver.graph.edges), set(expected.edges))
+            self.assertEqual(edges, set(tuple(sorted(edge)) for edge in expected.edges))
+        self.assert_(num_events > 0)
+        self.assert_(perceiver.neighbor_list.num_builds > 1)
+
+    def test_from_geometry_thresholds(self):
+        from molmod.bonds import bonds
+        for numbers in [6, 1], [6, 6], [8, 1], [87, 1]:
+            numbers = numpy.array(numbers)
+            length = bonds.get_length(numbers[0], numbers[1])
+            if length is None:
+                length = bonds.max_length
+            for scaling in 0.8, 1.0, 1.5:
+                for factor in 0.8, 0.95, 1.05, 1.15, 1.3, 1.6:
+                    distance = factor*length
+                    mol = Molecule(numbers, numpy.array([[0.0, 0.0, 0.0], [0.0, distance, 0.0]]))
+                    graph = MolecularGraph.from_geometry(mol, do_orders=True, scaling=scaling)
+                    if distance > bonds.max_length*bonds.bond_tolerance:
+                        expected = None
+                    else:
+                        expected = bonds.bonded(numbers[0], numbers[1], distance/scaling)
+                    if expected is None:
+                        self.assertEqual(graph.num_edges, 0)
+                    else:
+                        self.assertEqual(graph.num_edges, 1)
+                        self.assertEqual(graph.orders[0], expected)
+
+    def test_from_geometry_workers(self):
+        for mol in self.iter_molecules(allow_multi=True):
+            graph1 = MolecularGraph.from_geometry(mol)
+            graph2 = MolecularGraph.from_geometry(mol, workers=3)
+            self.assertEqual(graph1.edges, graph2.edges)
@@ -62,6 +62,20 @@ class MoleculeTestCase(BaseTestCase):
                     distance = numpy.linalg.norm(delta)
                     self.assertAlmostEqual(dm[i,j], distance)
 
+    def test_distance_matrix_float(self):
+        molecule = Molecule.from_file("input/tpa.xyz")
+        coordinates = molecule.coordinates.astype(numpy.float32)
+        molecule32 = Molecule(molecule.numbers, coordinates)
+        dm = molecule32.distance_matrix
+        self.assertEqual(dm.dtype, numpy.float32)
+        self.assert_(abs(dm - molecule.distance_matrix).max() < 1e-5*molecule.distance_matrix.max())
+        unit_cell = UnitCell(numpy.identity(3)*5.0)
+        from molmod.ext import molecules_distance_matrix, molecules_distance_matrix_float
+        dm = molecules_distance_matrix_float(coordinates, unit_cell.matrix, unit_cell.reciprocal)
+        dm_ref = molecules_distance_matrix(molecule.coordinates, unit_cell.matrix, unit_cell.reciprocal)
+        self.assertEqual(dm.dtype, numpy.float32)
+        self.assert_(abs(dm - dm_ref).max() < 1e-5*dm_ref.max())
+
     def test_read_only(self):
         numbers = [8, 1]
         coordinates = [
@@ -86,6 +100,17 @@ class MoleculeTestCase(BaseTestCase):
         molecule.set_default_masses()
         self.assertAlmostEqual(molecule.mass, 32839.849030585152)
 
+    def test_kdtree(self):
+        molecule = Molecule.from_file("input/thf.xyz")
+        point = numpy.array([1.0, 2.0, 0.5])
+        distances = numpy.sqrt(((molecule.coordinates - point)**2).sum(axis=1))
+        indexes, nearest = molecule.kdtree.query_knn(point, 3)
+        self.assertEqual(list(indexes), list(distances.argsort()[:3]))
+        self.assertEqual(sorted(molecule.element_kdtrees), [1, 6, 8])
+        index, distance = molecule.element_kdtrees[6].query_knn(point, 1)
+        carbons = (molecule.numbers == 6).nonzero()[0]
+        self.assertEqual(index[0], carbons[distances[carbons].argmin()])
+
     def test_com(self):
         molecule = Molecule.from_file("input/water.xyz")
         molecule.set_default_masses()
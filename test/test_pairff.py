@@ -241,6 +241,151 @@ class PairFFTestCase(unittest.TestCase):
     def test_debug4ff(self):
         self.check_ff(self.make_debug4ff())
 
+    def test_arrays(self):
+        # compare the vectorized evaluation with the per-pair components
+        numc = 8
+        coordinates = np.random.uniform(-2, 2, (numc, 3))
+        scaling = np.random.uniform(0, 1, (numc, numc))
+        scaling = 0.5*(scaling + scaling.T)
+        scaling[scaling < 0.2] = 0.0
+        atom_values = np.random.uniform(0.1, 1.0, numc)
+        outer = np.outer(atom_values, atom_values)
+        ffs = [
+            molmod.pairff.CoulombFF(scaling.copy(), atom_values - 0.5,
+                np.random.uniform(-1, 1, (numc, 3)), coordinates),
+            molmod.pairff.DispersionFF(scaling.copy(), outer, coordinates),
+            molmod.pairff.PauliFF(scaling.copy(), outer, coordinates),
+            molmod.pairff.ExpRepFF(scaling.copy(), outer, outer, coordinates),
+            Debug4FF(scaling.copy(), coordinates),
+        ]
+        for ff in ffs:
+            energy = 0.0
+            for index1 in xrange(numc):
+                for index2 in xrange(index1):
+                    for se, ve in ff.yield_pair_energies(index1, index2):
+                        energy += se*ve*ff.scaling[index1, index2]
+            self.assert_(abs(ff.energy() - energy) < 1e-10*abs(energy))
+            gradient = ff.gradient()
+            hessian = ff.hessian()
+            for index1 in xrange(numc):
+                expected = ff.gradient_component(index1)
+                error = abs(gradient[index1] - expected).max()
+                self.assert_(error <= 1e-10*abs(expected).max())
+                for index2 in xrange(numc):
+                    expected = ff.hessian_component(index1, index2)
+                    error = abs(hessian[index1, :, index2] - expected).max()
+                    self.assert_(error <= 1e-10*abs(expected).max())
+
+    def test_cutoff(self):
+        numc = 30
+        coordinates = np.random.uniform(0, 6, (numc, 3))
+        scaling = np.random.uniform(0.5, 1, (numc, numc))
+        scaling = 0.5*(scaling + scaling.T)
+        atom_values = np.random.uniform(0.1, 1.0, numc)
+        outer = np.outer(atom_values, atom_values)
+        dipoles = np.random.uniform(-1, 1, (numc, 3))
+        cutoff = 3.0
+        distances = np.sqrt(((coordinates.reshape(-1, 1, 3) - coordinates)**2).sum(axis=2))
+        scaling_ref = scaling*(distances < cutoff)
+        for make in [
+            lambda s, **kwargs: molmod.pairff.DispersionFF(s, outer, coordinates, **kwargs),
+            lambda s, **kwargs: molmod.pairff.ExpRepFF(s, outer, outer, coordinates, **kwargs),
+            lambda s, **kwargs: molmod.pairff.CoulombFF(s, atom_values - 0.5, dipoles, coordinates, **kwargs),
+        ]:
+            ff = make(scaling.copy(), cutoff=cutoff)
+            ff_ref = make(scaling_ref.copy())
+            energy_ref = ff_ref.energy()
+            self.assert_(abs(ff.energy() - energy_ref) < 1e-10*abs(energy_ref))
+            gradient_ref = ff_ref.gradient()
+            self.assert_(abs(ff.gradient() - gradient_ref).max() < 1e-10*abs(gradient_ref).max())
+            hessian_ref = ff_ref.hessian()
+            threshold = 1e-10*abs(hessian_ref).max()
+            self.assert_(abs(ff.hessian() - hessian_ref).max() < threshold)
+            # check the sparse format
+            offsets, columns, blocks = ff.hessian_sparse()
+            self.assertEqual(offsets[-1], len(columns))
+            self.assertEqual(len(columns), numc + 2*len(ff.pair_distances))
+            for i in xrange(numc):
+                row = columns[offsets[i]:offsets[i+1]]
+                self.assert_((row[1:] > row[:-1]).all())
+                self.assert_(i in row)
+                for j, block in zip(row, blocks[offsets[i]:offsets[i+1]]):
+                    self.assert_(abs(block - hessian_ref[i, :, j]).max() < threshold)
+
+    def test_cutoff_types(self):
+        numc = 20
+        coordinates = np.random.uniform(0, 5, (numc, 3))
+        types = np.random.randint(0, 3, numc)
+        table = np.random.uniform(0.1, 1.0, (3, 3))
+        table = table + table.T
+        ff = molmod.pairff.DispersionFF(None, (types, table), coordinates, cutoff=100.0)
+        ff_ref = molmod.pairff.DispersionFF(
+            1 - np.identity(numc), table[types][:, types], coordinates
+        )
+        energy_ref = ff_ref.energy()
+        self.assert_(abs(ff.energy() - energy_ref) < 1e-10*abs(energy_ref))
+        gradient_ref = ff_ref.gradient()
+        self.assert_(abs(ff.gradient() - gradient_ref).max() < 1e-10*abs(gradient_ref).max())
+        self.assertRaises(TypeError, molmod.pairff.DispersionFF, None, table, coordinates)
+
+    def test_cutoff_periodic(self):
+        from molmod.unit_cells import UnitCell
+        numc = 20
+        unit_cell = UnitCell(np.identity(3)*8.0)
+        coordinates = np.random.uniform(0, 8, (numc, 3))
+        As = np.ones((numc, numc))
+        Bs = np.ones((numc, numc))*1.5
+        ff = molmod.pairff.ExpRepFF(None, As, Bs, coordinates, cutoff=3.5, unit_cell=unit_cell)
+        energy = ff.energy()
+        gradient = ff.gradient()
+        # compare with an explicit sum over the minimum images
+        energy_ref = 0.0
+        for i in xrange(numc):
+            for j in xrange(i):
+                d = np.linalg.norm(unit_cell.shortest_vector(coordinates[i] - coordinates[j]))
+                if d < 3.5:
+                    energy_ref += np.exp(-1.5*d)
+        self.assertAlmostEqual(energy, energy_ref)
+        # finite differences
+        eps = 1e-6
+        for i in xrange(3):
+            tmp = coordinates.copy()
+            tmp[i, 0] += eps
+            ff.update_coordinates(tmp)
+            self.assertAlmostEqual((ff.energy() - energy)/eps, gradient[i, 0], 4)
+        self.assertRaises(ValueError, molmod.pairff.ExpRepFF, None, As, Bs, coordinates, unit_cell=unit_cell)
+        # a threaded pair search gives the same pairs
+        ff2 = molmod.pairff.ExpRepFF(None, As, Bs, coordinates, cutoff=3.5, unit_cell=unit_cell, workers=2)
+        self.assertEqual(ff2.workers, 2)
+        self.assertAlmostEqual(ff2.energy(), energy)
+        self.assertAlmostEqual(ff2.batch(coordinates.reshape(1, numc, 3))[0], energy)
+
+    def test_batch(self):
+        from molmod.unit_cells import UnitCell
+        numc = 20
+        stack = np.random.uniform(0, 6, (4, numc, 3))
+        scaling = np.random.uniform(0.5, 1, (numc, numc))
+        scaling = 0.5*(scaling + scaling.T)
+        atom_values = np.random.uniform(0.1, 1.0, numc)
+        outer = np.outer(atom_values, atom_values)
+        dipoles = np.random.uniform(-1, 1, (numc, 3))
+        for kwargs in {}, {"cutoff": 3.0}, {"cutoff": 2.5, "unit_cell": UnitCell(np.identity(3)*6.0)}:
+            for ff in [
+                molmod.pairff.DispersionFF(scaling.copy(), outer, **kwargs),
+                molmod.pairff.ExpRepFF(scaling.copy(), outer, outer, **kwargs),
+                molmod.pairff.CoulombFF(scaling.copy(), atom_values - 0.5, dipoles, **kwargs),
+            ]:
+                energies, gradients = ff.batch(stack, do_gradient=True)
+                self.assertEqual(energies.shape, (4,))
+                self.assertEqual(gradients.shape, (4, numc, 3))
+                self.assert_(abs(ff.batch(stack) - energies).max() < 1e-10*abs(energies).max())
+                for i in xrange(4):
+                    ff.update_coordinates(stack[i])
+                    energy = ff.energy()
+                    self.assert_(abs(energies[i] - energy) < 1e-10*abs(energy))
+                    gradient = ff.gradient()
+                    self.assert_(abs(gradients[i] - gradient).max() < 1e-10*abs(gradient).max())
+
     def check_ff(self, ff):
         coordinates = ff.coordinates
         numc = len(coordinates)
@@ -513,6 +658,67 @@ class CoulombFFTestCase(BaseTestCase):
                 ex_center[j] += eps
                 self.assertAlmostEqual(-efield0[j], (ff.esp_point(ex_center) - esp0)/eps, 3)
 
+    def test_points_cutoff(self):
+        coordinates = np.random.uniform(0, 20, (50,3))
+        scaling = 1 - np.identity(50, float)
+        charges = np.random.uniform(-1, 1, 50)
+        dipoles = np.random.uniform(-1, 1, (50,3))
+        ff = molmod.pairff.CoulombFF(scaling, charges=charges, dipoles=dipoles, coordinates=coordinates)
+        points = coordinates[:10] + np.random.uniform(-0.5, 0.5, (10,3))
+        # a cutoff larger than the system must reproduce the exact result
+        self.assertArraysAlmostEqual(ff.esp_points(points, 100.0), ff.esp_points(points))
+        self.assertArraysAlmostEqual(ff.efield_points(points, 100.0), ff.efield_points(points))
+        for point in points:
+            self.assertAlmostEqual(ff.esp_point(point), ff.esp_points([point])[0])
+            mask = np.sqrt(((coordinates - point)**2).sum(axis=1)) <= 5.0
+            ff_part = molmod.pairff.CoulombFF(
+                scaling[mask][:,mask], charges=charges[mask],
+                dipoles=dipoles[mask], coordinates=coordinates[mask]
+            )
+            self.assertAlmostEqual(ff.esp_point(point, 5.0), ff_part.esp_point(point))
+            self.assertArraysAlmostEqual(ff.efield_point(point, 5.0), ff_part.efield_point(point))
+
+    def test_grid(self):
+        from molmod.io.cube import Cube
+        cube = Cube.from_file('input/alanine.cube')
+        size = cube.molecule.size
+        scaling = 1 - np.identity(size, float)
+        charges = np.random.uniform(-1, 1, size)
+        dipoles = np.random.uniform(-1, 1, (size,3))
+        points = cube.get_points()
+        for c, d in (charges, None), (None, dipoles), (charges, dipoles):
+            ff = molmod.pairff.CoulombFF(scaling, charges=c, dipoles=d, coordinates=cube.molecule.coordinates)
+            esp = ff.esp_points(points.reshape(-1, 3)).reshape(cube.data.shape)
+            efield = ff.efield_points(points.reshape(-1, 3)).reshape(points.shape)
+            self.assertArraysAlmostEqual(ff.esp_grid(points), esp)
+            self.assertArraysAlmostEqual(ff.efield_grid(points, chunk_size=100, workers=3), efield)
+            self.assertArraysAlmostEqual(ff.esp_grid(points, 100.0, chunk_size=77, workers=2), esp)
+            # write the result straight into the cube
+            ff.esp_grid(points, out=cube.data, chunk_size=50)
+            self.assertArraysAlmostEqual(cube.data, esp)
+        self.assertRaises(TypeError, ff.esp_grid, points, out=np.zeros(10))
+        self.assertRaises(TypeError, ff.efield_grid, points[..., :2])
+
+    def test_grid_float(self):
+        from molmod.io.cube import Cube
+        cube = Cube.from_file('input/alanine.cube')
+        size = cube.molecule.size
+        scaling = 1 - np.identity(size, float)
+        charges = np.random.uniform(-1, 1, size)
+        dipoles = np.random.uniform(-1, 1, (size,3))
+        points = cube.get_points()
+        points32 = points.astype(np.float32)
+        ff = molmod.pairff.CoulombFF(scaling, charges=charges, dipoles=dipoles, coordinates=cube.molecule.coordinates)
+        esp = ff.esp_grid(points)
+        esp32 = ff.esp_grid(points32, chunk_size=100, workers=2)
+        self.assertEqual(esp32.dtype, np.float32)
+        self.assert_(abs(esp32 - esp).max() < 1e-5*abs(esp).max())
+        efield = ff.efield_grid(points)
+        efield32 = ff.efield_grid(points32)
+        self.assertEqual(efield32.dtype, np.float32)
+        self.assert_(abs(efield32 - efield).max() < 1e-5*abs(efield).max())
+        self.assertRaises(TypeError, ff.esp_grid, points32, out=np.zeros(esp.shape))
+
     def test_efield(self):
         coordinates = np.random.uniform(-1, 1, (3,3))
         point = coordinates[0]
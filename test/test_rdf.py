@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from molmod.rdf import *
+from molmod.binning import PairSearchImages
+from molmod.unit_cells import UnitCell
+from molmod.units import angstrom
+from molmod.io.xyz import XYZReader
+
+import numpy, unittest
+
+
+__all__ = ["RadialDistributionTestCase"]
+
+
+class RadialDistributionTestCase(unittest.TestCase):
+    def test_ideal_gas(self):
+        unit_cell = UnitCell(numpy.identity(3)*10.0)
+        labels = numpy.array([1]*200 + [2]*100)
+        rdf = RadialDistribution(labels, [(1, 1), (1, 2), (2, 1)], 7.0, 7)
+        for i in xrange(20):
+            coordinates = numpy.random.uniform(0, 10, (300, 3))
+            rdf.add_frame(coordinates, unit_cell)
+        self.assertEqual(rdf.num_frames, 20)
+        g = rdf.get_rdf()
+        self.assertEqual(g.shape, (3, 7))
+        # skip the first bins, which are too noisy
+        self.assert_(abs(g[:,2:] - 1).max() < 0.15)
+        n = rdf.get_coordination()
+        self.assertAlmostEqual(n[0,-1]/(200/1000.0*4.0/3.0*numpy.pi*7.0**3), 1.0, 1)
+        self.assertAlmostEqual(n[1,-1]/(100/1000.0*4.0/3.0*numpy.pi*7.0**3), 1.0, 1)
+        self.assertAlmostEqual(n[2,-1]/(200/1000.0*4.0/3.0*numpy.pi*7.0**3), 1.0, 1)
+
+    def test_ideal_gas_small(self):
+        # with few atoms, the self pairs must be excluded from the normalization
+        unit_cell = UnitCell(numpy.identity(3)*20.0)
+        rdf = RadialDistribution(numpy.array([8]*4), [(8, 8)], 10.0, 5)
+        for i in xrange(2000):
+            coordinates = numpy.random.uniform(0, 20, (4, 3))
+            rdf.add_frame(coordinates, unit_cell)
+        g = rdf.get_rdf()
+        self.assertAlmostEqual(g[0, 2:].mean(), 1.0, 1)
+
+    def test_histogram_reader(self):
+        reader = XYZReader("input/thf.xyz")
+        unit_cell = UnitCell(numpy.identity(3)*20*angstrom)
+        rdf = RadialDistribution(reader.numbers, [(8, 1), (6, 6)], 5*angstrom, 10)
+        rdf.add_frames(reader, lambda frame: (frame[1], unit_cell))
+        self.assertEqual(rdf.num_frames, 1)
+        # compare with a direct histogram
+        coordinates = XYZReader("input/thf.xyz").next()[1]
+        numbers = reader.numbers
+        i0, i1, images, deltas, distances = PairSearchImages(coordinates, 5*angstrom, unit_cell).get_arrays()
+        for index, (n0, n1) in enumerate([(8, 1), (6, 6)]):
+            mask = ((numbers[i0] == n0) & (numbers[i1] == n1)) | ((numbers[i0] == n1) & (numbers[i1] == n0))
+            expected = numpy.histogram(distances[mask], rdf.edges)[0]
+            self.assertEqual(list(rdf.histograms[index]), list(expected))
+
+    def test_aperiodic(self):
+        rdf = RadialDistribution([1, 1, 2], [(1, 2)], 5.0, 5)
+        rdf.add_frames([
+            (numpy.array([[0.0, 0.0, 0.0], [0.0, 0.0, 3.5], [0.0, 0.0, 1.5]]), None),
+        ])
+        self.assertEqual(list(rdf.histograms[0]), [0, 1, 1, 0, 0])
+        self.assertEqual(list(rdf.get_coordination()[0]), [0.0, 0.5, 1.0, 1.0, 1.0])
+        self.assertRaises(ValueError, rdf.get_rdf)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, RadialDistribution, [1, 2], [(1, 3)], 5.0, 5)
+        self.assertRaises(ValueError, RadialDistribution, [1, 2], [(1, 2), (1, 2)], 5.0, 5)
@@ -55,6 +55,26 @@ class SimilarityTestCase(unittest.TestCase):
             molecule.descriptor = SimilarityDescriptor.from_molecular_graph(molecule.graph)
         self.check(molecules, margin=0.2, cutoff=10.0)
 
+    def test_float(self):
+        molecules = self.get_molecules()
+        for molecule in molecules:
+            molecule.descriptor = SimilarityDescriptor.from_coordinates(
+                molecule.coordinates.astype(numpy.float32), molecule.numbers
+            )
+            self.assertEqual(molecule.descriptor.table_distances.dtype, numpy.float32)
+        self.check(molecules, margin=0.2*angstrom, cutoff=7.0*angstrom)
+        # compare with double precision, also when the two are mixed
+        for molecule1 in molecules:
+            descriptor1 = SimilarityDescriptor.from_molecule(molecule1)
+            for molecule2 in molecules:
+                descriptor2 = SimilarityDescriptor.from_molecule(molecule2)
+                expected = compute_similarity(descriptor1, descriptor2, 0.2*angstrom, 7.0*angstrom)
+                for value in [
+                    compute_similarity(molecule1.descriptor, molecule2.descriptor, 0.2*angstrom, 7.0*angstrom),
+                    compute_similarity(descriptor1, molecule2.descriptor, 0.2*angstrom, 7.0*angstrom),
+                ]:
+                    self.assert_(abs(value - expected) <= 1e-4*expected)
+
     def check(self, molecules, margin, cutoff, verbose=False):
         if verbose:
             print
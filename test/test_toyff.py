@@ -105,6 +105,7 @@ class ToyFFTestCase(unittest.TestCase):
         numbers = numpy.random.randint(6, 10, N)
         graph = MolecularGraph(edges, numbers)
         ff = ToyFF(graph, unit_cell)
+        ff.graph = graph
 
         return ff, coordinates, dm, mask, unit_cell
 
@@ -121,6 +122,32 @@ class ToyFFTestCase(unittest.TestCase):
 
         self.assert_(error < oom*1e-5)
 
+    def check_toyff_hessian(self, ff, coordinates):
+        energy0, gradient0, hessian0 = ff(coordinates, do_hessian=True)
+        self.assertAlmostEqual(energy0, ff(coordinates))
+        self.assert_(abs(gradient0 - ff(coordinates, True)[1]).max() <= abs(gradient0).max()*1e-10)
+        self.assert_(abs(hessian0 - hessian0.transpose()).max() <= abs(hessian0).max()*1e-10)
+        eps = numpy.random.uniform(-1e-6, 1e-6, coordinates.shape)
+        energy1, gradient1, hessian1 = ff(coordinates+eps, do_hessian=True)
+
+        delta_gradient = gradient1 - gradient0
+        approx_delta_gradient = 0.5*numpy.dot(hessian0 + hessian1, eps.ravel())
+
+        error = abs(delta_gradient - approx_delta_gradient).max()
+        oom = abs(delta_gradient).max()
+
+        self.assert_(error < oom*1e-5)
+
+        # compare the sparse and the dense Hessian
+        size = len(hessian0)/3
+        offsets, columns, blocks = ff.hessian_sparse(coordinates)
+        hessian_sparse = numpy.zeros((size, 3, size, 3), float)
+        for i in xrange(size):
+            for p in xrange(offsets[i], offsets[i+1]):
+                hessian_sparse[i, :, columns[p], :] = blocks[p]
+            self.assert_((numpy.diff(columns[offsets[i]:offsets[i+1]]) > 0).all())
+        self.assert_(abs(hessian_sparse.reshape(hessian0.shape) - hessian0).max() <= abs(hessian0).max()*1e-10)
+
     def test_dm_quad_energy(self):
         for i in xrange(10):
             ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
@@ -137,6 +164,12 @@ class ToyFFTestCase(unittest.TestCase):
             ff.dm_quad = 1.0
             self.check_toyff_gradient(ff, coordinates)
 
+    def test_dm_quad_hessian(self):
+        for i in xrange(10):
+            ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
+            ff.dm_quad = 1.0
+            self.check_toyff_hessian(ff, coordinates)
+
     def test_dm_reci_energy(self):
         for i in xrange(10):
             ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
@@ -157,6 +190,12 @@ class ToyFFTestCase(unittest.TestCase):
             ff.dm_reci = 1.0
             self.check_toyff_gradient(ff, coordinates)
 
+    def test_dm_reci_hessian(self):
+        for i in xrange(10):
+            ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
+            ff.dm_reci = 1.0
+            self.check_toyff_hessian(ff, coordinates)
+
     def test_bond_quad_energy(self):
         for i in xrange(10):
             ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
@@ -172,6 +211,12 @@ class ToyFFTestCase(unittest.TestCase):
             ff.bond_quad = 1.0
             self.check_toyff_gradient(ff, coordinates)
 
+    def test_bond_quad_hessian(self):
+        for i in xrange(10):
+            ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
+            ff.bond_quad = 1.0
+            self.check_toyff_hessian(ff, coordinates)
+
     def test_bond_hyper_energy(self):
         for i in xrange(10):
             ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
@@ -187,6 +232,91 @@ class ToyFFTestCase(unittest.TestCase):
             ff.bond_hyper = 1.0
             self.check_toyff_gradient(ff, coordinates)
 
+    def test_bond_hyper_hessian(self):
+        for i in xrange(10):
+            ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
+            ff.bond_hyper = 1.0
+            self.check_toyff_hessian(ff, coordinates)
+
+    def test_sparse(self):
+        for i in xrange(10):
+            ff, coordinates, dm, mask, unit_cell = self.get_random_ff()
+            # with a large graph distance, the sparse mode must be exact
+            ff_sparse = ToyFF(ff.graph, unit_cell, max_graph_distance=len(coordinates))
+            for key in "dm_quad", "dm_reci", "bond_quad", "span_quad":
+                setattr(ff, key, 1.0)
+                setattr(ff_sparse, key, 1.0)
+            energy0, gradient0, hessian0 = ff(coordinates, do_hessian=True)
+            energy1, gradient1, hessian1 = ff_sparse(coordinates, do_hessian=True)
+            self.assertAlmostEqual(energy0, energy1)
+            self.assert_(abs(gradient0 - gradient1).max() <= 1e-10*abs(gradient0).max())
+            self.assert_(abs(hessian0 - hessian1).max() <= 1e-10*abs(hessian0).max())
+            self.check_toyff_gradient(ff_sparse, coordinates)
+            self.check_toyff_hessian(ff_sparse, coordinates)
+
+    def test_sparse_pairs(self):
+        mol = Molecule.from_file("input/caplayer.cml")
+        dm = mol.graph.distances
+        for max_graph_distance in 1, 2, 3:
+            ff = ToyFF(mol.graph, max_graph_distance=max_graph_distance)
+            i, j = ff.dm_pairs.transpose()
+            self.assert_((i < j).all())
+            self.assertEqual(len(ff.dm_pairs), ((dm > 0) & (dm <= max_graph_distance)).sum()/2)
+            self.assert_((dm[i, j]**2 == ff.dm_lengths).all())
+        self.assertRaises(ValueError, ToyFF, mol.graph, max_graph_distance=0)
+
+    def test_guess_geometry_sparse(self):
+        mol = Molecule.from_file("input/caplayer.cml")
+        output_mol = guess_geometry(mol.graph, max_graph_distance=4)
+        self.assertEqual(output_mol.size, mol.size)
+        for i, j in mol.graph.edges:
+            distance = numpy.linalg.norm(output_mol.coordinates[i] - output_mol.coordinates[j])
+            self.assert_(distance < 2*angstrom)
+
+    def test_threads(self):
+        # The compiled routines release the GIL, such that several force
+        # fields can be evaluated concurrently.
+        import threading
+        mol = Molecule.from_file("input/dopamine.xyz")
+        ff = ToyFF(MolecularGraph.from_geometry(mol))
+        ff.dm_quad = 1.0
+        ff.dm_reci = 1.0
+        ff.bond_hyper = 1.0
+        ff.span_quad = 1.0
+        xs = [mol.coordinates.ravel() + numpy.random.uniform(-0.1, 0.1, mol.size*3) for i in xrange(8)]
+        expected = [ff(x, True) for x in xs]
+        results = [None]*len(xs)
+        def work(index):
+            results[index] = ff(xs[index], True)
+        threads = [threading.Thread(target=work, args=(index,)) for index in xrange(len(xs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (energy0, gradient0), (energy1, gradient1) in zip(expected, results):
+            self.assert_(abs(energy0 - energy1) <= abs(energy0)*1e-10)
+            self.assert_(abs(gradient0 - gradient1).max() <= abs(gradient0).max()*1e-10)
+
+    def test_batch(self):
+        mol = Molecule.from_file("input/dopamine.xyz")
+        graph = MolecularGraph.from_geometry(mol)
+        xs = mol.coordinates + numpy.random.uniform(-0.3, 0.3, (5, mol.size, 3))
+        for max_graph_distance in None, 3:
+            ff = ToyFF(graph, max_graph_distance=max_graph_distance)
+            ff.dm_quad = 1.0
+            ff.dm_reci = 1.0
+            ff.bond_quad = 0.5
+            ff.bond_hyper = 1.0
+            ff.span_quad = 1.0
+            energies, gradients = ff.batch(xs, do_gradient=True)
+            self.assertEqual(energies.shape, (5,))
+            self.assertEqual(gradients.shape, (5, mol.size, 3))
+            self.assert_(abs(ff.batch(xs) - energies).max() <= abs(energies).max()*1e-10)
+            for i in xrange(5):
+                energy, gradient = ff(xs[i].ravel(), True)
+                self.assert_(abs(energies[i] - energy) <= abs(energy)*1e-10)
+                self.assert_(abs(gradients[i].ravel() - gradient).max() <= abs(gradient).max()*1e-10)
+
     def test_example_periodic(self):
         mol = Molecule.from_file("input/caplayer.cml")
         unit_cell = UnitCell(
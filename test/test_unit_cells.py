@@ -487,3 +487,38 @@ class UnitCellTestCase(BaseTestCase):
             for i1, i0 in enumerate(uc0.active_inactive[0]):
                 self.assertArraysAlmostEqual(uc0.matrix[:,i0], uc1.matrix[:,i1])
                 self.assertEqual(uc0.active[i0], uc1.active[i1])
+
+    def test_reduced(self):
+        for i in xrange(20):
+            uc0 = self.get_random_uc(full=False)
+            uc1 = uc0.reduced
+            self.assertArraysEqual(uc0.active, uc1.active)
+            self.assertAlmostEqual(uc0.volume, uc1.volume)
+            # the same lattice
+            if uc1.active.any():
+                transformation = uc0.to_fractional(uc1.matrix.transpose()[uc1.active])
+                self.assertArraysAlmostEqual(transformation, numpy.round(transformation), doabs=True)
+            # not longer
+            norms0 = numpy.sqrt((uc0.matrix**2).sum(axis=0))
+            norms1 = numpy.sqrt((uc1.matrix**2).sum(axis=0))
+            self.assert_((norms1 <= norms0*(1 + 1e-10)).all())
+
+    def test_shortest_vector_exact(self):
+        for i in xrange(20):
+            uc = self.get_random_uc(full=False)
+            r0 = numpy.random.normal(0, 10, (10,3))
+            r1 = uc.shortest_vector(r0, exact=True)
+            # brute force minimum image
+            indexes = (numpy.indices((11,11,11)).reshape(3, -1).transpose() - 5)*uc.active
+            shifts = uc.reduced.to_cartesian(indexes)
+            for j in xrange(10):
+                index = uc.to_fractional(r0[j] - r1[j])
+                self.assertArraysAlmostEqual(index, numpy.round(index), doabs=True)
+                candidates = uc.reduced.shortest_vector(r0[j]) + shifts
+                shortest = numpy.sqrt((candidates**2).sum(axis=1)).min()
+                self.assertAlmostEqual(numpy.linalg.norm(r1[j]), shortest)
+                r1_row_bis = uc.shortest_vector(r0[j], exact=True)
+                self.assertArraysAlmostEqual(r1_row_bis, r1[j], doabs=True)
+        # orthorhombic cells do not need image shifts
+        uc = UnitCell(numpy.diag([1.0, 2.0, 3.0]))
+        self.assertEqual(len(uc.image_shifts), 0)
@@ -45,6 +45,7 @@ class TypeCheckTest(ReadOnly):
     c = ReadOnlyAttribute(numpy.ndarray, npdim=2)
     d = ReadOnlyAttribute(numpy.ndarray, npshape=(None,3))
     e = ReadOnlyAttribute(numpy.ndarray, npdtype=float)
+    f = ReadOnlyAttribute(numpy.ndarray, npdtype=float, allow_float32=True)
 
 
 class CustomCheckTest(ReadOnly):
@@ -118,6 +119,16 @@ class UtilsTestCase(unittest.TestCase):
         test.d = numpy.array([[1.2, 3.5, 10.0], [7.1, 0.1, 0.2]])
         test.e = numpy.array([4.2, 3.1])
 
+    def test_type_checking_float32(self):
+        test = TypeCheckTest()
+        test.e = numpy.array([4.2, 3.1], numpy.float32)
+        self.assertEqual(test.e.dtype, float)
+        test.f = numpy.array([4.2, 3.1], numpy.float32)
+        self.assertEqual(test.f.dtype, numpy.float32)
+        test = TypeCheckTest()
+        test.f = [4.2, 3.1]
+        self.assertEqual(test.f.dtype, float)
+
     def test_assign_list(self):
         self.check_type_error(Test, [4, 5])
 